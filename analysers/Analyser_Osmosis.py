@@ -135,6 +135,8 @@ CREATE INDEX idx_buildings_linestring_wall ON {0}.buildings USING GIST(linestrin
             self.relation:"relation", self.relation_full:"relation",
         }
         self.typeMapping = {'N': self.node_full, 'W': self.way_full, 'R': self.relation_full}
+        self.typeFull = {self.node_full: "node", self.node_position: "node", self.way_full: "way", self.relation_full: "relation"}
+        self.objects = None
 
         if hasattr(config, "verbose") and config.verbose:
             self.explain_sql = True
@@ -154,12 +156,14 @@ CREATE INDEX idx_buildings_linestring_wall ON {0}.buildings USING GIST(linestrin
         # close database connections + output file
         self.giscurs.close()
         self.gisconn.close()
+        self.logger.log(self.apiconn.CacheStats())
         self.apiconn.close()
         Analyser.__exit__(self, exc_type, exc_value, traceback)
 
 
     def analyser(self):
         self.init_analyser()
+        self.apiconn.CacheClear()
         if self.classs != {} or self.classs_change != {}:
             self.logger.log(u"run osmosis all analyser %s" % self.__class__.__name__)
             self.error_file.analyser(self.config.timestamp)
@@ -183,6 +187,7 @@ CREATE INDEX idx_buildings_linestring_wall ON {0}.buildings USING GIST(linestrin
 
     def analyser_change(self):
         self.init_analyser()
+        self.apiconn.CacheClear()
         if self.classs != {}:
             self.logger.log(u"run osmosis base analyser %s" % self.__class__.__name__)
             self.error_file.analyser(self.config.timestamp)
@@ -336,7 +341,7 @@ WHERE
 """
         self.giscurs.execute(sql.format(table, type, id))
 
-    def run0(self, sql, callback = None):
+    def run0(self, sql, callback = None, callback_block = None):
         if self.explain_sql:
             self.logger.log(sql.strip())
         if self.explain_sql and (sql.strip().startswith("SELECT") or sql.strip().startswith("CREATE TABLE")) and not ';' in sql[:-1] and " AS " in sql:
@@ -364,45 +369,94 @@ WHERE
                         print("res=", res)
                         print("ret=", ret)
                         raise
+                if callback_block:
+                    callback_block()
 
     def run(self, sql, callback = None):
+        # errors of a block of rows are written once the objects they need
+        # are read, in batch
+        pending = []
+
         def callback_package(res):
             ret = callback(res)
             if ret and ret.__class__ == dict:
                 if "self" in ret:
                     res = ret["self"](res)
-                if "data" in ret:
-                    self.geom = defaultdict(list)
-                    for (i, d) in enumerate(ret["data"]):
-                        if d != None:
-                            d(res[i])
-                    ret["fixType"] = map(lambda datai: self.FixTypeTable[datai] if datai != None and datai in self.FixTypeTable else None, ret["data"])
-                self.error_file.error(
-                    ret["class"],
-                    ret.get("subclass"),
-                    ret.get("text"),
-                    res,
-                    ret.get("fixType"),
-                    ret.get("fix"),
-                    self.geom)
+                pending.append((res, ret))
+
+        def callback_block():
+            self.prefetch(pending)
+            for (res, ret) in pending:
+                try:
+                    self.error_package(res, ret)
+                except:
+                    print("res=", res)
+                    print("ret=", ret)
+                    raise
+            del pending[:]
+            self.objects = None
 
         caller = getframeinfo(stack()[1][0])
         if callback:
             self.logger.log(u"%s:%d xml generation" % (caller.filename, caller.lineno))
-            self.run0(sql, callback_package)
+            self.run0(sql, callback_package, callback_block)
         else:
             self.logger.log(u"%s:%d sql" % (caller.filename, caller.lineno))
             self.run0(sql)
 
 
+    def error_package(self, res, ret):
+        if "data" in ret:
+            self.geom = defaultdict(list)
+            for (i, d) in enumerate(ret["data"]):
+                if d != None:
+                    d(res[i])
+            ret["fixType"] = map(lambda datai: self.FixTypeTable[datai] if datai != None and datai in self.FixTypeTable else None, ret["data"])
+        self.error_file.error(
+            ret["class"],
+            ret.get("subclass"),
+            ret.get("text"),
+            res,
+            ret.get("fixType"),
+            ret.get("fix"),
+            self.geom)
+
+    def prefetch(self, rows):
+        """
+        Read the objects needed by the *_full() and node_position() data of
+        rows, (res, ret) pairs, with one query by type.
+        """
+        ids = {"node": set(), "way": set(), "relation": set()}
+        types = {'N': "node", 'W': "way", 'R': "relation"}
+        for (res, ret) in rows:
+            for (i, d) in enumerate(ret.get("data") or []):
+                if d == None or res[i] == None:
+                    continue
+                if d in self.typeFull:
+                    ids[self.typeFull[d]].add(res[i])
+                elif d == self.any_full:
+                    ids[types[res[i][0]]].add(int(res[i][1:]))
+                elif d == self.array_full:
+                    for r in res[i]:
+                        ids[types[r[0]]].add(int(r[1:]))
+        self.objects = {}
+        for (t, get_many) in (("node", self.apiconn.NodeGetMany), ("way", self.apiconn.WayGetMany), ("relation", self.apiconn.RelationGetMany)):
+            l = list(ids[t])
+            self.objects[t] = dict(zip(l, get_many(l)))
+
+    def get(self, t, id):
+        if self.objects is not None and id in self.objects[t]:
+            return self.objects[t][id]
+        return {"node": self.apiconn.NodeGet, "way": self.apiconn.WayGet, "relation": self.apiconn.RelationGet}[t](id)
+
     def node(self, res):
         self.geom["node"].append({"id":res, "tag":{}})
 
     def node_full(self, res):
-        self.geom["node"].append(self.apiconn.NodeGet(res))
+        self.geom["node"].append(self.get("node", res))
 
     def node_position(self, res):
-        node = self.apiconn.NodeGet(res)
+        node = self.get("node", res)
         if node:
             self.geom["position"].append({'lat': str(node['lat']), 'lon': str(node['lon'])})
 
@@ -413,13 +467,13 @@ WHERE
         self.geom["way"].append({"id":res, "nd":[], "tag":{}})
 
     def way_full(self, res):
-        self.geom["way"].append(self.apiconn.WayGet(res))
+        self.geom["way"].append(self.get("way", res))
 
     def relation(self, res):
         self.geom["relation"].append({"id":res, "member":[], "tag":{}})
 
     def relation_full(self, res):
-        self.geom["relation"].append(self.apiconn.RelationGet(res))
+        self.geom["relation"].append(self.get("relation", res))
 
     def any_full(self, res):
         self.typeMapping[res[0]](int(res[1:]))
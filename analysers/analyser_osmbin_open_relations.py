@@ -34,8 +34,8 @@ def data2dict(data):
         res[x["type"]][x["data"]["id"]] = x["data"]
     return res
 
-def get_ways(relid, bin):
-    data = bin.RelationFullRecur(relid, WayNodes = False, RaiseOnLoop = False, RemoveSubarea = True)
+def get_ways(relid, bin, memo = None):
+    data = bin.RelationFullRecur(relid, WayNodes = False, RaiseOnLoop = False, RemoveSubarea = True, Memo = memo)
     ways = []
     for x in data:
         if x["type"] == "way":
@@ -76,8 +76,10 @@ class Analyser_OsmBin_Open_Relations(Analyser):
         self.classs = {"boundary": 1, "multipolygon": 2}
 
         self.bin = OsmBin.OsmBin(osmbin_path)
+        self.memo = {} # member relations shared by relations
         self.bin.CopyRelationTo(self)
         del self.bin
+        del self.memo
 
         self.error_file.analyser_end()
 
@@ -88,7 +90,7 @@ class Analyser_OsmBin_Open_Relations(Analyser):
             return
 
         try:
-            ways = get_ways(data["id"], self.bin)
+            ways = get_ways(data["id"], self.bin, self.memo)
         except OsmBin.MissingDataError as e:
             print(e, "on relation", data["id"])
             return
@@ -108,8 +110,7 @@ class Analyser_OsmBin_Open_Relations(Analyser):
             except:
                 pass
 
-        for nid, cpt in bnds:
-            ndata = self.bin.NodeGet(nid)
+        for ndata in self.bin.NodeGetMany([nid for nid, cpt in bnds]):
             if ndata:
                 if ndata["lat"] > 90 or ndata["lat"] < -90:
                     print("Incorrect node found on relation", data["id"])
@@ -22,8 +22,14 @@
 
 from Analyser import Analyser
 
-import sys, os
+import sys, os, socket, time
+import collections
+import cPickle
+import hashlib
 import importlib
+import inspect
+import itertools
+import multiprocessing
 from modules import OsmoseLog
 
 ###########################################################################
@@ -32,6 +38,21 @@ class Analyser_Sax(Analyser):
 
     def __init__(self, config, logger = OsmoseLog.logger()):
         Analyser.__init__(self, config, logger)
+        self._shards = None
+        # elements waiting for plugins, as (kind, data)
+        self._batch = []
+        # errors and deletions waiting for their objects to be read
+        self._pending = []
+        # relations with pending errors kept until the end of the parsing,
+        # and number of their entries in _pending
+        self._pending_relations = set()
+        self._pending_held = 0
+        self._resolved = {"node": {}, "way": {}, "relation": {}, "user": {}}
+        # anchors of parsed relations, to locate them without reading all
+        # their members, and nodes located by anchors, see locateRelation()
+        self._anchors = {}
+        self._located = {}
+        self._loops = set()
 
     def __enter__(self):
         Analyser.__enter__(self)
@@ -43,6 +64,8 @@ class Analyser_Sax(Analyser):
     def __exit__(self, exc_type, exc_value, traceback):
         # close database connections
         self._log(u"Closing reader and parser")
+        if hasattr(self._reader, "CacheStats"):
+            self._log(self._reader.CacheStats())
         del self.parser
         del self._reader
         Analyser.__exit__(self, exc_type, exc_value, traceback)
@@ -64,6 +87,10 @@ class Analyser_Sax(Analyser):
     def ToolsOpenFile(self, filename, mode):
         return open(self.ToolsGetFilePath(filename).encode("utf8"), mode)
 
+    def ToolsGetCacheFolder(self):
+        from modules import config
+        return getattr(self.config, "dir_plugins_cache", None) or config.dir_plugins_cache
+
     def ToolsListDir(self, dirname):
         return [x.decode("utf8") for x in os.listdir(self.ToolsGetFilePath(dirname))]
 
@@ -93,15 +120,23 @@ class Analyser_Sax(Analyser):
     #### Reader
 
     def NodeGet(self, NodeId):
+        if NodeId in self._resolved["node"]:
+            return self._resolved["node"][NodeId]
         return self._reader.NodeGet(NodeId)
 
     def WayGet(self, WayId):
+        if WayId in self._resolved["way"]:
+            return self._resolved["way"][WayId]
         return self._reader.WayGet(WayId)
 
     def RelationGet(self, RelationId):
+        if RelationId in self._resolved["relation"]:
+            return self._resolved["relation"][RelationId]
         return self._reader.RelationGet(RelationId)
 
     def UserGet(self, UserId):
+        if UserId in self._resolved["user"]:
+            return self._resolved["user"][UserId]
         return self._reader.UserGet(UserId)
 
     def ExtendData(self, data):
@@ -127,27 +162,230 @@ class Analyser_Sax(Analyser):
         self.logger.sub().cpt(txt)
 
     ################################################################################
-    #### Node parsing
-
-    def NodeCreate(self, data):
-
-        # Initialisation
-        err  = []
-        tags = data[u"tag"]
-
-        if tags == {}:
-            return
+    #### Plugins evaluation
+
+    def _plugins_results(self, kind, data):
+        """
+        Results of the plugins methods of kind, in plugins order, None for
+        the ones not triggered by the tags of data.
+        """
+        return self._plugins_results_batch([(kind, data)])[0]
+
+    def _plugins_results_batch(self, elements, only = None):
+        """
+        Results of the plugins methods for each (kind, data) of elements, as
+        by _plugins_results(), None for elements of kind None. Batch methods
+        of plugins are called once for each run of elements of same kind,
+        with the ones triggering them. only restricts methods called to some
+        indexes, by kind.
+        """
+        results = [None] * len(elements)
+        for (kind, run) in itertools.groupby(xrange(len(elements)), lambda j: elements[j][0]):
+            if kind is None:
+                continue
+            methodes = self._plugins_batch_methodes[kind]
+            called = collections.defaultdict(list)
+            for j in run:
+                results[j] = [None] * len(methodes)
+                for i in self._plugins_dispatch(kind, elements[j][1][u"tag"]):
+                    called[i].append(j)
+            for i in sorted(called):
+                if only is None or i in only[kind]:
+                    res = methodes[i]([self._plugins_args(kind, elements[j][1]) for j in called[i]])
+                    for (j, r) in zip(called[i], res):
+                        results[j][i] = r
+        return results
+
+    def _plugins_dispatch(self, kind, tags):
+        """
+        Indexes of the plugins methods of kind to call for tags, cached by
+        set of tag keys.
+        """
+        key = (kind, frozenset(tags))
+        selected = self._plugins_dispatch_cache.get(key)
+        if selected is None:
+            (always, keys, prefixes) = self._plugins_dispatch_table[kind]
+            selected = set(always)
+            for k in tags:
+                if k in keys:
+                    selected.update(keys[k])
+                for (prefix, methodes) in prefixes:
+                    if k.startswith(prefix):
+                        selected.update(methodes)
+            selected = sorted(selected)
+            if len(self._plugins_dispatch_cache) >= 100000:
+                self._plugins_dispatch_cache.clear()
+            self._plugins_dispatch_cache[key] = selected
+        return selected
+
+    def _plugins_args(self, kind, data):
+        if kind == "node":
+            return (data, data[u"tag"])
+        elif kind == "way":
+            return (data, data[u"tag"], data[u"nd"])
+        else:
+            return (data, data[u"tag"], data[u"member"])
 
-        # On execute les jobs
-        for meth in self.pluginsNodeMethodes:
-            res = meth(data, tags)
+    def _plugins_errors(self, results):
+        err = []
+        for res in results:
             if res:
                 if isinstance(res, dict):
                     err.append(res)
                 else:
                     err += res
+        return err
+
+    def _create(self, kind, data):
+        self._batch.append((kind, data))
+        if len(self._batch) >= 1000:
+            self._batch_flush()
+
+    def _delete(self, kind, data):
+        self._batch.append((kind + "_delete", data))
+        if len(self._batch) >= 1000:
+            self._batch_flush()
+
+    def _batch_flush(self):
+        """
+        Run plugins on the batch of elements, by worker processes when there
+        are, and keep their errors to be written.
+        """
+        batch = self._batch
+        self._batch = []
+        # deleted elements are not checked
+        jobs = [(kind, data) if not kind.endswith("_delete") else (None, None) for (kind, data) in batch]
+        if self._shards:
+            self._shards.send(batch, jobs)
+        else:
+            for ((kind, data), results) in zip(batch, self._plugins_results_batch(jobs)):
+                self._pending_add(kind, data, None if results is None else self._plugins_errors(results))
+
+    ################################################################################
+    #### Errors output
+
+    def _pending_add(self, kind, data, err):
+        """
+        Keep errors of an element, or its deletion when err is None, to be
+        written by _pending_flush(), in the same order.
+        """
+        if err is None or err:
+            self._pending.append((kind, data, err))
+            if self._pending_hold(kind, data):
+                self._pending_relations.add(data["id"])
+                self._pending_held += 1
+            elif len(self._pending) - self._pending_held >= 10000:
+                self._pending_flush(hold=True)
+
+    def _pending_hold(self, kind, data):
+        # errors of relations anchored on sub-relations not parsed yet are
+        # kept until the end of the parsing, to locate them with anchors of
+        # sub-relations coming after them, and so are later entries of the
+        # same relations
+        if kind in ("relation", "relation_delete") and data["id"] in self._pending_relations:
+            return True
+        return kind == "relation" and data.get(u"member") and self._anchor_parsed(self._anchor(data), set([data["id"]])) is None
+
+    def _pending_flush(self, hold=False):
+        """
+        Write pending errors and deletions, after reading the objects they
+        need by batches of ids: missing metadata, users, and positions of
+        ways and relations. With hold, entries of relations kept until the
+        end of the parsing are not written.
+        """
+        held = []
+        if hold and self._pending_held:
+            pending = self._pending
+            self._pending = []
+            for entry in pending:
+                if entry[0] in ("relation", "relation_delete") and entry[1]["id"] in self._pending_relations:
+                    held.append(entry)
+                else:
+                    self._pending.append(entry)
+
+        nodes = set()
+        ways = set()
+        relations = set()
+        for (kind, data, err) in self._pending:
+            meta = "uid" in data or "user" in data
+            if kind == "node" and not meta:
+                nodes.add(data["id"])
+            elif kind == "way":
+                if not meta:
+                    ways.add(data["id"])
+                if data[u"nd"]:
+                    nodes.add(data[u"nd"][len(data[u"nd"])/2])
+            elif kind == "relation" and not meta:
+                relations.add(data["id"])
+        self._resolve("relation", relations)
+
+        # anchors of relations, to locate them
+        member_ways = set()
+        for (kind, data, err) in self._pending:
+            if kind == "relation" and data[u"member"]:
+                if not "uid" in data and not "user" in data:
+                    data = self.RelationGet(data["id"])
+                anchor = data and self._anchor_member(self._anchor(data), set([data["id"]]))
+                if anchor and anchor[0] == u"node":
+                    nodes.add(anchor[1])
+                elif anchor:
+                    member_ways.add(anchor[1])
+        self._resolve("way", ways | member_ways)
+        for w in member_ways:
+            way = self._resolved["way"][w]
+            if way and way[u"nd"]:
+                nodes.add(way[u"nd"][0])
+        self._resolve("node", nodes)
+
+        # names of users of objects written with errors
+        users = set()
+        for (kind, data, err) in self._pending:
+            if err and not "uid" in data and not "user" in data:
+                data = self._resolved[kind].get(data["id"])
+            if data and "uid" in data and not "user" in data:
+                users.add(data["uid"])
+        for uid in sorted(users):
+            self._resolved["user"][uid] = self._reader.UserGet(uid)
+
+        for (kind, data, err) in self._pending:
+            if err is None:
+                getattr(self.error_file, kind)(data["id"])
+            else:
+                getattr(self, "_%s_errors" % kind)(data, err)
+        self._pending = held
+        if not held:
+            self._pending_relations.clear()
+            self._pending_held = 0
+        for objects in self._resolved.values():
+            objects.clear()
+        self._located.clear()
+        if self._loops:
+            self._sublog(u"loops of relation members on relations %s" % ", ".join(map(str, sorted(self._loops))))
+            self._loops.clear()
+
+    def _resolve(self, kind, ids):
+        """
+        Read objects of kind by increasing ids, with a single call when the
+        reader can read several ones.
+        """
+        ids = sorted(ids)
+        get_many = getattr(self._reader, kind.capitalize() + "GetMany", None)
+        if get_many:
+            objects = get_many(ids)
+        else:
+            get = getattr(self._reader, kind.capitalize() + "Get")
+            objects = [get(i) for i in ids]
+        self._resolved[kind].update(zip(ids, objects))
+
+    ################################################################################
+    #### Node parsing
+
+    def NodeCreate(self, data):
+        if data[u"tag"] == {}:
+            return
+        self._create("node", data)
 
-        # Enregistrement des erreurs
+    def _node_errors(self, data, err):
         if err:
             if not "uid" in data and not "user" in data:
                 data = self.NodeGet(data["id"])
@@ -176,29 +414,17 @@ class Analyser_Sax(Analyser):
         self.NodeCreate(data)
 
     def NodeDelete(self, data):
-        self.error_file.node_delete(data["id"])
+        self._delete("node", data)
 
     ################################################################################
     #### Way parsing
 
     def WayCreate(self, data):
+        self._create("way", data)
 
-        # Initialisation
-        err  = []
-        tags = data[u"tag"]
-        nds  = data[u"nd"]
-
-        # On execute les jobs
-        for meth in self.pluginsWayMethodes:
-            res = meth(data, tags, nds)
-            if res:
-                if isinstance(res, dict):
-                    err.append(res)
-                else:
-                    err += res
-
-        # Enregistrement des erreurs
+    def _way_errors(self, data, err):
         if err:
+            nds = data[u"nd"]
             if not "uid" in data and not "user" in data:
                 tmp_data = self.WayGet(data["id"])
                 if tmp_data:
@@ -232,54 +458,128 @@ class Analyser_Sax(Analyser):
         self.WayCreate(data)
 
     def WayDelete(self, data):
-        self.error_file.way_delete(data["id"])
+        self._delete("way", data)
 
     ################################################################################
     #### Relation parsing
 
-    def locateRelation(self, data, recur_control = []):
-        node = None
+    def _anchor(self, data):
+        """
+        Anchor of a relation: its first node or way member, else the list of
+        its sub-relations.
+        """
+        relations = []
         for memb in data[u"member"]:
-            if memb[u"type"] == u"node":
-                node = self.NodeGet(memb[u"ref"])
-            elif memb[u"type"] == "way":
-                way = self.WayGet(memb[u"ref"])
-                if way:
-                    node = self.NodeGet(way[u"nd"][0])
+            if memb[u"type"] in (u"node", u"way"):
+                return (memb[u"type"], memb[u"ref"])
+            elif memb[u"type"] == u"relation":
+                relations.append(memb[u"ref"])
+        return (u"relation", tuple(relations))
+
+    def _anchor_member(self, anchor, seen):
+        """
+        Node or way member expected to locate a relation, from the anchors of
+        parsed sub-relations, None if not known.
+        """
+        if anchor[0] != u"relation":
+            return anchor
+        for ref in anchor[1]:
+            if ref not in seen and ref in self._anchors:
+                seen.add(ref)
+                member = self._anchor_member(self._anchors[ref], seen)
+                if member:
+                    return member
+
+    def _anchor_parsed(self, anchor, seen):
+        """
+        True if anchors of parsed sub-relations reach a node or way member,
+        False if they have none, None if a sub-relation to follow is not
+        parsed yet.
+        """
+        if anchor[0] != u"relation":
+            return True
+        for ref in anchor[1]:
+            if ref in seen:
+                continue
+            if ref not in self._anchors:
+                return None
+            seen.add(ref)
+            parsed = self._anchor_parsed(self._anchors[ref], seen)
+            if parsed is not False:
+                return parsed
+        return False
+
+    def locateRelation(self, data):
+        """
+        Node locating a relation: its first node member, or first node of its
+        first way member, else location of its first located sub-relation.
+        """
+        return self._locate(data["id"], self._anchor(data), [], data)[0]
+
+    def _locate(self, id, anchor, stack, data = None):
+        """
+        Location of relation id from its anchor, relations of stack being
+        skipped as sub-relations. Also returns if a loop of members was
+        skipped, making location depend on stack.
+        """
+        if anchor[0] != u"relation":
+            node = self._locate_member(anchor[0], anchor[1])
             if node:
-                break
-        if not node:
+                return (node, False)
+            # first member missing, as on extract borders, try the other ones
+            if data is None:
+                data = self.RelationGet(id)
+                if not data:
+                    return (None, False)
             for memb in data[u"member"]:
-                if memb[u"type"] == u"relation":
-                    ref = memb[u"ref"]
-                    if ref == data["id"] or ref in recur_control:
-                        # don't reread the same relation
-                        continue
-                    rel = self.RelationGet(memb[u"ref"])
-                    if rel:
-                        node = self.locateRelation(rel, recur_control=recur_control+[data["id"]])
+                node = self._locate_member(memb[u"type"], memb[u"ref"])
                 if node:
-                    break
-        return node
-
-    def RelationCreate(self, data):
-
-        # Initialisation
+                    return (node, False)
+            relations = [memb[u"ref"] for memb in data[u"member"] if memb[u"type"] == u"relation"]
+        else:
+            relations = anchor[1]
 
-        err  = []
-        tags = data[u"tag"]
-        members = data[u"member"]
+        loop = False
+        for ref in relations:
+            if ref == id or ref in stack:
+                self._loops.add(id)
+                loop = True
+                continue
+            (node, sub_loop) = self._locate_relation(ref, stack + [id])
+            loop = loop or sub_loop
+            if node:
+                return (node, loop)
+        return (None, loop)
+
+    def _locate_member(self, kind, ref):
+        if kind == u"node":
+            return self.NodeGet(ref)
+        elif kind == u"way":
+            way = self.WayGet(ref)
+            if way:
+                return self.NodeGet(way[u"nd"][0])
+
+    def _locate_relation(self, id, stack):
+        if id in self._located:
+            return (self._located[id], False)
+        data = None
+        anchor = self._anchors.get(id)
+        if anchor is None:
+            # not parsed, as on change files
+            data = self.RelationGet(id)
+            if not data:
+                return (None, False)
+            anchor = self._anchor(data)
+        (node, loop) = self._locate(id, anchor, stack, data)
+        if not loop:
+            self._located[id] = node
+        return (node, loop)
 
-        # On execute les jobs
-        for meth in self.pluginsRelationMethodes:
-            res = meth(data, tags, members)
-            if res:
-                if isinstance(res, dict):
-                    err.append(res)
-                else:
-                    err += res
+    def RelationCreate(self, data):
+        self._anchors[data["id"]] = self._anchor(data)
+        self._create("relation", data)
 
-        # Enregistrement des erreurs
+    def _relation_errors(self, data, err):
         if err and data[u"member"]:
             if not "uid" in data and not "user" in data:
                 data = self.RelationGet(data["id"])
@@ -311,29 +611,57 @@ class Analyser_Sax(Analyser):
         self.RelationCreate(data)
 
     def RelationDelete(self, data):
-        self.error_file.relation_delete(data["id"])
+        self._anchors.pop(data["id"], None)
+        self._delete("relation", data)
 
     ################################################################################
 
     def _load_reader(self):
-        if hasattr(self.config, 'db_string') and self.config.db_string:
-            from modules import OsmOsis
-            self._reader = OsmOsis.OsmOsis(self.config.db_string, self.config.db_schema)
+        if hasattr(self.config, "reader"):
+            self._reader = self.config.reader
             return
 
-        try:
-            from modules import OsmBin
-            self._reader = OsmBin.OsmBin("/data/work/osmbin/data")
-            return
-        except IOError:
-            pass
+        from modules import config
+        readers = getattr(self.config, "sax_readers", None) or config.sax_readers
+        for reader in readers:
+            if reader == "osmosis":
+                if hasattr(self.config, 'db_string') and self.config.db_string:
+                    from modules import OsmOsis
+                    self._reader = OsmOsis.OsmOsis(self.config.db_string, self.config.db_schema)
+                    return
 
-        if hasattr(self.config, "reader"):
-            self._reader = self.config.reader
+            elif reader == "osmbin_socket":
+                try:
+                    from modules import OsmBin
+                    self._reader = OsmBin.OsmBinClient(config.osmbin_socket)
+                    return
+                except socket.error:
+                    pass
 
-        else:
-            from modules import OsmSaxAlea
-            self._reader = OsmSaxAlea.OsmSaxReader(self.config.src)
+            elif reader == "osmbin":
+                try:
+                    from modules import OsmBin
+                    self._reader = OsmBin.OsmBin(config.osmbin_folder)
+                    return
+                except IOError:
+                    pass
+
+            elif reader == "sqlite":
+                # store of a full extract, not of a change file
+                if not self.config.src.endswith((".osc", ".osc.gz", ".osc.bz2")):
+                    from modules import OsmSqlite
+                    self._reader = OsmSqlite.OsmSqlite(self.config.src, self.logger.sub())
+                    return
+
+            elif reader == "alea":
+                from modules import OsmSaxAlea
+                self._reader = OsmSaxAlea.OsmSaxReader(self.config.src)
+                return
+
+            else:
+                raise Exception("Unknown sax reader '%s'" % reader)
+
+        raise Exception("No sax reader available among %s" % ", ".join(readers))
 
     ################################################################################
 
@@ -345,21 +673,21 @@ class Analyser_Sax(Analyser):
         elif (self.config.src.endswith(".osc") or
               self.config.src.endswith(".osc.gz") or
               self.config.src.endswith(".osc.bz2")):
-            from modules.OsmSax import OscSaxReader
-            self.parser = OscSaxReader(self.config.src, self.logger.sub())
+            from modules.OsmSax import OscExpatReader
+            self.parser = OscExpatReader(self.config.src, self.logger.sub())
             self.parsing_change_file = True
         elif (self.config.src.endswith(".osm") or
               self.config.src.endswith(".osm.gz") or
               self.config.src.endswith(".osm.bz2")):
-            from modules.OsmSax import OsmSaxReader
-            self.parser = OsmSaxReader(self.config.src, self.logger.sub())
+            from modules.OsmSax import OsmExpatReader
+            self.parser = OsmExpatReader(self.config.src, self.logger.sub())
             self.parsing_change_file = False
         else:
             raise Exception("File extension '%s' is not recognized" % self.config.src)
 
     ################################################################################
 
-    def _load_plugins(self):
+    def _load_plugins(self, shardable_only = False):
 
         self._log(u"Loading plugins")
         self._Err = {}
@@ -401,10 +729,13 @@ class Analyser_Sax(Analyser):
                         self._sublog(u"skip "+plugin[:-3])
                         continue
 
+                if shardable_only and not pluginClazz.shardable:
+                    continue
+
                 # Initialisation du plugin
                 pluginInstance = pluginClazz(self)
                 self._sublog(u"init "+pluginName+" ("+", ".join(pluginInstance.availableMethodes())+")")
-                if pluginInstance.init(self.logger.sub().sub()) != False:
+                if self._init_plugin(pluginInstance) != False:
 
                     pluginAvailableMethodes = pluginInstance.availableMethodes()
                     self.plugins[pluginName] = pluginInstance
@@ -423,6 +754,96 @@ class Analyser_Sax(Analyser):
                             raise Exception("class %d already present as item %d" % (cl, self._Err[cl]['item']))
                         self._Err[cl] = v
 
+        self._plugins_methodes = {
+            "node": self.pluginsNodeMethodes,
+            "way": self.pluginsWayMethodes,
+            "relation": self.pluginsRelationMethodes,
+        }
+        self._load_plugins_dispatch()
+
+    def _load_plugins_dispatch(self):
+        # methods of plugins with only_for_tags called only when one of the
+        # keys, or of the "prefix*", is in tags
+        self._plugins_dispatch_table = {}
+        self._plugins_dispatch_cache = {}
+        self._plugins_batch_methodes = {}
+        for (kind, methodes) in self._plugins_methodes.items():
+            self._plugins_batch_methodes[kind] = [getattr(meth.im_self, kind + "_batch") for meth in methodes]
+            always = []
+            keys = collections.defaultdict(list)
+            prefixes = collections.defaultdict(list)
+            for (i, meth) in enumerate(methodes):
+                only_for_tags = meth.im_self.only_for_tags
+                if only_for_tags is None:
+                    always.append(i)
+                    continue
+                for k in only_for_tags:
+                    if k.endswith("*"):
+                        prefixes[k[:-1]].append(i)
+                    else:
+                        keys[k].append(i)
+            self._plugins_dispatch_table[kind] = (always, dict(keys), prefixes.items())
+
+    def _init_plugin(self, plugin):
+        """
+        Call init() of plugin, or for plugins with init_cache, restore the
+        attributes it set from the cache of a previous run.
+        """
+        logger = self.logger.sub().sub()
+        if plugin.init_cache is None:
+            return plugin.init(logger)
+
+        # one file by plugin and options, replaced when the key changes
+        folder = self.ToolsGetCacheFolder()
+        options = hashlib.sha1(repr(sorted(self.config.options.items()))).hexdigest()
+        filename = os.path.join(folder, "%s-%s.pickle" % (plugin.__class__.__name__, options))
+        key = self._init_cache_key(plugin)
+        try:
+            if plugin.init_cache_delay is None or os.stat(filename).st_mtime > time.time() - plugin.init_cache_delay*24*60*60:
+                with open(filename, "rb") as f:
+                    if cPickle.load(f) == key:
+                        (result, attributes) = cPickle.load(f)
+                        plugin.__dict__.update(attributes)
+                        return result
+        except Exception:
+            # no cache, or not readable, init again
+            pass
+
+        result = plugin.init(logger)
+        attributes = dict((name, getattr(plugin, name)) for name in ["errors"] + plugin.init_cache if hasattr(plugin, name))
+        tmp = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(tmp, "wb") as f:
+                cPickle.dump(key, f, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump((result, attributes), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, filename)
+        except (IOError, OSError, TypeError, cPickle.PicklingError) as e:
+            self._sublog(u"can't write init cache of %s: %s" % (plugin.__class__.__name__, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return result
+
+    def _init_cache_key(self, plugin):
+        """
+        Key of the init cache of plugin, from the options, and modification
+        times of the plugin sources, of its data files and of translations.
+        It is stored in the cache file, checked before restoring attributes.
+        """
+        key = [_INIT_CACHE_VERSION, sorted(self.config.options.items())]
+        for clazz in inspect.getmro(plugin.__class__)[:-1]:
+            key.append(os.stat(inspect.getsourcefile(clazz)).st_mtime)
+        for name in plugin.init_cache_files + ["po"]:
+            path = self.ToolsGetFilePath(name)
+            if os.path.isdir(path):
+                key.append([(f, os.stat(os.path.join(path, f)).st_mtime) for f in sorted(os.listdir(path))])
+            elif os.path.exists(path):
+                key.append(os.stat(path).st_mtime)
+            else:
+                key.append(None)
+        return hashlib.sha1(repr(key)).hexdigest()
+
     ################################################################################
 
     def _load_output(self):
@@ -441,7 +862,21 @@ class Analyser_Sax(Analyser):
 
     def _run_analyse(self):
         self._log(u"Analysing file "+self.config.src)
-        self.parser.CopyTo(self)
+        from modules import config
+        concurrency = getattr(self.config, "sax_concurrency", None) or config.sax_concurrency or multiprocessing.cpu_count()
+        if concurrency > 1:
+            self._sublog(u"running plugins in %d processes" % concurrency)
+            self._shards = _Shards(self, concurrency)
+        try:
+            self.parser.CopyTo(self)
+            self._batch_flush()
+            if self._shards:
+                self._shards.close()
+            self._pending_flush()
+        finally:
+            if self._shards:
+                self._shards.terminate()
+                self._shards = None
         self._log(u"Analyse finished")
 
     ################################################################################
@@ -454,7 +889,72 @@ class Analyser_Sax(Analyser):
             self.plugins[y].end(self.logger.sub().sub())
 
     def _close_output(self):
-        self.error_file.analyser_end()
+        if not self.config.timestamp:
+            # Not in file header, computed by parser from read data
+            self.config.timestamp = self.parser.timestamp()
+        self.error_file.analyser_end(self.config.timestamp)
+
+# version of the pickled attributes of plugins init cache
+_INIT_CACHE_VERSION = 2
+
+################################################################################
+#### Plugins evaluation in worker processes
+
+# analyser of the worker process, with its own shardable plugins
+_shard_analyser = None
+
+def _shard_init(config):
+    global _shard_analyser
+    _shard_analyser = Analyser_Sax(config, OsmoseLog.logger(open(os.devnull, "w")))
+    _shard_analyser._load_plugins(shardable_only = True)
+
+def _shard_run(jobs):
+    return _shard_analyser._plugins_results_batch(jobs)
+
+class _Shards(object):
+    """
+    Evaluation of shardable plugins by worker processes, each one loading
+    its own plugins. Batches of elements are sent to them, the other plugins
+    are run at once in the analyser process. Errors are given back to the
+    analyser in elements order, merged in plugins order, so the output is
+    the same as when running all plugins in the analyser process.
+    """
+
+    def __init__(self, analyser, processes):
+        self._analyser = analyser
+        self._processes = processes
+        self._local = {}
+        for (kind, methodes) in analyser._plugins_methodes.items():
+            self._local[kind] = [i for (i, meth) in enumerate(methodes) if not meth.im_self.shardable]
+        self._pending = collections.deque()
+        self._pool = multiprocessing.Pool(processes, _shard_init, (analyser.config,))
+
+    def send(self, batch, jobs):
+        local = self._analyser._plugins_results_batch(jobs, self._local)
+        self._pending.append((batch, local, self._pool.apply_async(_shard_run, (jobs,))))
+        # bounded number of pending batches, when output is slower than plugins
+        while len(self._pending) > 2 * self._processes:
+            self._receive()
+
+    def _receive(self):
+        (batch, local, job) = self._pending.popleft()
+        analyser = self._analyser
+        for ((kind, data), local_results, results) in zip(batch, local, job.get()):
+            if results is None:
+                analyser._pending_add(kind, data, None)
+                continue
+            for i in self._local[kind]:
+                results.insert(i, local_results[i])
+            analyser._pending_add(kind, data, analyser._plugins_errors(results))
+
+    def close(self):
+        while self._pending:
+            self._receive()
+        self._pool.close()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
 
 ################################################################################
 from Analyser import TestAnalyser
@@ -489,6 +989,9 @@ class TestAnalyserOsmosis(TestAnalyser):
             polygon_id = None
             reader = TestAnalyserOsmosis.MockupReader()
         self.config = config()
+        # plugins init() called by each test, not restored from other runs
+        import tempfile
+        self.config.dir_plugins_cache = tempfile.mkdtemp()
 
         # create directory for results
         import os
@@ -501,6 +1004,10 @@ class TestAnalyserOsmosis(TestAnalyser):
           else:
             raise
 
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.config.dir_plugins_cache)
+
     def test(self):
         self.xml_res_file = os.path.join(self.dirname, "sax.test.xml")
         self.config.dst = self.xml_res_file
@@ -513,6 +1020,229 @@ class TestAnalyserOsmosis(TestAnalyser):
         self.root_err = self.load_errors()
         self.check_num_err(min=37)
 
+    def test_parallel(self):
+        self.xml_res_file = os.path.join(self.dirname, "sax.test.parallel.xml")
+        self.config.dst = self.xml_res_file
+        self.config.options = {"project": "openstreetmap"}
+        self.config.sax_concurrency = 2
+        # mix of plugins run in workers and in the analyser process
+        from plugins.Highway_Lanes import Highway_Lanes
+        Highway_Lanes.shardable = False
+        try:
+            with Analyser_Sax(self.config) as analyser_obj:
+                analyser_obj.analyser()
+        finally:
+            del Highway_Lanes.shardable
+
+        self.compare_results("tests/results/sax.test.xml")
+
+    def test_plugins_shardable(self):
+        # shardable plugins give the same errors with elements split between
+        # worker processes, each one with its own instances
+        from modules import OsmSax
+        class Collect:
+            def __init__(self):
+                self.jobs = []
+            def NodeCreate(self, data):
+                self.jobs.append(("node", data))
+            def WayCreate(self, data):
+                self.jobs.append(("way", data))
+            def RelationCreate(self, data):
+                self.jobs.append(("relation", data))
+        collect = Collect()
+        OsmSax.OsmExpatReader(self.config.src).CopyTo(collect)
+
+        self.config.options = {"project": "openstreetmap", "country": "FR", "language": "fr"}
+        analysers = [Analyser_Sax(self.config) for i in range(3)]
+        for a in analysers:
+            a._load_plugins(shardable_only = True)
+        self.assertTrue(len(analysers[0].plugins) > 40)
+        results = analysers[0]._plugins_results_batch(collect.jobs)
+        for (i, job) in enumerate(collect.jobs):
+            self.assertEquals(analysers[1 + i % 2]._plugins_results_batch([job])[0], results[i], job)
+
+    def test_plugins_dispatch(self):
+        from plugins.Plugin import Plugin
+        class P_all(Plugin):
+            def node(self, data, tags):
+                return {"class": 1}
+        class P_name(Plugin):
+            only_for_tags = ["name", "addr:*"]
+            def node(self, data, tags):
+                return [{"class": 2}, {"class": 3}]
+            def way(self, data, tags, nds):
+                return {"class": 4}
+
+        a = Analyser_Sax(self.config)
+        (p1, p2) = (P_all(a), P_name(a))
+        a._plugins_methodes = {"node": [p1.node, p2.node, p1.node], "way": [p2.way], "relation": []}
+        a._load_plugins_dispatch()
+        for (tags, node, way) in (({}, [0, 2], []),
+                                  ({"name": "a"}, [0, 1, 2], [0]),
+                                  ({"addr:street": "a", "name": "a"}, [0, 1, 2], [0]),
+                                  ({"addr": "a"}, [0, 2], [])):
+            self.assertEquals(a._plugins_dispatch("node", tags), node)
+            self.assertEquals(a._plugins_dispatch("way", tags), way)
+
+        data = {"id": 1, "tag": {"name": "a"}, "nd": []}
+        self.assertEquals(a._plugins_errors(a._plugins_results("node", data)), [{"class": 1}, {"class": 2}, {"class": 3}, {"class": 1}])
+        data = {"id": 1, "tag": {"highway": "a"}, "nd": []}
+        self.assertEquals(a._plugins_results("way", data), [None])
+
+    def test_plugins_batch(self):
+        from plugins.Plugin import Plugin
+        class P_each(Plugin):
+            def node(self, data, tags):
+                return {"class": 1, "subclass": data["id"]}
+        class P_batch(Plugin):
+            only_for_tags = ["name"]
+            calls = []
+            def node(self, data, tags):
+                return {"class": 2, "subclass": data["id"]}
+            def node_batch(self, nodes):
+                self.calls.append([data["id"] for (data, tags) in nodes])
+                return Plugin.node_batch(self, nodes)
+
+        a = Analyser_Sax(self.config)
+        (p1, p2) = (P_each(a), P_batch(a))
+        a._plugins_methodes = {"node": [p1.node, p2.node], "way": [], "relation": []}
+        a._load_plugins_dispatch()
+        elements = [("node", {"id": 1, "tag": {"name": "a"}}),
+                    ("node", {"id": 2, "tag": {}}),
+                    (None, None),
+                    ("node", {"id": 3, "tag": {"name": "a"}}),
+                    ("way", {"id": 4, "tag": {"name": "a"}, "nd": []}),
+                    ("node", {"id": 5, "tag": {"name": "a"}})]
+        results = a._plugins_results_batch(elements)
+        # called once by run of elements of same kind
+        self.assertEquals(P_batch.calls, [[1], [3], [5]])
+        self.assertEquals(results[0], [{"class": 1, "subclass": 1}, {"class": 2, "subclass": 1}])
+        self.assertEquals(results[1], [{"class": 1, "subclass": 2}, None])
+        self.assertEquals(results[2], None)
+        self.assertEquals(results[4], [])
+        for (res, (kind, data)) in zip(results, elements):
+            if kind:
+                self.assertEquals(res, a._plugins_results(kind, data))
+        results = a._plugins_results_batch(elements, {"node": [1], "way": []})
+        self.assertEquals(results[0], [None, {"class": 2, "subclass": 1}])
+
+    def test_pending_flush(self):
+        class Reader(TestAnalyserOsmosis.MockupReader):
+            calls = []
+            def NodeGetMany(self, ids):
+                self.calls.append(("node", ids))
+                return [self.NodeGet(i) for i in ids]
+            def WayGetMany(self, ids):
+                self.calls.append(("way", ids))
+                return [self.WayGet(i) for i in ids]
+        class ErrorFile(object):
+            def __init__(self):
+                self.out = []
+            def error(self, classs, subclass, text, res, types, fix, geom):
+                self.out.append((classs, res, types, geom["position"][0]["id"]))
+            def node_delete(self, id):
+                self.out.append(("node_delete", id))
+
+        a = Analyser_Sax(self.config)
+        a._reader = Reader()
+        a.error_file = ErrorFile()
+        a._pending_add("way", {"id": 3, "tag": {}, "nd": [30, 31, 32]}, [{"class": 1}])
+        a._pending_add("node", {"id": 1, "tag": {}, "user": "u"}, [{"class": 2}])
+        a._pending_add("node", {"id": 2, "tag": {}}, [])
+        a._pending_add("node_delete", {"id": 4}, None)
+        a._pending_add("relation", {"id": 5, "tag": {}, "member": [{"type": "way", "ref": 6}]}, [{"class": 3}])
+        self.assertEquals(a.error_file.out, [])
+        a._pending_flush()
+        self.assertEquals(a.error_file.out, [(1, [3], ["way"], 31), (2, [1], ["node"], 1), ("node_delete", 4), (3, [5], ["relation"], 0)])
+        # relation 5 read from reader, with a node member
+        self.assertEquals(Reader.calls, [("way", [3]), ("node", [0, 31])])
+        self.assertEquals(a._pending, [])
+
+        # relations located from sub-relations not parsed yet are held at the
+        # threshold, not the ones already anchored on a node or way
+        class ErrorFile(ErrorFile):
+            def relation_delete(self, id):
+                self.out.append(("relation_delete", id))
+        a.error_file = ErrorFile()
+        a._anchors[11] = (u"node", 110)
+        a._anchors[13] = (u"relation", (14,))
+        a._pending_add("relation", {"id": 7, "tag": {}, "user": "u", "member": [{"type": "relation", "ref": 9}]}, [{"class": 4}])
+        a._pending_add("relation", {"id": 8, "tag": {}, "user": "u", "member": [{"type": "node", "ref": 80}]}, [{"class": 5}])
+        a._pending_add("relation", {"id": 10, "tag": {}, "user": "u", "member": [{"type": "relation", "ref": 11}]}, [{"class": 6}])
+        a._pending_add("relation", {"id": 12, "tag": {}, "user": "u", "member": [{"type": "relation", "ref": 13}]}, [{"class": 7}])
+        for i in range(9998):
+            a._pending_add("node_delete", {"id": i}, None)
+        self.assertEquals(len(a.error_file.out), 10000)
+        self.assertEquals(a.error_file.out[0:2], [(5, [8], ["relation"], 80), (6, [10], ["relation"], 110)])
+        self.assertEquals([e[1]["id"] for e in a._pending], [7, 12])
+        a._anchors[9] = (u"node", 90)
+        a._anchors[14] = (u"way", 140)
+        a._pending_add("relation_delete", {"id": 7}, None)
+        a._pending_add("relation_delete", {"id": 8}, None)
+        a._pending_flush()
+        self.assertEquals(a.error_file.out[10000:], [(4, [7], ["relation"], 90), (7, [12], ["relation"], 0), ("relation_delete", 7), ("relation_delete", 8)])
+        self.assertEquals(a._pending, [])
+        self.assertEquals(a._pending_relations, set())
+
+    def test_init_cache(self):
+        from plugins.Plugin import Plugin
+        class P_cached(Plugin):
+            init_cache = ["words", "missing"]
+            calls = 0
+            def init(self, logger):
+                Plugin.init(self, logger)
+                P_cached.calls += 1
+                self.errors[1] = {"item": 1}
+                self.words = set([self.father.config.options.get("language")])
+
+        a = Analyser_Sax(self.config)
+        for language in ("fr", "fr", "nl"):
+            self.config.options = {"language": language}
+            p = P_cached(a)
+            self.assertEquals(a._init_plugin(p), None)
+            self.assertEquals(p.errors, {1: {"item": 1}})
+            self.assertEquals(p.words, set([language]))
+        self.assertEquals(P_cached.calls, 2)
+        self.assertEquals(len(os.listdir(self.config.dir_plugins_cache)), 2)
+
+        # sources changed, file of the same options is replaced
+        a._init_cache_key = lambda plugin: "changed"
+        for i in range(2):
+            p = P_cached(a)
+            a._init_plugin(p)
+            self.assertEquals(p.words, set(["nl"]))
+        self.assertEquals(P_cached.calls, 3)
+        self.assertEquals(len(os.listdir(self.config.dir_plugins_cache)), 2)
+
+    def test_locate_relation(self):
+        rels = {1: [("relation", 2), ("relation", 3)],
+                2: [("relation", 1)],
+                3: [("relation", 3), ("way", 66), ("way", 7)],
+                4: [("relation", 2), ("relation", 5)],
+                5: [("relation", 1)]}
+        rels = dict((id, {"id": id, "tag": {}, "member": [{"type": t, "ref": r} for (t, r) in members]}) for (id, members) in rels.items())
+        class Reader(TestAnalyserOsmosis.MockupReader):
+            def WayGet(self, id):
+                if id != 66:
+                    return { "id": id, "nd": [id * 10], "tag": {} }
+            def RelationGet(self, id):
+                return rels.get(id)
+
+        a = Analyser_Sax(self.config)
+        a._reader = Reader()
+        a._plugins_methodes = {"node": [], "way": [], "relation": []}
+        a._load_plugins_dispatch()
+        for id in (1, 2, 3, 5):
+            a.RelationCreate(rels[id])
+        self.assertEquals(a._anchors[1], ("relation", (2, 3)))
+        self.assertEquals(a._anchors[3], ("way", 66))
+        for id in (1, 2, 4, 5):
+            self.assertEquals(a.locateRelation(rels[id])["id"], 70)
+        self.assertEquals(sorted(a._loops), [1, 2])
+        # self loop of relation 3 not reached, only it is located without
+        # skipping a loop
+        self.assertEquals(a._located.keys(), [3])
+
     def test_FR(self):
         self.xml_res_file = os.path.join(self.dirname, "sax.test.FR.xml")
         self.xml_res_file = "tests/out/sax.test.FR.xml"
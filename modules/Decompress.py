@@ -0,0 +1,656 @@
+#-*- coding: utf-8 -*-
+
+###########################################################################
+##                                                                       ##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+##                                                                       ##
+###########################################################################
+
+# Decompression of .bz2 and .gz files ahead of the reader, in background
+# threads. zlib and bz2 release the GIL while decompressing, so the parsing
+# thread and the decompressing threads really run side by side.
+#
+# Multistream .bz2 files (as written by pbzip2 or lbzip2, like the planet
+# dumps) are split on stream boundaries and the streams are decompressed in
+# parallel by a pool of threads.
+
+import bisect
+import bz2
+import collections
+import itertools
+import multiprocessing
+import Queue
+import re
+import sys
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+
+###########################################################################
+## Decompressed chunks generators
+
+# Header of a bz2 stream followed by the magic of its first block, the only
+# place where a block begins on a byte boundary
+_Bz2StreamStart = re.compile("BZh[1-9]1AY&SY")
+
+# Over this size without any stream boundary, file is not multistream,
+# pbzip2 and lbzip2 streams are made from at most 900 KB of input
+_BZ2_MAX_STREAM = 2**20
+
+# Compressed data given at once to the decompressor of a single stream,
+# decompressed chunks are then about a bzip2 block, 900 KB
+_BZ2_STREAM_INPUT = 2**16
+
+def _Bz2Stream(chunks):
+    """
+    Decompress concatenated bz2 streams, from an iterator on compressed data.
+    """
+    d = bz2.BZ2Decompressor()
+    for data in chunks:
+        while data:
+            try:
+                out = d.decompress(data)
+            except EOFError:
+                # previous stream ended at the end of last chunk
+                if not "BZh".startswith(data[:3]):
+                    return
+                d = bz2.BZ2Decompressor()
+                continue
+            if out:
+                yield out
+            data = d.unused_data
+            if data:
+                if not "BZh".startswith(data[:3]):
+                    # trailing garbage
+                    return
+                d = bz2.BZ2Decompressor()
+
+def _Bz2Decompress(data):
+    return "".join(_Bz2Stream([data]))
+
+def _Split(data, size):
+    return (data[i:i+size] for i in xrange(0, len(data), size))
+
+def _Bz2Chunks(f, chunk_size, threads):
+    # started on first stream boundary, not to pay it on single stream files
+    pool = None
+    try:
+        pending = collections.deque()
+        data = ""
+        while True:
+            read = f.read(chunk_size)
+            if read:
+                # only look for a boundary in the newly read part
+                cut = None
+                for m in _Bz2StreamStart.finditer(data + read, max(1, len(data) - 9)):
+                    cut = m.start()
+                data += read
+                if cut is None:
+                    if len(data) >= _BZ2_MAX_STREAM:
+                        break
+                    continue
+            elif not pending:
+                # small single stream file
+                break
+            else:
+                cut = len(data)
+
+            if cut:
+                if not pool:
+                    pool = ThreadPool(threads)
+                pending.append(pool.apply_async(_Bz2Decompress, (data[:cut],)))
+                data = data[cut:]
+            while len(pending) > 2 * threads or (pending and not read):
+                yield pending.popleft().get()
+            if not read:
+                return
+
+        # one stream, can't be split
+        while pending:
+            yield pending.popleft().get()
+        for out in _Bz2Stream(itertools.chain(_Split(data, _BZ2_STREAM_INPUT), iter(lambda: f.read(_BZ2_STREAM_INPUT), ""))):
+            yield out
+
+    finally:
+        if pool:
+            # don't wait for the pool threads, terminate() can take 0.1s
+            pool.close()
+
+def _GzipChunks(f, chunk_size, threads):
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for data in iter(lambda: f.read(chunk_size), ""):
+        while data:
+            out = d.decompress(data)
+            if out:
+                yield out
+            data = d.unused_data
+            if data:
+                # next member of a concatenated gzip file
+                if not "\x1f\x8b".startswith(data[:2]):
+                    # trailing garbage
+                    return
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    out = d.flush()
+    if out:
+        yield out
+
+def _Produce(chunks, queue, stop):
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    try:
+        for out in chunks:
+            if not put(out):
+                return
+        put(None)
+    except Exception:
+        put(sys.exc_info())
+    finally:
+        chunks.close()
+
+###########################################################################
+
+class _ChunkFile(object):
+    """
+    Read-only file object on decompressed chunks returned by _Next().
+    On seek, _Restart(offset) can start the chunks again from a position
+    before offset and return it, or return None to keep reading forward.
+    """
+
+    def _Reset(self, offset):
+        self._buffer = ""
+        self._pos = 0           # read position in _buffer
+        self._offset = offset   # position in decompressed data of _buffer[0]
+        self._eof = False
+
+    def _Fill(self):
+        if self._eof:
+            return False
+        try:
+            item = self._Next()
+        except:
+            self._eof = True
+            raise
+        if item is None:
+            self._eof = True
+            return False
+        self._offset += self._pos
+        self._buffer = self._buffer[self._pos:] + item
+        self._pos = 0
+        return True
+
+    def read(self, size = -1):
+        if size < 0:
+            out = [self._buffer[self._pos:]]
+            self._offset += len(self._buffer)
+            self._buffer = ""
+            self._pos = 0
+            while self._Fill():
+                out.append(self._buffer)
+                self._offset += len(self._buffer)
+                self._buffer = ""
+            return "".join(out)
+
+        while len(self._buffer) - self._pos < size and self._Fill():
+            pass
+        out = self._buffer[self._pos:self._pos + size]
+        self._pos += len(out)
+        return out
+
+    def readline(self):
+        start = self._pos
+        while True:
+            i = self._buffer.find("\n", start)
+            if i >= 0:
+                end = i + 1
+                break
+            start = len(self._buffer) - self._pos
+            if not self._Fill():
+                end = len(self._buffer)
+                break
+            # _Fill() moved remaining data at the beginning of _buffer
+        out = self._buffer[self._pos:end]
+        self._pos = end
+        return out
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def tell(self):
+        return self._offset + self._pos
+
+    def seek(self, offset, whence = 0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence != 0:
+            raise IOError("Seek from end not supported")
+        start = self._Restart(offset)
+        if start is not None:
+            self._Reset(start)
+        while offset > self._offset + len(self._buffer):
+            self._offset += len(self._buffer)
+            self._buffer = ""
+            self._pos = 0
+            if not self._Fill():
+                break
+        self._pos = min(offset - self._offset, len(self._buffer))
+
+    def fileno(self):
+        # as with GzipFile, descriptor of the compressed file
+        return self._file.fileno()
+
+    def __del__(self):
+        self.close()
+
+
+class DecompressFile(_ChunkFile):
+    """
+    Read-only file object on a .bz2 or .gz file, decompressed by background
+    threads, filling a bounded queue of decompressed chunks.
+    Seeking backward out of current chunk restarts the decompression.
+    """
+
+    def __init__(self, filename, threads = None, chunk_size = 2**20, queue_size = 8):
+        self.name = filename
+        self._threads = threads or multiprocessing.cpu_count()
+        self._chunk_size = chunk_size
+        self._queue_size = queue_size
+        self._file = None
+        self._Start()
+
+    def _Start(self):
+        self._file = open(self.name, "rb")
+        if self.name.endswith(".bz2"):
+            chunks = _Bz2Chunks(self._file, self._chunk_size, self._threads)
+        else:
+            chunks = _GzipChunks(self._file, self._chunk_size, self._threads)
+        self._queue = Queue.Queue(self._queue_size)
+        self._stop = threading.Event()
+        # thread does not reference self, so closing is left to __del__
+        self._thread = threading.Thread(target=_Produce, args=(chunks, self._queue, self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+        self._Reset(0)
+
+    def _Next(self):
+        item = self._queue.get()
+        if isinstance(item, tuple):
+            raise item[0], item[1], item[2]
+        return item
+
+    def _Restart(self, offset):
+        if offset < self._offset:
+            self.close()
+            self._Start()
+            return 0
+
+    def close(self):
+        if self._file:
+            self._stop.set()
+            self._thread.join()
+            self._file.close()
+            self._file = None
+
+###########################################################################
+## Random access in gzip files, from seek points, as zran.c from zlib
+## examples. zlib module doesn't expose inflate() stopping on deflate blocks
+## and restarting from a bit position, so libz is used through ctypes.
+
+try:
+    import ctypes
+    import ctypes.util
+    _libz = ctypes.util.find_library("z")
+    _libz = _libz and ctypes.CDLL(_libz)
+except (ImportError, OSError):
+    _libz = None
+
+if _libz:
+    class _ZStream(ctypes.Structure):
+        _fields_ = [
+            ("next_in", ctypes.c_void_p), ("avail_in", ctypes.c_uint), ("total_in", ctypes.c_ulong),
+            ("next_out", ctypes.c_void_p), ("avail_out", ctypes.c_uint), ("total_out", ctypes.c_ulong),
+            ("msg", ctypes.c_char_p), ("state", ctypes.c_void_p),
+            ("zalloc", ctypes.c_void_p), ("zfree", ctypes.c_void_p), ("opaque", ctypes.c_void_p),
+            ("data_type", ctypes.c_int), ("adler", ctypes.c_ulong), ("reserved", ctypes.c_ulong),
+        ]
+
+    _libz.zlibVersion.restype = ctypes.c_char_p
+    _libz.inflateInit2_.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    _libz.inflate.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_int]
+    _libz.inflateReset.argtypes = [ctypes.POINTER(_ZStream)]
+    _libz.inflatePrime.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_int, ctypes.c_int]
+    _libz.inflateSetDictionary.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_char_p, ctypes.c_uint]
+    _libz.inflateEnd.argtypes = [ctypes.POINTER(_ZStream)]
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+# window of deflate, needed to restart at a seek point
+_WINDOW_SIZE = 32768
+
+# wbits values: auto detection of gzip or zlib header, and raw deflate
+_WBITS_HEADER = 32 + 15
+_WBITS_RAW = -15
+
+def GzipSeekable():
+    return bool(_libz)
+
+
+class _Inflater(object):
+
+    def __init__(self, wbits, out_size = 2**18):
+        self._strm = _ZStream()
+        self._out = ctypes.create_string_buffer(out_size)
+        self._input = None
+        ret = _libz.inflateInit2_(ctypes.byref(self._strm), wbits, _libz.zlibVersion(), ctypes.sizeof(_ZStream))
+        if ret != Z_OK:
+            raise IOError("inflateInit2 failed (%d)" % ret)
+
+    def __del__(self):
+        _libz.inflateEnd(ctypes.byref(self._strm))
+
+    def feed(self, data):
+        self._input = ctypes.create_string_buffer(data, len(data))
+        self._strm.next_in = ctypes.addressof(self._input)
+        self._strm.avail_in = len(data)
+
+    def avail_in(self):
+        return self._strm.avail_in
+
+    def unused_data(self):
+        if not self._strm.avail_in:
+            return ""
+        return ctypes.string_at(self._strm.next_in, self._strm.avail_in)
+
+    def data_type(self):
+        return self._strm.data_type
+
+    def reset(self):
+        _libz.inflateReset(ctypes.byref(self._strm))
+
+    def prime(self, bits, value):
+        _libz.inflatePrime(ctypes.byref(self._strm), bits, value)
+
+    def set_dictionary(self, window):
+        ret = _libz.inflateSetDictionary(ctypes.byref(self._strm), window, len(window))
+        if ret != Z_OK:
+            raise IOError("inflateSetDictionary failed (%d)" % ret)
+
+    def inflate(self, flush = Z_NO_FLUSH):
+        self._strm.next_out = ctypes.addressof(self._out)
+        self._strm.avail_out = len(self._out)
+        ret = _libz.inflate(ctypes.byref(self._strm), flush)
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            raise IOError("Error %d while decompressing: %s" % (ret, self._strm.msg))
+        return (ret, ctypes.string_at(self._out, len(self._out) - self._strm.avail_out))
+
+
+class GzipIndexer(object):
+    """
+    Iterate on decompressed chunks of a gzip file, and record in points the
+    seek points (offset, compressed offset, bits, window) every span bytes of
+    decompressed data.
+    """
+
+    def __init__(self, f, span = 2**20, chunk_size = 2**20):
+        self._file = f
+        self._span = span
+        self._chunk_size = chunk_size
+        self.points = []
+
+    def __iter__(self):
+        inflater = _Inflater(_WBITS_HEADER)
+        totin = totout = last = 0
+        window = ""
+        while True:
+            if not inflater.avail_in():
+                data = self._file.read(self._chunk_size)
+                if not data:
+                    return
+                inflater.feed(data)
+
+            avail_in = inflater.avail_in()
+            (ret, out) = inflater.inflate(Z_BLOCK)
+            totin += avail_in - inflater.avail_in()
+            if out:
+                totout += len(out)
+                window = (window + out)[-_WINDOW_SIZE:]
+                yield out
+
+            if ret == Z_STREAM_END:
+                # next member of a concatenated gzip file
+                inflater.reset()
+            else:
+                # at end of a deflate block, and not of the last one
+                data_type = inflater.data_type()
+                if data_type & 128 and not data_type & 64 and (totout == 0 or totout - last > self._span):
+                    self.points.append((totout, totin, data_type & 7, window))
+                    last = totout
+
+
+class GzipSeekFile(_ChunkFile):
+    """
+    Read-only file object on a gzip file, with random access from seek points
+    made by GzipIndexer. offsets are the sorted decompressed offsets of the
+    points, and points the matching (compressed offset, bits, window).
+    """
+
+    def __init__(self, filename, offsets, points, chunk_size = 2**16):
+        self.name = filename
+        self._offsets = offsets
+        self._points = points
+        self._chunk_size = chunk_size
+        self._file = open(filename, "rb")
+        self._Jump(-1)
+
+    def _Jump(self, i):
+        if i < 0:
+            self._file.seek(0)
+            self._inflater = _Inflater(_WBITS_HEADER)
+            self._raw = False
+            self._Reset(0)
+        else:
+            (pos, bits, window) = self._points[i]
+            self._file.seek(pos - (1 if bits else 0))
+            self._inflater = _Inflater(_WBITS_RAW)
+            if bits:
+                self._inflater.prime(bits, ord(self._file.read(1)) >> (8 - bits))
+            self._inflater.set_dictionary(window)
+            self._raw = True
+            self._Reset(self._offsets[i])
+
+    def _Restart(self, offset):
+        i = bisect.bisect_right(self._offsets, offset) - 1
+        start = self._offsets[i] if i >= 0 else 0
+        if offset < self._offset or start > self._offset + len(self._buffer):
+            self._Jump(i)
+            return self._offset
+
+    def _Next(self):
+        while True:
+            if not self._inflater.avail_in():
+                data = self._file.read(self._chunk_size)
+                if not data:
+                    return None
+                self._inflater.feed(data)
+
+            (ret, out) = self._inflater.inflate()
+            if ret == Z_STREAM_END:
+                # next member of a concatenated gzip file
+                data = self._inflater.unused_data()
+                if self._raw:
+                    # skip the trailer, read by zlib when header is read too
+                    if len(data) < 8:
+                        self._file.read(8 - len(data))
+                    data = data[8:]
+                self._inflater = _Inflater(_WBITS_HEADER)
+                self._raw = False
+                if data:
+                    self._inflater.feed(data)
+            if out:
+                return out
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+###########################################################################
+import unittest
+import gzip
+import os
+import shutil
+import tempfile
+
+class Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.data = bz2.BZ2File("tests/saint_barthelemy.osm.bz2").read()
+
+        # multistream, like pbzip2
+        cls.multi = os.path.join(cls.dir, "multi.osm.bz2")
+        with open(cls.multi, "wb") as f:
+            for i in xrange(0, len(cls.data), 100000):
+                f.write(bz2.compress(cls.data[i:i+100000]))
+
+        # multimember gzip
+        cls.multigz = os.path.join(cls.dir, "multi.osm.gz")
+        with open(cls.multigz, "wb") as f:
+            for i in xrange(0, len(cls.data), 1000000):
+                g = gzip.GzipFile(fileobj=f, mode="wb")
+                g.write(cls.data[i:i+1000000])
+                g.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def check_read(self, filename, **kwargs):
+        f = DecompressFile(filename, **kwargs)
+        out = []
+        while True:
+            data = f.read(12345)
+            if not data:
+                break
+            out.append(data)
+        self.assertEquals("".join(out), self.data)
+        self.assertEquals(f.tell(), len(self.data))
+
+    def test_bz2(self):
+        self.check_read("tests/saint_barthelemy.osm.bz2")
+
+    def test_bz2_multistream(self):
+        self.check_read(self.multi)
+        self.check_read(self.multi, threads=1)
+        self.check_read(self.multi, threads=3, chunk_size=5000, queue_size=1)
+
+    def test_bz2_large_stream(self):
+        global _BZ2_MAX_STREAM
+        old = _BZ2_MAX_STREAM
+        _BZ2_MAX_STREAM = 10000
+        try:
+            self.check_read("tests/saint_barthelemy.osm.bz2", chunk_size=4096)
+        finally:
+            _BZ2_MAX_STREAM = old
+
+    def test_bz2_single_stream_chunks(self):
+        # single stream is not decompressed whole, but by bzip2 blocks of
+        # about 900 KB
+        with open("tests/saint_barthelemy.osm.bz2", "rb") as f:
+            chunks = list(_Bz2Chunks(f, 2**20, 2))
+        self.assertEquals("".join(chunks), self.data)
+        assert len(chunks) > 1
+
+    def test_gz(self):
+        self.check_read("tests/saint_barthelemy.osm.gz")
+        self.check_read("tests/saint_barthelemy.osm.gz", chunk_size=1000)
+
+    def test_gz_multimember(self):
+        self.check_read(self.multigz)
+        self.check_read(self.multigz, chunk_size=4096)
+
+    def test_read_all(self):
+        f = DecompressFile(self.multi, chunk_size=10000)
+        self.assertEquals(f.read(10), self.data[:10])
+        self.assertEquals(f.read(), self.data[10:])
+        self.assertEquals(f.read(), "")
+
+    def test_readline(self):
+        f = DecompressFile(self.multi, chunk_size=1000)
+        self.assertEquals(list(f), self.data.splitlines(True))
+
+    def test_seek(self):
+        f = DecompressFile("tests/saint_barthelemy.osm.gz", chunk_size=1000)
+        for pos in [500000, 500010, 100, 100000, 0, 1500000, len(self.data) - 5]:
+            f.seek(pos)
+            self.assertEquals(f.tell(), pos)
+            self.assertEquals(f.readline(), _ReadLineAt(self.data, pos))
+        f.seek(len(self.data) + 10)
+        self.assertEquals(f.read(), "")
+
+    def test_error(self):
+        bad = os.path.join(self.dir, "bad.osm.bz2")
+        with open(bad, "wb") as f:
+            f.write(bz2.compress(self.data[:100000]))
+            f.write("BZh91AY&SY" + "garbage" * 1000)
+        f = DecompressFile(bad)
+        with self.assertRaises(IOError):
+            f.read()
+
+    def test_close(self):
+        f = DecompressFile(self.multi, chunk_size=1000, queue_size=1)
+        f.read(10)
+        thread = f._thread
+        f.close()
+        self.assertFalse(thread.is_alive())
+
+    def check_seek_file(self, filename, span):
+        with open(filename, "rb") as f:
+            indexer = GzipIndexer(f, span=span, chunk_size=10000)
+            self.assertEquals("".join(indexer), self.data)
+        self.assertTrue(len(indexer.points) > 2)
+        offsets = [p[0] for p in indexer.points]
+        points = [p[1:] for p in indexer.points]
+        self.assertEquals(offsets[0], 0)
+
+        f = GzipSeekFile(filename, offsets, points)
+        self.assertEquals(f.read(), self.data)
+        for pos in [500000, 500010, 100, 100000, 0, 1500000, 999999, 1000000, len(self.data) - 5]:
+            f.seek(pos)
+            self.assertEquals(f.tell(), pos)
+            self.assertEquals(f.readline(), _ReadLineAt(self.data, pos))
+            pos = f.tell()
+            self.assertEquals(f.read(100000), self.data[pos:pos + 100000])
+
+    @unittest.skipIf(not GzipSeekable(), "libz not available")
+    def test_gzip_seek(self):
+        self.check_seek_file("tests/saint_barthelemy.osm.gz", 100000)
+
+    @unittest.skipIf(not GzipSeekable(), "libz not available")
+    def test_gzip_seek_multimember(self):
+        self.check_seek_file(self.multigz, 50000)
+
+def _ReadLineAt(data, pos):
+    end = data.find("\n", pos)
+    return data[pos:] if end < 0 else data[pos:end + 1]
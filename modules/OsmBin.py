@@ -28,6 +28,12 @@
 # 3. wget -O - -o /dev/null http://planet.openstreetmap.org/planet-latest.osm.bz2 \
 #    | bunzip2
 #    | ./OsmBin.py --import /data/osmbin -
+# or, with .pbf decoded by parallel processes:
+# 3. ./OsmBin.py --import /data/osmbin planet-latest.osm.pbf
+# Import into an empty folder writes with large sequential buffers.
+# Tags and attributes (version, user...) of nodes and ways are also stored
+# when the folder is created with:
+# 2. ./OsmBin.py --init /data/osmbin --tags
 
 ###########################################################################
 ## OSC UPDATE                                                            ##
@@ -36,6 +42,8 @@
 # do
 #   bzcat /data/updates/$i | ./OsmBin.py --update /data/osmbin -
 # done
+# Writes of a change file are applied at once, through the journal file of
+# the folder. An interrupted update is completed on next opening for writing.
 
 ###########################################################################
 ## PYTHON                                                                ##
@@ -47,7 +55,40 @@
 # print bin.RelationGet(12)
 # print bin.RelationFullRecur(12)
 
-import sys, os, lockfile
+###########################################################################
+## READ SERVICE                                                          ##
+###########################################################################
+# ./OsmBin.py --serve /data/osmbin /data/osmbin.sock
+# import OsmBin
+# bin = OsmBinClient("/data/osmbin.sock")
+# print bin.NodeGetMany([12, 13])
+
+###########################################################################
+## WAY CONVERSION                                                        ##
+###########################################################################
+# Folders created before the varint way.data format are converted with:
+# ./OsmBin.py --convert-ways /data/osmbin
+
+###########################################################################
+## WAY COMPACTION                                                        ##
+###########################################################################
+# way.data is rewritten in way id order, without the space freed by updates,
+# and fragmentation statistics are printed, with:
+# ./OsmBin.py --compact /data/osmbin
+
+###########################################################################
+## RELATION MIGRATION                                                    ##
+###########################################################################
+# Folders created before relation.idx/relation.data stored one file per
+# relation under relation/. They are converted with:
+# ./OsmBin.py --migrate-relations /data/osmbin
+
+import sys, os, re, time, calendar, lockfile, mmap, struct, socket, SocketServer, threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class MissingDataError(Exception):
     def __init__(self, value):
@@ -124,16 +165,463 @@ def _Str1ToInt(txt):
 def _IntToStr1(i0):
     return chr(i0)
 
+def _IntToCoord(num):
+    return float(num-1800000000)/10000000
+
 def _Str4ToCoord(num):
-    return float(_Str4ToInt(num)-1800000000)/10000000
+    return _IntToCoord(_Str4ToInt(num))
 
 def _CoordToStr4(coord):
     return _IntToStr4(int((coord*10000000)+1800000000))
 
+# node.crd record: latitude and longitude as _CoordToStr4()
+_NodeStruct = struct.Struct(">II")
+if numpy:
+    _NodeDtype = numpy.dtype([("lat", ">u4"), ("lon", ">u4")])
+
+# way.data starts with its format version, also keeping location 0 free of
+# data. A record is the size of its body (varint), then the body: node ids as
+# zigzag varints of the delta to the previous node id (to 0 for the first
+# one). In _WayDataV1, a record was the number of nodes (2 bytes), then the
+# node ids (5 bytes).
+_WayDataV1 = "--"
+_WayDataV2 = "V2"
+_WayReadSize = 256   # bytes read ahead by WayGet()
+_WayNumpyDecode = 64 # numpy is slower on smaller node lists
+_WayNumpyEncode = 256
+
+def _EncodeVarint(num):
+    c = []
+    while num > 127:
+        c.append(chr((num & 127) | 128))
+        num >>= 7
+    c.append(chr(num))
+    return "".join(c)
+
+def _DecodeVarint(buf, pos):
+    num = 0
+    shift = 0
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        num |= (b & 127) << shift
+        if b < 128:
+            return (num, pos)
+        shift += 7
+
+def _EncodeWayNodes(nds):
+    if numpy and len(nds) >= _WayNumpyEncode:
+        ids = numpy.asarray(nds, dtype=numpy.int64)
+        delta = numpy.empty_like(ids)
+        delta[0] = ids[0]
+        delta[1:] = ids[1:] - ids[:-1]
+        z = ((delta << 1) ^ (delta >> 63)).view(numpy.uint64)
+        # number of bytes of each varint
+        n = numpy.ones(len(z), dtype=numpy.int64)
+        for k in range(1, 10):
+            more = z >= 2**(7*k)
+            if not more.any():
+                break
+            n += more
+        start = numpy.cumsum(n) - n
+        c = numpy.empty(int(n.sum()), dtype=numpy.uint8)
+        for k in range(int(n.max())):
+            m = n > k
+            byte = (z[m] >> numpy.uint64(7*k)) & numpy.uint64(127)
+            byte[n[m] > k+1] |= numpy.uint64(128)
+            c[start[m] + k] = byte
+        return c.tostring()
+
+    c = []
+    prev = 0
+    for NodeId in nds:
+        delta = NodeId - prev
+        prev = NodeId
+        z = (delta << 1) ^ (delta >> 63)
+        while z > 127:
+            c.append(chr((z & 127) | 128))
+            z >>= 7
+        c.append(chr(z))
+    return "".join(c)
+
+def _DecodeWayNodes(buf, pos, end):
+    if numpy and end - pos >= _WayNumpyDecode:
+        return _DecodeWayNodesMany(buf, [(pos, end)])[0]
+
+    nds = []
+    prev = 0
+    z = 0
+    shift = 0
+    for c in buf[pos:end]:
+        b = ord(c)
+        z |= (b & 127) << shift
+        if b < 128:
+            prev += (z >> 1) ^ -(z & 1)
+            nds.append(prev)
+            z = 0
+            shift = 0
+        else:
+            shift += 7
+    return nds
+
+def _DecodeWayNodesMany(buf, spans):
+    """
+    Node lists of the way bodies at buf[start:end] for (start, end) in spans,
+    decoded all together when numpy is available.
+    """
+    if not numpy:
+        return [_DecodeWayNodes(buf, start, end) for (start, end) in spans]
+    body = "".join([buf[start:end] for (start, end) in spans])
+    if not body:
+        return [[] for span in spans]
+
+    b = numpy.frombuffer(body, dtype=numpy.uint8)
+    last = b < 128 # last byte of each varint
+    ends = numpy.flatnonzero(last)
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    shift = numpy.arange(len(b)) - numpy.repeat(starts, ends - starts + 1)
+    z = numpy.add.reduceat((b & 127).astype(numpy.uint64) << (7*shift).astype(numpy.uint64), starts)
+    ids = numpy.cumsum((z >> numpy.uint64(1)).view(numpy.int64) ^ -(z & numpy.uint64(1)).view(numpy.int64))
+
+    # deltas of each way start from 0
+    lengths = numpy.array([end - start for (start, end) in spans], dtype=numpy.int64)
+    nb_last = numpy.concatenate(([0], numpy.cumsum(last)))
+    span_ends = numpy.cumsum(lengths)
+    counts = nb_last[span_ends] - nb_last[span_ends - lengths]
+    firsts = numpy.cumsum(counts) - counts
+    ids -= numpy.repeat(numpy.where(firsts > 0, ids[firsts - 1], 0), counts)
+    ids = ids.tolist()
+    return [ids[first:first+count] for (first, count) in zip(firsts.tolist(), counts.tolist())]
+
+def _IdxToAddresses(idx):
+    """
+    (position, address) of the non zero 5 bytes addresses in idx.
+    """
+    if idx == "\0" * len(idx):
+        return []
+    if numpy:
+        a = numpy.frombuffer(idx, dtype=numpy.uint8, count=len(idx) - len(idx) % 5).reshape(-1, 5)
+        pos = numpy.flatnonzero(a.any(axis=1))
+        adr = a[pos].astype(numpy.int64).dot(numpy.array([2**32, 2**24, 2**16, 2**8, 1], dtype=numpy.int64))
+        return zip(pos.tolist(), adr.tolist())
+    res = []
+    for i in xrange(len(idx) / 5):
+        adr = _Str5ToInt(idx[5*i:5*(i+1)])
+        if adr:
+            res.append((i, adr))
+    return res
+
+def _WayToStr(nds):
+    c = _EncodeWayNodes(nds)
+    return _EncodeVarint(len(c)) + c
+
+# relation.data record: size of the body (4 bytes), relation id (5 bytes, 0
+# once deleted), then the body:
+#   number of members (4 bytes), each one as type (1 byte), ref (5 bytes)
+#   and role (string)
+#   number of tags (2 bytes), each one as key and value (strings)
+#   number of other attributes (1 byte), each one as key (string), kind (1
+#   byte, "i" for integers, "u" for strings) and value (string)
+# strings are utf-8 encoded, after their length (2 bytes)
+_RelationHeadStruct = struct.Struct(">IBI")
+_MemberStruct       = struct.Struct(">cBI")
+_Int4Struct         = struct.Struct(">I")
+_Int2Struct         = struct.Struct(">H")
+_MemberTypeToStr1   = {u"node": "n", u"way": "w", u"relation": "r"}
+_Str1ToMemberType   = {"n": u"node", "w": u"way", "r": u"relation"}
+
+def _EncodeString(s):
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    else:
+        s = str(s)
+    return _Int2Struct.pack(len(s)) + s
+
+def _DecodeString(buf, pos):
+    (l,) = _Int2Struct.unpack_from(buf, pos)
+    pos += 2
+    return (buf[pos:pos+l].decode("utf-8"), pos+l)
+
+def _RelationToStr(data):
+    c = [_Int4Struct.pack(len(data[u"member"]))]
+    for m in data[u"member"]:
+        c.append(_MemberStruct.pack(_MemberTypeToStr1[m[u"type"]], m[u"ref"] >> 32, m[u"ref"] & _CstMax4))
+        c.append(_EncodeString(m[u"role"]))
+    c.append(_Int2Struct.pack(len(data[u"tag"])))
+    for (k, v) in data[u"tag"].iteritems():
+        c.append(_EncodeString(k))
+        c.append(_EncodeString(v))
+    attrs = [k for k in data if k not in (u"id", u"member", u"tag")]
+    c.append(_IntToStr1(len(attrs)))
+    for k in attrs:
+        v = data[k]
+        c.append(_EncodeString(k))
+        if isinstance(v, (int, long)):
+            c.append("i")
+        else:
+            c.append("u")
+        c.append(_EncodeString(v))
+    return "".join(c)
+
+def _StrToRelation(RelationId, buf, pos):
+    data = {u"id": RelationId, u"member": [], u"tag": {}}
+    (nb,) = _Int4Struct.unpack_from(buf, pos)
+    pos += 4
+    for i in xrange(nb):
+        (t, ref0, ref1) = _MemberStruct.unpack_from(buf, pos)
+        (role, pos) = _DecodeString(buf, pos + 6)
+        data[u"member"].append({u"type": _Str1ToMemberType[t], u"ref": (ref0 << 32) + ref1, u"role": role})
+    (nb,) = _Int2Struct.unpack_from(buf, pos)
+    pos += 2
+    for i in xrange(nb):
+        (k, pos) = _DecodeString(buf, pos)
+        (v, pos) = _DecodeString(buf, pos)
+        data[u"tag"][k] = v
+    nb = _Str1ToInt(buf[pos])
+    pos += 1
+    for i in xrange(nb):
+        (k, pos) = _DecodeString(buf, pos)
+        kind = buf[pos]
+        (v, pos) = _DecodeString(buf, pos + 1)
+        if kind == "i":
+            v = int(v)
+        data[k] = v
+    return data
+
+# Optional tag store, for nodes and ways, in folders created with
+# InitFolder(folder, tags=True). node.tag.idx and way.tag.idx give the
+# address of a tag.data record, 0 for objects without tags nor attributes.
+# A record is the size of its body (varint), then the body:
+#   number of tags (varint), each one as key and value (tag strings)
+#   number of other attributes (varint), each one as key (tag string), kind
+#   (1 byte) and value: "i" integer (zigzag varint), "d" string of digits
+#   (varint), "t" timestamp (varint of seconds since epoch), "u" other
+#   string (tag string)
+# A tag string is a varint, 2*i+1 for the string i of tag.dict, or 2*l for l
+# bytes of utf-8 following it. tag.dict holds keys and values seen more than
+# once, each one as its length (varint) and utf-8 bytes.
+_TagSkipKeys = frozenset((u"id", u"tag", u"nd", u"member", u"lat", u"lon"))
+_TagDictMax = 2**22
+_TimestampFormat = "%Y-%m-%dT%H:%M:%SZ"
+_TimestampRe = re.compile(r"^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z$")
+# ascii decimal, without leading zeros, to fit in a varint
+_DecimalRe = re.compile(r"(0|[1-9][0-9]{0,17})\Z")
+
+def _EncodeTagString(s, string_id, key):
+    i = string_id(s, key) if string_id else None
+    if i is not None:
+        return _EncodeVarint(2*i + 1)
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    else:
+        s = str(s)
+    return _EncodeVarint(2*len(s)) + s
+
+def _DecodeTagString(buf, pos, strings):
+    (n, pos) = _DecodeVarint(buf, pos)
+    if n & 1:
+        return (strings[n >> 1], pos)
+    return (buf[pos:pos+(n >> 1)].decode("utf-8"), pos + (n >> 1))
+
+def _TagsToStr(data, string_id = None):
+    """
+    Tag store body of data, "" when there is nothing to store. string_id(s,
+    key) gives the tag.dict index of s, or None to store s inline.
+    """
+    attrs = [k for k in data if k not in _TagSkipKeys]
+    if not data.get(u"tag") and not attrs:
+        return ""
+    c = [_EncodeVarint(len(data.get(u"tag") or ()))]
+    for (k, v) in (data.get(u"tag") or {}).iteritems():
+        c.append(_EncodeTagString(k, string_id, True))
+        c.append(_EncodeTagString(v, string_id, False))
+    c.append(_EncodeVarint(len(attrs)))
+    for k in attrs:
+        v = data[k]
+        c.append(_EncodeTagString(k, string_id, True))
+        if isinstance(v, (int, long)):
+            c.append("i" + _EncodeVarint((v << 1) ^ (v >> 63)))
+            continue
+        if not isinstance(v, basestring):
+            v = unicode(v)
+        m = _TimestampRe.match(v)
+        if m:
+            t = calendar.timegm([int(x) for x in m.groups()])
+            if t >= 0:
+                c.append("t" + _EncodeVarint(t))
+                continue
+        if _DecimalRe.match(v):
+            c.append("d" + _EncodeVarint(int(v)))
+        else:
+            c.append("u" + _EncodeTagString(v, string_id, False))
+    return "".join(c)
+
+def _StrToTags(buf, pos, strings = ()):
+    """
+    (tags, attributes) of a tag store body, decoded from pos.
+    """
+    tags = {}
+    attrs = {}
+    (nb, pos) = _DecodeVarint(buf, pos)
+    for i in xrange(nb):
+        (k, pos) = _DecodeTagString(buf, pos, strings)
+        (v, pos) = _DecodeTagString(buf, pos, strings)
+        tags[k] = v
+    (nb, pos) = _DecodeVarint(buf, pos)
+    for i in xrange(nb):
+        (k, pos) = _DecodeTagString(buf, pos, strings)
+        kind = buf[pos]
+        if kind == "u":
+            (v, pos) = _DecodeTagString(buf, pos + 1, strings)
+        else:
+            (v, pos) = _DecodeVarint(buf, pos + 1)
+            if kind == "i":
+                v = (v >> 1) ^ -(v & 1)
+            elif kind == "t":
+                v = unicode(time.strftime(_TimestampFormat, time.gmtime(v)))
+            else:
+                v = unicode(v)
+        attrs[k] = v
+    return (tags, attrs)
+
+# way.free, relation.free and tag.free: _FreeMagic, then address and size of each free
+# record (8 bytes each). Older folders have "address;size" text lines.
+_FreeMagic = "OSMFREE1"
+
+def _FreeToStr(free):
+    c = []
+    for size in free:
+        for ptr in free[size]:
+            c.append(ptr)
+            c.append(size)
+    return _FreeMagic + struct.pack(">%dq" % len(c), *c)
+
+def _StrToFree(data):
+    free = {}
+    if data.startswith(_FreeMagic):
+        c = struct.unpack(">%dq" % ((len(data) - len(_FreeMagic)) / 8), data[len(_FreeMagic):])
+        for i in xrange(0, len(c), 2):
+            free.setdefault(c[i+1], []).append(c[i])
+    else:
+        for line in data.splitlines():
+            line = line.strip().split(';')
+            free.setdefault(int(line[1]), []).append(int(line[0]))
+    return free
+
+# journal: _JournalMagic, then entries as _JournalEntryStruct (index of file in
+# _JournalFiles, offset, size) followed by the data to write, then an entry
+# with file _JournalEnd and the number of entries as offset. Files without
+# attribute, the free lists, are truncated after data.
+_JournalMagic = "OSMBINJ1"
+_JournalEntryStruct = struct.Struct(">BQI")
+_JournalFiles = (("node.crd", "_fNode_crd"), ("way.idx", "_fWay_idx"), ("way.data", "_fWay_data"),
+                 ("relation.idx", "_fRelation_idx"), ("relation.data", "_fRelation_data"),
+                 ("way.free", None), ("relation.free", None),
+                 ("node.tag.idx", "_fNode_tag_idx"), ("way.tag.idx", "_fWay_tag_idx"),
+                 ("tag.data", "_fTag_data"), ("tag.dict", "_fTag_dict"), ("tag.free", None))
+_JournalEnd = 255
+
+class _PagedFile:
+    """
+    File object keeping writes to f in memory, as ranges of written bytes,
+    until they are given by Runs(). Reads see the pending writes.
+    """
+
+    # ranges are indexed by page, and don't cross pages
+    page_size = 2**12
+
+    def __init__(self, f):
+        f.flush()
+        self._f = f
+        self._pages = {}
+        self._pos = 0
+        self._size = os.fstat(f.fileno()).st_size
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence = 0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self._size
+        self._pos = pos
+
+    def read(self, size = -1):
+        pos = self._pos
+        end = self._size if size < 0 else min(pos + size, self._size)
+        if pos >= end:
+            return ""
+        self._f.seek(pos)
+        data = self._f.read(end - pos)
+        data = bytearray(data + "\0" * (end - pos - len(data)))
+        for n in xrange(pos / self.page_size, (end - 1) / self.page_size + 1):
+            for (start, written) in self._pages.get(n, ()):
+                a = max(start, pos)
+                b = min(start + len(written), end)
+                if a < b:
+                    data[a-pos:b-pos] = written[a-start:b-start]
+        self._pos = end
+        return str(data)
+
+    def write(self, data):
+        pos = self._pos
+        i = 0
+        while i < len(data):
+            n = pos / self.page_size
+            l = min((n + 1)*self.page_size - pos, len(data) - i)
+            self._WritePage(n, pos, data[i:i+l])
+            pos += l
+            i += l
+        self._pos = pos
+        self._size = max(self._size, pos)
+
+    def _WritePage(self, n, pos, data):
+        # ranges of the page are sorted, and merged when they overlap or
+        # are adjacent
+        end = pos + len(data)
+        ranges = self._pages.setdefault(n, [])
+        i = 0
+        while i < len(ranges) and ranges[i][0] + len(ranges[i][1]) < pos:
+            i += 1
+        j = i
+        while j < len(ranges) and ranges[j][0] <= end:
+            j += 1
+        if i == j:
+            ranges.insert(i, (pos, bytearray(data)))
+            return
+        start = min(pos, ranges[i][0])
+        merged = bytearray(max(end, ranges[j-1][0] + len(ranges[j-1][1])) - start)
+        for (s, written) in ranges[i:j]:
+            merged[s-start:s-start+len(written)] = written
+        merged[pos-start:end-start] = data
+        ranges[i:j] = [(start, merged)]
+
+    def Runs(self):
+        """
+        (offset, data) of written consecutive bytes, by offset.
+        """
+        runs = []
+        for n in sorted(self._pages):
+            for (start, written) in self._pages[n]:
+                if runs and runs[-1][0] + len(runs[-1][1]) == start:
+                    runs[-1][1].extend(written)
+                else:
+                    runs.append((start, bytearray(written)))
+        return [(offset, str(data)) for (offset, data) in runs]
+
 ###########################################################################
 ## InitFolder
 
-def InitFolder(folder):
+def InitFolder(folder, tags = False):
 
     nb_node_max = 2**4
     nb_way_max  = 2**4
@@ -163,29 +651,282 @@ def InitFolder(folder):
         
     # reset way.data
     print("Creating way.data")
-    open(os.path.join(folder, "way.data"), "wb").write("--") # for no data at location 0
+    open(os.path.join(folder, "way.data"), "wb").write(_WayDataV2)
     
     # reset way.free
     print("Creating way.free")
     open(os.path.join(folder, "way.free"), "wb")
 
+    _InitRelationFiles(folder)
+
+    if tags:
+        _InitTagFiles(folder)
+
+def _InitRelationFiles(folder):
+
+    # create relation.idx
+    print("Creating relation.idx")
+    open(os.path.join(folder, "relation.idx"), "wb")
+
+    # reset relation.data
+    print("Creating relation.data")
+    open(os.path.join(folder, "relation.data"), "wb").write("--") # for no data at location 0
+
+    # reset relation.free
+    print("Creating relation.free")
+    open(os.path.join(folder, "relation.free"), "wb")
+
+def _InitTagFiles(folder):
+
+    # create node.tag.idx and way.tag.idx
+    print("Creating node.tag.idx and way.tag.idx")
+    open(os.path.join(folder, "node.tag.idx"), "wb")
+    open(os.path.join(folder, "way.tag.idx"), "wb")
+
+    # reset tag.data
+    print("Creating tag.data")
+    open(os.path.join(folder, "tag.data"), "wb").write("--") # for no data at location 0
+
+    # reset tag.dict and tag.free
+    print("Creating tag.dict and tag.free")
+    open(os.path.join(folder, "tag.dict"), "wb")
+    open(os.path.join(folder, "tag.free"), "wb")
+
+###########################################################################
+## ConvertWays
+
+def ConvertWays(folder):
+    """
+    Convert way.idx and way.data from _WayDataV1 to _WayDataV2. Ways are
+    written in id order, and way.free is emptied.
+    """
+    lock = lockfile.FileLock(os.path.join(folder, "lock"))
+    lock.acquire(timeout=0)
+    try:
+        fWay_idx  = open(os.path.join(folder, "way.idx"), "rb")
+        fWay_data = open(os.path.join(folder, "way.data"), "rb")
+        if fWay_data.read(2) != _WayDataV1:
+            print("way.data is not in the old format")
+            return
+        fNew_idx  = open(os.path.join(folder, "way.idx.new"), "wb")
+        fNew_data = open(os.path.join(folder, "way.data.new"), "wb")
+        fNew_data.write(_WayDataV2)
+        size = len(_WayDataV2)
+        nb = 0
+        while True:
+            idx = fWay_idx.read(5*2**20)
+            if not idx:
+                break
+            c_idx = bytearray(len(idx))
+            c_data = []
+            for (i, AdrWay) in _IdxToAddresses(idx):
+                fWay_data.seek(AdrWay)
+                nbn  = _Str2ToInt(fWay_data.read(2))
+                data = fWay_data.read(5*nbn)
+                c = _WayToStr([_Str5ToInt(data[5*j:5*(j+1)]) for j in xrange(nbn)])
+                c_idx[5*i:5*(i+1)] = _IntToStr5(size)
+                c_data.append(c)
+                size += len(c)
+                nb += 1
+            fNew_idx.write(c_idx)
+            fNew_data.write("".join(c_data))
+        fNew_idx.close()
+        fNew_data.close()
+        fWay_idx.close()
+        fWay_data.close()
+        os.rename(os.path.join(folder, "way.idx.new"), os.path.join(folder, "way.idx"))
+        os.rename(os.path.join(folder, "way.data.new"), os.path.join(folder, "way.data"))
+        open(os.path.join(folder, "way.free"), "wb")
+        print("Converted %d ways, way.data is now %d bytes" % (nb, size))
+    finally:
+        lock.release()
+
+def _FinishCompactWays(folder):
+    # last step of OsmBin.CompactWays(), once way.idx.new and way.data.new
+    # are complete, also done on next opening for writing if interrupted
+    for name in ("way.idx", "way.data"):
+        if os.path.exists(os.path.join(folder, name + ".new")):
+            os.rename(os.path.join(folder, name + ".new"), os.path.join(folder, name))
+    open(os.path.join(folder, "way.free"), "wb")
+    os.remove(os.path.join(folder, "way.compact"))
+
+###########################################################################
+## MigrateRelations
+
+def MigrateRelations(folder):
+    """
+    Move the relations stored one file per relation under folder/relation/ to
+    relation.idx and relation.data.
+    """
+    reldir = os.path.join(folder, "relation")
+    if not os.path.exists(os.path.join(folder, "relation.idx")):
+        _InitRelationFiles(folder)
+
+    o = OsmBin(folder, "w")
+    nb = 0
+    for i in sorted(os.listdir(reldir)):
+        for j in sorted(os.listdir(os.path.join(reldir, i))):
+            for k in sorted(os.listdir(os.path.join(reldir, i, j))):
+                o.RelationCreate(eval(open(os.path.join(reldir, i, j, k)).read()))
+                nb += 1
+    del o
+    print("Migrated %d relations, %s can now be removed" % (nb, reldir))
+
+###########################################################################
+## _OsmBinBase
+
+class _OsmBinBase:
+    # reader functions on top of NodeGet, NodeGetMany, WayGet and RelationGet
+
+    def RelationFullRecur(self, RelationId, WayNodes = True, RaiseOnLoop = True, RemoveSubarea = False, RecurControl = [], Memo = None):
+        """
+        RelationId and its members, depth first, as {"type": type, "data":
+        object}: nodes, ways followed by their nodes when WayNodes, and
+        relations followed by their own members. Relations members of
+        themselves or of a member relation raise RelationLoopError, or are
+        skipped when not RaiseOnLoop. Members of RelationId with role subarea
+        or region are skipped when RemoveSubarea.
+        Ways and nodes are read in batches, once the relations are walked.
+        Memo is a dict keeping walked member relations between calls, as long
+        as relations are not modified.
+        """
+        plan = self._RelationPlan(RelationId, RaiseOnLoop, RemoveSubarea, list(RecurControl), {} if Memo is None else Memo)
+        WayIds = list(set(ref for (t, ref) in plan if t == "way"))
+        ways = dict(zip(WayIds, self.WayGetMany(WayIds)))
+        NodeIds = set(ref for (t, ref) in plan if t == "node")
+        if WayNodes:
+            for way in ways.itervalues():
+                if way:
+                    NodeIds.update(way["nd"])
+        NodeIds = list(NodeIds)
+        nodes = dict(zip(NodeIds, self.NodeGetMany(NodeIds)))
+
+        dta = []
+        for (t, ref) in plan:
+            if t == "relation":
+                dta.append({"type": "relation", "data": ref})
+            elif t == "node":
+                dta.append({"type": "node", "data": nodes[ref]})
+            elif t == "way":
+                way = ways[ref]
+                if not way:
+                    raise MissingDataError("missing way %d"%ref)
+                dta.append({"type": "way", "data": way})
+                if WayNodes:
+                    for NodeId in way["nd"]:
+                        dta.append({"type": "node", "data": nodes[NodeId]})
+            else:
+                raise ref
+        return dta
+
+    def _RelationPlan(self, RelationId, RaiseOnLoop, RemoveSubarea, path, memo):
+        # entries of RelationFullRecur(), depth first, as ("relation", data),
+        # ("node", ref), ("way", ref), and last ("error", exception) when
+        # walking stopped on an error. Walked member relations are kept in
+        # memo, unless a loop was skipped under them, as it depends on the
+        # path.
+        plan = []
+        stack = [] # relation, index of next member, start in plan, can be kept
+        on_path = set(path)
+        RelId = RelationId
+        while RelId is not None:
+            if (stack or not RemoveSubarea) and (RelId, RaiseOnLoop) in memo:
+                plan.extend(memo[(RelId, RaiseOnLoop)])
+            else:
+                rel = self.RelationGet(RelId)
+                if rel is None:
+                    plan.append(("error", MissingDataError("missing relation %d"%RelId)))
+                    return plan
+                plan.append(("relation", rel))
+                path.append(RelId)
+                on_path.add(RelId)
+                stack.append([rel, 0, len(plan), True])
+
+            RelId = None
+            while stack and RelId is None:
+                frame = stack[-1]
+                rel = frame[0]
+                if frame[1] == len(rel["member"]):
+                    stack.pop()
+                    path.pop()
+                    on_path.discard(rel["id"])
+                    if stack and frame[3]:
+                        memo[(rel["id"], RaiseOnLoop)] = plan[frame[2]-1:]
+                    elif stack:
+                        stack[-1][3] = False
+                    continue
+                m = rel["member"][frame[1]]
+                frame[1] += 1
+                if m["type"] in ("node", "way"):
+                    plan.append((m["type"], m["ref"]))
+                elif m["type"] == "relation":
+                    if m["ref"] == rel["id"]:
+                        if not RaiseOnLoop:
+                            continue
+                        plan.append(("error", RelationLoopError('self member '+str(rel["id"]))))
+                        return plan
+                    if m["ref"] in on_path:
+                        if not RaiseOnLoop:
+                            frame[3] = False
+                            continue
+                        plan.append(("error", RelationLoopError('member loop '+str(path+[m["ref"]]))))
+                        return plan
+                    if RemoveSubarea and len(stack) == 1 and m["role"] in [u"subarea", u"region"]:
+                        continue
+                    RelId = m["ref"]
+        return plan
+
+    def WayGetMany(self, WayIds):
+        return [self.WayGet(WayId) for WayId in WayIds]
+
+    #######################################################################
+    ## user functions
+
+    def UserGet(self, UserId):
+        return None
+
 ###########################################################################
 ## OsmBinWriter
 
-class OsmBin:
+class OsmBin(_OsmBinBase):
 
     def __init__(self, folder, mode = "r"):
         self._mode           = mode
         self._folder         = folder
-        self._reldir         = os.path.join(folder, "relation")
+        if self._mode=="w":
+            lock = lockfile.FileLock(os.path.join(folder, "lock"))
+            lock.acquire(timeout=0)
+            self._lock = lock
+            if os.path.exists(os.path.join(folder, "way.compact")):
+                _FinishCompactWays(folder)
         self._fNode_crd      = open(os.path.join(folder, "node.crd"), {"w":"rb+", "r":"r"}[mode])
         self._fWay_idx       = open(os.path.join(folder, "way.idx") , {"w":"rb+", "r":"r"}[mode])
         self._fWay_data      = open(os.path.join(folder, "way.data"), {"w":"rb+", "r":"r"}[mode])
         self._fWay_data_size = os.stat(os.path.join(folder, "way.data")).st_size
+        if self._fWay_data.read(2) != _WayDataV2:
+            raise IOError("%s: way.data in old format, convert it with OsmBin.py --convert-ways" % folder)
+        self._fRelation_idx  = open(os.path.join(folder, "relation.idx") , {"w":"rb+", "r":"r"}[mode])
+        self._fRelation_data = open(os.path.join(folder, "relation.data"), {"w":"rb+", "r":"r"}[mode])
+        self._fRelation_data_size = os.stat(os.path.join(folder, "relation.data")).st_size
+        self._tags           = os.path.exists(os.path.join(folder, "tag.dict"))
+        self._fNode_tag_idx  = None
+        self._fWay_tag_idx   = None
+        self._fTag_data      = None
+        self._fTag_dict      = None
+        if self._tags:
+            self._fNode_tag_idx = open(os.path.join(folder, "node.tag.idx"), {"w":"rb+", "r":"r"}[mode])
+            self._fWay_tag_idx  = open(os.path.join(folder, "way.tag.idx") , {"w":"rb+", "r":"r"}[mode])
+            self._fTag_data     = open(os.path.join(folder, "tag.data")    , {"w":"rb+", "r":"r"}[mode])
+            self._fTag_data_size = os.stat(os.path.join(folder, "tag.data")).st_size
+            self._fTag_dict     = open(os.path.join(folder, "tag.dict")    , {"w":"rb+", "r":"r"}[mode])
+            self._ReadTagDict()
+        self._node_crd       = None # memory map of node.crd
+        self._node_crd_array = None # same, as numpy array
+        self._node_crd_dirty = False
         if self._mode=="w":
-            lock_file = os.path.join(folder, "lock")
-            self._lock = lockfile.FileLock(lock_file)
-            self._lock.acquire(timeout=0)
+            entries = self._ReadJournal()
+            if entries:
+                self._ApplyJournal(entries)
             self._ReadFree()
 
         self.node_id_size = 5
@@ -195,35 +936,188 @@ class OsmBin:
             self._fNode_crd.close()
             self._fWay_idx.close()
             self._fWay_data.close()
+            self._fRelation_idx.close()
+            self._fRelation_data.close()
+            if self._tags:
+                self._fNode_tag_idx.close()
+                self._fWay_tag_idx.close()
+                self._fTag_data.close()
+                self._fTag_dict.close()
         except AttributeError:
             pass
-        if self._mode=="w":
+        if self._mode=="w" and hasattr(self, "_lock"):
             self._WriteFree()
             self._lock.release()
         
     def _ReadFree(self):
-        self._free = {}
-        for nbn in range(2001):
-            self._free[nbn] = []            
-        f = open(os.path.join(self._folder, "way.free"))
-        while True:
-            line = f.readline()
-            if not line:
-                break
-            line = line.strip().split(';')
-            self._free[int(line[1])].append(int(line[0]))
+        # way free space, by size of record
+        self._free = _StrToFree(open(os.path.join(self._folder, "way.free"), "rb").read())
+        # relation free space, by size of record body
+        self._relation_free = _StrToFree(open(os.path.join(self._folder, "relation.free"), "rb").read())
+        # tag.data free space, by size of record
+        if self._tags:
+            self._tag_free = _StrToFree(open(os.path.join(self._folder, "tag.free"), "rb").read())
 
     def _WriteFree(self):
         try:
             self._free
         except AttributeError:
             return
-        f = open(os.path.join(self._folder, "way.free"), 'w')
-        for nbn in self._free:
-            for ptr in self._free[nbn]:
-                f.write("%d;%d\n"%(ptr, nbn))
+        open(os.path.join(self._folder, "way.free"), "wb").write(_FreeToStr(self._free))
+        open(os.path.join(self._folder, "relation.free"), "wb").write(_FreeToStr(self._relation_free))
+        if self._tags:
+            open(os.path.join(self._folder, "tag.free"), "wb").write(_FreeToStr(self._tag_free))
+
+    #######################################################################
+    ## journal functions
+
+    def _WriteJournal(self, entries):
+        f = open(os.path.join(self._folder, "journal"), "wb")
+        f.write(_JournalMagic)
+        for (i, offset, data) in entries:
+            f.write(_JournalEntryStruct.pack(i, offset, len(data)))
+            f.write(data)
+        f.write(_JournalEntryStruct.pack(_JournalEnd, len(entries), 0))
+        f.flush()
+        os.fsync(f.fileno())
         f.close()
-        
+
+    def _ReadJournal(self):
+        # entries of a complete journal, None if there is none
+        try:
+            f = open(os.path.join(self._folder, "journal"), "rb")
+        except IOError:
+            return None
+        if f.read(len(_JournalMagic)) != _JournalMagic:
+            return None
+        entries = []
+        while True:
+            head = f.read(_JournalEntryStruct.size)
+            if len(head) < _JournalEntryStruct.size:
+                return None
+            (i, offset, size) = _JournalEntryStruct.unpack(head)
+            if i == _JournalEnd:
+                return entries if offset == len(entries) else None
+            data = f.read(size)
+            if len(data) < size:
+                return None
+            entries.append((i, offset, data))
+
+    def _ApplyJournal(self, entries):
+        # writes are done file by file, by offset
+        for (i, offset, data) in sorted(entries, key=lambda e: e[0:2]):
+            (name, attr) = _JournalFiles[i]
+            if attr:
+                f = getattr(self, attr)
+                f.seek(offset)
+                f.write(data)
+            else:
+                f = open(os.path.join(self._folder, name), "rb+")
+                f.seek(offset)
+                f.write(data)
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+        for (name, attr) in _JournalFiles:
+            if attr and getattr(self, attr):
+                getattr(self, attr).flush()
+                os.fsync(getattr(self, attr).fileno())
+        os.remove(os.path.join(self._folder, "journal"))
+        self._ReadSizes()
+        self._node_crd_dirty = True
+
+    def _ReadSizes(self):
+        self._fWay_data_size = os.fstat(self._fWay_data.fileno()).st_size
+        self._fRelation_data_size = os.fstat(self._fRelation_data.fileno()).st_size
+        if self._tags:
+            self._fTag_data_size = os.fstat(self._fTag_data.fileno()).st_size
+
+    #######################################################################
+    ## tag functions
+
+    def _ReadTagDict(self):
+        # strings of tag.dict, and their index. A string being appended by
+        # a writer is left for a next call.
+        self._fTag_dict.seek(0)
+        data = self._fTag_dict.read()
+        self._tag_strings = []
+        pos = 0
+        while pos < len(data):
+            try:
+                (l, start) = _DecodeVarint(data, pos)
+            except IndexError:
+                break
+            if start + l > len(data):
+                break
+            self._tag_strings.append(data[start:start+l].decode("utf-8"))
+            pos = start + l
+        self._tag_string_ids = dict((s, i) for (i, s) in enumerate(self._tag_strings))
+        self._tag_seen = set()
+
+    def _TagStringId(self, s, key):
+        # index of s in tag.dict, keys are added at once and values when seen
+        # again
+        i = self._tag_string_ids.get(s)
+        if i is not None or len(self._tag_strings) >= _TagDictMax:
+            return i
+        if not key and s not in self._tag_seen:
+            if len(self._tag_seen) >= _TagDictMax:
+                self._tag_seen.clear()
+            self._tag_seen.add(s)
+            return None
+        c = s.encode("utf-8") if isinstance(s, unicode) else str(s)
+        self._fTag_dict.seek(0, 2)
+        self._fTag_dict.write(_EncodeVarint(len(c)) + c)
+        i = len(self._tag_strings)
+        self._tag_strings.append(s)
+        self._tag_string_ids[s] = i
+        return i
+
+    def _TagGet(self, fIdx, Id, data):
+        # add tags and attributes of Id to data
+        record = self._Record(fIdx, self._fTag_data, Id)
+        if record is None:
+            return data
+        (size, pos) = _DecodeVarint(record, 0)
+        try:
+            (tags, attrs) = _StrToTags(record, pos, self._tag_strings)
+        except IndexError:
+            # strings added to tag.dict by a writer since opening
+            self._ReadTagDict()
+            (tags, attrs) = _StrToTags(record, pos, self._tag_strings)
+        data.update(attrs)
+        data["tag"] = tags
+        return data
+
+    def _TagCreate(self, fIdx, data):
+        self._TagDelete(fIdx, data)
+        c = _TagsToStr(data, self._TagStringId)
+        if not c:
+            return
+        c = _EncodeVarint(len(c)) + c
+        size = len(c)
+        if self._tag_free.get(size):
+            Adr = self._tag_free[size].pop()
+        else:
+            Adr = self._fTag_data_size
+            self._fTag_data_size += size
+        fIdx.seek(5*data[u"id"])
+        fIdx.write(_IntToStr5(Adr))
+        self._fTag_data.seek(Adr)
+        self._fTag_data.write(c)
+
+    def _TagDelete(self, fIdx, data):
+        fIdx.seek(5*data[u"id"])
+        Adr = _Str5ToInt(fIdx.read(5))
+        if not Adr:
+            return
+        self._fTag_data.seek(Adr)
+        (size, pos) = _DecodeVarint(self._fTag_data.read(10), 0)
+        self._tag_free.setdefault(pos + size, []).append(Adr)
+        fIdx.seek(5*data[u"id"])
+        fIdx.write(_IntToStr5(0))
+
     def begin(self):
         pass
 
@@ -233,24 +1127,65 @@ class OsmBin:
     #######################################################################
     ## node functions
         
+    def _MapNodeCrd(self, NodeId):
+        # node.crd is mapped again when NodeId is after the end of the map
+        # and the file grew since
+        if self._node_crd_dirty:
+            self._fNode_crd.flush()
+            self._node_crd_dirty = False
+        if self._node_crd is None or 8*NodeId >= len(self._node_crd):
+            size = os.fstat(self._fNode_crd.fileno()).st_size
+            size -= size % 8
+            if size and (self._node_crd is None or size > len(self._node_crd)):
+                self._node_crd = mmap.mmap(self._fNode_crd.fileno(), size, access=mmap.ACCESS_READ)
+                if numpy:
+                    self._node_crd_array = numpy.frombuffer(self._node_crd, dtype=_NodeDtype)
+        return self._node_crd
+
     def NodeGet(self, NodeId):
-        data = {}
-        data["id"] = NodeId
-        self._fNode_crd.seek(8*data[u"id"])
-        read = self._fNode_crd.read(8)
-        if len(read) != 8:
+        crd = self._MapNodeCrd(NodeId)
+        if crd is None or NodeId < 0 or 8*NodeId >= len(crd):
             return None
-        data["lat"] = _Str4ToCoord(read[:4])
-        data["lon"] = _Str4ToCoord(read[4:])
-        data["tag"] = {}
+        (lat, lon) = _NodeStruct.unpack_from(crd, 8*NodeId)
+        data = {"id": NodeId, "lat": _IntToCoord(lat), "lon": _IntToCoord(lon), "tag": {}}
+        if self._tags:
+            self._TagGet(self._fNode_tag_idx, NodeId, data)
         return data
-        
+
+    def NodeGetMany(self, NodeIds):
+        """
+        Nodes of NodeIds, in the same order, as NodeGet() would return them,
+        read in one gather on node.crd when numpy is available.
+        """
+        if len(NodeIds) == 0:
+            return []
+        if not numpy:
+            return [self.NodeGet(NodeId) for NodeId in NodeIds]
+        if self._MapNodeCrd(max(NodeIds)) is None:
+            return [None] * len(NodeIds)
+
+        ids = numpy.asarray(NodeIds, dtype=numpy.int64)
+        inside = (ids >= 0) & (ids < len(self._node_crd_array))
+        crd = self._node_crd_array[numpy.where(inside, ids, 0)]
+        lat = ((crd["lat"].astype(numpy.int64) - 1800000000) / 1e7).tolist()
+        lon = ((crd["lon"].astype(numpy.int64) - 1800000000) / 1e7).tolist()
+        res = [{"id": NodeId, "lat": la, "lon": lo, "tag": {}} if ok else None
+               for (NodeId, la, lo, ok) in zip(NodeIds, lat, lon, inside.tolist())]
+        if self._tags:
+            for data in res:
+                if data:
+                    self._TagGet(self._fNode_tag_idx, data["id"], data)
+        return res
+
     def NodeCreate(self, data):
         LatStr4 = _CoordToStr4(data[u"lat"])
         LonStr4 = _CoordToStr4(data[u"lon"])
         self._fNode_crd.seek(8*data[u"id"])
         self._fNode_crd.write(LatStr4+LonStr4)
-        
+        self._node_crd_dirty = True
+        if self._tags:
+            self._TagCreate(self._fNode_tag_idx, data)
+
     NodeUpdate = NodeCreate
 
     def NodeDelete(self, data):
@@ -258,45 +1193,64 @@ class OsmBin:
         LonStr4 = _IntToStr4(0)
         self._fNode_crd.seek(8*data[u"id"])
         self._fNode_crd.write(LatStr4+LonStr4)
+        self._node_crd_dirty = True
+        if self._tags:
+            self._TagDelete(self._fNode_tag_idx, data)
 
     #######################################################################
     ## way functions
-    
+
+    def _Record(self, fIdx, fData, Id):
+        # record of Id, as size of the body (varint) then the body
+        fIdx.seek(5*Id)
+        Adr = _Str5ToInt(fIdx.read(5))
+        if not Adr:
+            return None
+        fData.seek(Adr)
+        data = fData.read(_WayReadSize)
+        (size, pos) = _DecodeVarint(data, 0)
+        if pos + size > len(data):
+            data += fData.read(pos + size - len(data))
+        return data[:pos + size]
+
+    def _WayRecord(self, WayId):
+        # way record, as _WayToStr()
+        return self._Record(self._fWay_idx, self._fWay_data, WayId)
+
     def WayGet(self, WayId):
-        self._fWay_idx.seek(5*WayId)
-        AdrWay = _Str5ToInt(self._fWay_idx.read(5))
-        if not AdrWay:
+        data = self._WayRecord(WayId)
+        if data is None:
             return None
-        self._fWay_data.seek(AdrWay)
-        nbn  = _Str2ToInt(self._fWay_data.read(2))
-        data = self._fWay_data.read(self.node_id_size*nbn)
-        nds = []
-        for i in range(nbn):
-            nds.append(_Str5ToInt(data[self.node_id_size*i:self.node_id_size*(i+1)]))
-        return {"id": WayId, "nd": nds, "tag":{}}
+        (size, pos) = _DecodeVarint(data, 0)
+        data = {"id": WayId, "nd": _DecodeWayNodes(data, pos, pos + size), "tag":{}}
+        if self._tags:
+            self._TagGet(self._fWay_tag_idx, WayId, data)
+        return data
     
     def WayCreate(self, data):
         self.WayDelete(data)
         # Search space big enough to store node list
-        nbn = len(data["nd"])
-        if self._free[nbn]:
-            AdrWay = self._free[nbn].pop()
+        c = _WayToStr(data[u"nd"])
+        size = len(c)
+        if self._free.get(size):
+            AdrWay = self._free[size].pop()
         else:
             AdrWay = self._fWay_data_size
-            self._fWay_data_size += 2 + self.node_id_size*nbn
+            self._fWay_data_size += size
         # File way.idx
         self._fWay_idx.seek(5*data[u"id"])
         self._fWay_idx.write(_IntToStr5(AdrWay))
         # File way.dat
         self._fWay_data.seek(AdrWay)
-        c = _IntToStr2(len(data[u"nd"]))
-        for NodeId in data[u"nd"]:
-            c += _IntToStr5(NodeId)
         self._fWay_data.write(c)
+        if self._tags:
+            self._TagCreate(self._fWay_tag_idx, data)
 
     WayUpdate = WayCreate
     
     def WayDelete(self, data):
+        if self._tags:
+            self._TagDelete(self._fWay_tag_idx, data)
         # Seek to position in file containing address to node list
         self._fWay_idx.seek(5*data[u"id"])
         AdrWay = _Str5ToInt(self._fWay_idx.read(5))
@@ -304,12 +1258,8 @@ class OsmBin:
             return
         # Free space
         self._fWay_data.seek(AdrWay)
-        nbn = _Str2ToInt(self._fWay_data.read(2))
-        try:
-            self._free[nbn].append(AdrWay)
-        except KeyError:
-            print("Cannot access free[%d] for way id=%d, idx=%d" % (nbn, data[u"id"], AdrWay))
-            raise
+        (size, pos) = _DecodeVarint(self._fWay_data.read(10), 0)
+        self._free.setdefault(pos + size, []).append(AdrWay)
         # Save deletion
         self._fWay_idx.seek(5*data[u"id"])
         self._fWay_idx.write(_IntToStr5(0))
@@ -317,118 +1267,589 @@ class OsmBin:
     #######################################################################
     ## relation functions
 
+    def _RelationRecord(self, RelationId):
+        # relation record body, as _RelationToStr()
+        self._fRelation_idx.seek(5*RelationId)
+        AdrRel = _Str5ToInt(self._fRelation_idx.read(5))
+        if not AdrRel:
+            return None
+        self._fRelation_data.seek(AdrRel)
+        (size, id0, id1) = _RelationHeadStruct.unpack(self._fRelation_data.read(_RelationHeadStruct.size))
+        return self._fRelation_data.read(size)
+
     def RelationGet(self, RelationId):
-        RelationId = "%09d"%RelationId
-        RelFolder  = self._reldir + "/" + RelationId[0:3] + "/" + RelationId[3:6] + "/"
-        RelFile    = RelationId[6:9]
-        if os.path.exists(RelFolder + RelFile):
-            return eval(open(RelFolder + RelFile).read())
-        else:
+        data = self._RelationRecord(RelationId)
+        if data is None:
             return None
-    
-    def RelationCreate(self, data):
-        RelationId = "%09d"%data["id"]
-        RelFolder  = self._reldir + "/" + RelationId[0:3] + "/" + RelationId[3:6] + "/"
-        RelFile    = RelationId[6:9]
-        if not os.path.exists(RelFolder):
-            os.makedirs(RelFolder)
-        open(RelFolder + RelFile, "w").write(repr(data))
-    
-    RelationUpdate = RelationCreate
-    
-    def RelationDelete(self, data):
-        RelationId = "%09d"%data["id"]
-        RelFolder  = self._reldir + "/" + RelationId[0:3] + "/" + RelationId[3:6] + "/"
-        RelFile    = RelationId[6:9]
-        try:
-            os.remove(RelFolder + RelFile)
-        except:
-            pass
+        return _StrToRelation(RelationId, data, 0)
 
-    def RelationFullRecur(self, RelationId, WayNodes = True, RaiseOnLoop = True, RemoveSubarea = False, RecurControl = []):
-        rel = self.RelationGet(RelationId)
-        dta = [{"type": "relation", "data": rel}]
-        for m in rel["member"]:
-            if m["type"] == "node":
-                dta.append({"type": "node", "data": self.NodeGet(m["ref"])})
-            elif m["type"] == "way":
-                way = self.WayGet(m["ref"])
-                if not way:
-                    raise MissingDataError("missing way %d"%m["ref"])
-                dta.append({"type": "way", "data": way})
-                if WayNodes:
-                    for n in way["nd"]:
-                        dta.append({"type": "node", "data": self.NodeGet(n)})
-            elif m["type"] == "relation":
-                if m["ref"] == RelationId:
-                    if not RaiseOnLoop:
-                        continue
-                    raise RelationLoopError('self member '+str(RelationId))
-                if m["ref"] in RecurControl:
-                    if not RaiseOnLoop:
-                        continue
-                    raise RelationLoopError('member loop '+str(RecurControl+[RelationId, m["ref"]]))
-                if RemoveSubarea and m["role"] in [u"subarea", u"region"]:
-                    continue
-                dta += self.RelationFullRecur(m["ref"], WayNodes = WayNodes, RaiseOnLoop = RaiseOnLoop, RecurControl = RecurControl+[RelationId])
-        return dta
+    def RelationCreate(self, data):
+        self.RelationDelete(data)
+        # Search space big enough to store relation
+        c = _RelationToStr(data)
+        size = len(c)
+        if self._relation_free.get(size):
+            AdrRel = self._relation_free[size].pop()
+        else:
+            AdrRel = self._fRelation_data_size
+            self._fRelation_data_size += _RelationHeadStruct.size + size
+        # File relation.idx
+        self._fRelation_idx.seek(5*data[u"id"])
+        self._fRelation_idx.write(_IntToStr5(AdrRel))
+        # File relation.data
+        self._fRelation_data.seek(AdrRel)
+        self._fRelation_data.write(_RelationHeadStruct.pack(size, data[u"id"] >> 32, data[u"id"] & _CstMax4) + c)
 
-    #######################################################################
-    ## user functions
+    RelationUpdate = RelationCreate
 
-    def UserGet(self, UserId):
-        return None
+    def RelationDelete(self, data):
+        # Seek to position in file containing address to relation
+        self._fRelation_idx.seek(5*data[u"id"])
+        AdrRel = _Str5ToInt(self._fRelation_idx.read(5))
+        if not AdrRel:
+            return
+        # Free space, and mark record as deleted for CopyRelationTo()
+        self._fRelation_data.seek(AdrRel)
+        (size, id0, id1) = _RelationHeadStruct.unpack(self._fRelation_data.read(_RelationHeadStruct.size))
+        self._relation_free.setdefault(size, []).append(AdrRel)
+        self._fRelation_data.seek(AdrRel)
+        self._fRelation_data.write(_RelationHeadStruct.pack(size, 0, 0))
+        # Save deletion
+        self._fRelation_idx.seek(5*data[u"id"])
+        self._fRelation_idx.write(_IntToStr5(0))
 
     #######################################################################
 
     def CopyWayTo(self, output):
-        self._fWay_idx.seek(0,2)
-        way_idx_size = self._fWay_idx.tell()
-        for i in xrange(way_idx_size / 5):
-            way = self.WayGet(i)
-            if way:
-                output.WayCreate(way)
-    
+        # ways are decoded by batches of consecutive ids
+        self._fWay_idx.flush()
+        self._fWay_data.flush()
+        data = mmap.mmap(self._fWay_data.fileno(), self._fWay_data_size, access=mmap.ACCESS_READ)
+        try:
+            WayId = 0
+            while True:
+                self._fWay_idx.seek(5*WayId)
+                idx = self._fWay_idx.read(5*2**20)
+                if len(idx) < 5:
+                    break
+                ways = []
+                spans = []
+                for (i, AdrWay) in _IdxToAddresses(idx):
+                    (size, pos) = _DecodeVarint(data, AdrWay)
+                    ways.append(WayId + i)
+                    spans.append((pos, pos + size))
+                for (i, nds) in zip(ways, _DecodeWayNodesMany(data, spans)):
+                    way = {"id": i, "nd": nds, "tag": {}}
+                    if self._tags:
+                        self._TagGet(self._fWay_tag_idx, i, way)
+                    output.WayCreate(way)
+                WayId += len(idx) / 5
+        finally:
+            data.close()
+
     def CopyRelationTo(self, output):
-        for i in os.listdir(self._reldir):
-            for j in os.listdir(self._reldir+"/"+i):
-                for k in os.listdir(self._reldir+"/"+i+"/"+j):
-                    output.RelationCreate(eval(open(self._reldir+"/"+i+"/"+j+"/"+k).read()))
+        # relation.data is read sequentially, skipping deleted records
+        self._fRelation_data.flush()
+        size_max = self._fRelation_data_size
+        data = mmap.mmap(self._fRelation_data.fileno(), size_max, access=mmap.ACCESS_READ)
+        try:
+            pos = 2
+            while pos < size_max:
+                (size, id0, id1) = _RelationHeadStruct.unpack_from(data, pos)
+                pos += _RelationHeadStruct.size
+                RelationId = (id0 << 32) + id1
+                if RelationId:
+                    output.RelationCreate(_StrToRelation(RelationId, data, pos))
+                pos += size
+        finally:
+            data.close()
+
+    def CompactWays(self):
+        """
+        Rewrite way.data with the ways in id order and no free space, and
+        way.idx for it. Return fragmentation statistics of way.data before
+        compaction: number of ways, bytes of file, of ways, of free records
+        in way.free, of space lost out of it, and number of free records.
+        """
+        self._fWay_idx.flush()
+        self._fWay_data.flush()
+        fNew_idx  = open(os.path.join(self._folder, "way.idx.new"), "wb")
+        fNew_data = open(os.path.join(self._folder, "way.data.new"), "wb")
+        fNew_data.write(_WayDataV2)
+        size = len(_WayDataV2)
+        nb = 0
+        data = mmap.mmap(self._fWay_data.fileno(), self._fWay_data_size, access=mmap.ACCESS_READ)
+        try:
+            # chunks of way.idx without any way are left as holes
+            self._fWay_idx.seek(0)
+            pos_idx = 0
+            while True:
+                idx = self._fWay_idx.read(5*2**20)
+                if not idx:
+                    break
+                addresses = _IdxToAddresses(idx)
+                if addresses:
+                    c_idx = bytearray(len(idx))
+                    c_data = []
+                    for (i, AdrWay) in addresses:
+                        (l, pos) = _DecodeVarint(data, AdrWay)
+                        c_idx[5*i:5*(i+1)] = _IntToStr5(size)
+                        c_data.append(data[AdrWay:pos + l])
+                        size += pos + l - AdrWay
+                    nb += len(addresses)
+                    fNew_idx.seek(pos_idx)
+                    fNew_idx.write(c_idx)
+                    fNew_data.write("".join(c_data))
+                pos_idx += len(idx)
+            fNew_idx.truncate(pos_idx)
+        finally:
+            data.close()
+        for f in (fNew_idx, fNew_data):
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+
+        stats = {"ways": nb, "size": self._fWay_data_size, "used": size - len(_WayDataV2),
+                 "free": sum(l*len(ptrs) for (l, ptrs) in self._free.iteritems()),
+                 "free_records": sum(len(ptrs) for ptrs in self._free.itervalues())}
+        stats["lost"] = stats["size"] - len(_WayDataV2) - stats["used"] - stats["free"]
+
+        open(os.path.join(self._folder, "way.compact"), "wb").close()
+        self._fWay_idx.close()
+        self._fWay_data.close()
+        _FinishCompactWays(self._folder)
+        self._fWay_idx  = open(os.path.join(self._folder, "way.idx"), "rb+")
+        self._fWay_data = open(os.path.join(self._folder, "way.data"), "rb+")
+        self._fWay_data_size = size
+        self._free = {}
+        return stats
+
+    def _IsEmpty(self):
+        # no way nor relation, as just after InitFolder()
+        return (self._fWay_data_size == len(_WayDataV2) and self._fRelation_data_size == 2 and
+                os.fstat(self._fNode_crd.fileno()).st_size == 0 and
+                (not self._tags or self._fTag_data_size == 2))
 
     def Import(self, f):
         if f == "-":
             import OsmSax
-            i = OsmSax.OsmSaxReader(sys.stdin)
+            i = OsmSax.OsmExpatReader(sys.stdin)
         elif f.endswith(".pbf"):
             import OsmPbf
             i = OsmPbf.OsmPbfReader(f)
         else:
             import OsmSax
-            i = OsmSax.OsmSaxReader(f)
-        i.CopyTo(self)
+            i = OsmSax.OsmExpatReader(f)
+        if self._IsEmpty():
+            o = _BulkTagWriter(self) if self._tags else _BulkWriter(self)
+            i.CopyTo(o)
+            o.close()
+        else:
+            i.CopyTo(self)
 
     def Update(self, f):
         import OsmSax
         if f == "-":
-            i = OsmSax.OscSaxReader(sys.stdin)
+            i = OsmSax.OscExpatReader(sys.stdin)
+        else:
+            i = OsmSax.OscExpatReader(f)
+        # writes of the whole change file are kept in memory, then journaled
+        # and applied in one pass by offset
+        paged = [_PagedFile(getattr(self, attr)) if attr and getattr(self, attr) else None
+                 for (name, attr) in _JournalFiles]
+        for ((name, attr), p) in zip(_JournalFiles, paged):
+            if p:
+                setattr(self, attr, p)
+        try:
+            i.CopyTo(self)
+        except:
+            # nothing was written
+            self._ReadFree()
+            self._ReadSizes()
+            if self._tags:
+                self._ReadTagDict()
+            raise
+        finally:
+            for ((name, attr), p) in zip(_JournalFiles, paged):
+                if p:
+                    setattr(self, attr, p._f)
+        entries = []
+        for (n, p) in enumerate(paged):
+            if p:
+                entries.extend((n, offset, data) for (offset, data) in p.Runs())
+        entries.append((_JournalFiles.index(("way.free", None)), 0, _FreeToStr(self._free)))
+        entries.append((_JournalFiles.index(("relation.free", None)), 0, _FreeToStr(self._relation_free)))
+        if self._tags:
+            entries.append((_JournalFiles.index(("tag.free", None)), 0, _FreeToStr(self._tag_free)))
+        self._WriteJournal(entries)
+        self._ApplyJournal(entries)
+
+###########################################################################
+## Bulk import
+
+class _BlockWriter:
+    """
+    Write records of record_size bytes at record_size*id in f, keeping runs
+    of consecutive ids in a buffer. Small gaps between ids are filled with
+    zeros, to keep runs going, when no record was written there before.
+    """
+
+    def __init__(self, f, record_size, buffer_size = 2**22):
+        self._f = f
+        self._record_size = record_size
+        self._buffer_size = buffer_size
+        self._max_gap = 2**16 / record_size
+        self._buf = []
+        self._buf_size = 0
+        self._start = None
+        self._next = None
+        self._end = 0 # after last id written so far
+
+    def put(self, id, data):
+        # data holds one or more records, for ids from id
+        if self._next is not None and (id == self._next or
+                (self._next < id <= self._next + self._max_gap and self._start >= self._end)):
+            if id > self._next:
+                self._buf.append("\0" * (self._record_size * (id - self._next)))
+                self._buf_size += self._record_size * (id - self._next)
         else:
-            i = OsmSax.OscSaxReader(f)
-        i.CopyTo(self)
+            self.flush()
+            self._start = id
+        self._buf.append(data)
+        self._buf_size += len(data)
+        self._next = id + len(data) / self._record_size
+        if self._buf_size >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            self._f.seek(self._record_size * self._start)
+            self._f.write("".join(self._buf))
+            self._end = max(self._end, self._next)
+        self._buf = []
+        self._buf_size = 0
+        self._next = None
+
+class _AppendWriter:
+    """
+    Append data at position pos of f, through a buffer.
+    """
+
+    def __init__(self, f, pos, buffer_size = 2**22):
+        self._f = f
+        self._pos = pos
+        self._buffer_size = buffer_size
+        self._buf = []
+        self._buf_size = 0
+
+    def append(self, data):
+        self._buf.append(data)
+        self._buf_size += len(data)
+        if self._buf_size >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            self._f.seek(self._pos)
+            self._f.write("".join(self._buf))
+            self._pos += self._buf_size
+        self._buf = []
+        self._buf_size = 0
+
+class _BulkWriter:
+    """
+    Output for readers, writing objects to an OsmBin with large buffered
+    writes. Ways and relations are appended without looking for previous
+    versions, so it is only used on an empty OsmBin.
+    """
+
+    def __init__(self, bin):
+        self._bin       = bin
+        self._node_crd  = _BlockWriter(bin._fNode_crd, 8)
+        self._way_idx   = _BlockWriter(bin._fWay_idx, 5)
+        self._way_data  = _AppendWriter(bin._fWay_data, bin._fWay_data_size)
+        self._rel_idx   = _BlockWriter(bin._fRelation_idx, 5)
+        self._rel_data  = _AppendWriter(bin._fRelation_data, bin._fRelation_data_size)
+
+    def NodeCreate(self, data):
+        self._node_crd.put(data[u"id"], _CoordToStr4(data[u"lat"]) + _CoordToStr4(data[u"lon"]))
+
+    def NodeCreateMany(self, data_list):
+        for data in data_list:
+            self.NodeCreate(data)
+
+    def NodeCoordCreateMany(self, ids, lats, lons):
+        if not numpy:
+            for (NodeId, lat, lon) in zip(ids, lats, lons):
+                self._node_crd.put(NodeId, _CoordToStr4(lat) + _CoordToStr4(lon))
+            return
+        # same rounding as _CoordToStr4()
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        crd = numpy.empty(len(ids), dtype=_NodeDtype)
+        crd["lat"] = (numpy.asarray(lats, dtype=numpy.float64)*10000000 + 1800000000).astype(numpy.int64)
+        crd["lon"] = (numpy.asarray(lons, dtype=numpy.float64)*10000000 + 1800000000).astype(numpy.int64)
+        # runs of consecutive ids
+        bounds = [0] + (numpy.flatnonzero(numpy.diff(ids) != 1) + 1).tolist() + [len(ids)]
+        for (start, end) in zip(bounds[:-1], bounds[1:]):
+            self._node_crd.put(int(ids[start]), crd[start:end].tostring())
+
+    def WayCreate(self, data):
+        c = _WayToStr(data[u"nd"])
+        self._way_idx.put(data[u"id"], _IntToStr5(self._bin._fWay_data_size))
+        self._way_data.append(c)
+        self._bin._fWay_data_size += len(c)
+
+    def WayCreateMany(self, data_list):
+        for data in data_list:
+            self.WayCreate(data)
+
+    def RelationCreate(self, data):
+        c = _RelationToStr(data)
+        c = _RelationHeadStruct.pack(len(c), data[u"id"] >> 32, data[u"id"] & _CstMax4) + c
+        self._rel_idx.put(data[u"id"], _IntToStr5(self._bin._fRelation_data_size))
+        self._rel_data.append(c)
+        self._bin._fRelation_data_size += len(c)
+
+    def RelationCreateMany(self, data_list):
+        for data in data_list:
+            self.RelationCreate(data)
+
+    def close(self):
+        for w in (self._node_crd, self._way_idx, self._way_data, self._rel_idx, self._rel_data):
+            w.flush()
+        self._bin._node_crd_dirty = True
+
+class _BulkTagWriter(_BulkWriter):
+    """
+    _BulkWriter also writing the tag store. Readers only giving coordinates
+    of nodes to NodeCoordCreateMany() give nodes with tags to
+    NodeTagCreateMany().
+    """
+
+    def __init__(self, bin):
+        _BulkWriter.__init__(self, bin)
+        self._node_tag_idx = _BlockWriter(bin._fNode_tag_idx, 5)
+        self._way_tag_idx  = _BlockWriter(bin._fWay_tag_idx, 5)
+        self._tag_data     = _AppendWriter(bin._fTag_data, bin._fTag_data_size)
+
+    def _TagCreate(self, idx, data):
+        c = _TagsToStr(data, self._bin._TagStringId)
+        if c:
+            c = _EncodeVarint(len(c)) + c
+            idx.put(data[u"id"], _IntToStr5(self._bin._fTag_data_size))
+            self._tag_data.append(c)
+            self._bin._fTag_data_size += len(c)
+
+    def NodeCreate(self, data):
+        _BulkWriter.NodeCreate(self, data)
+        self._TagCreate(self._node_tag_idx, data)
+
+    def NodeTagCreateMany(self, data_list):
+        for data in data_list:
+            self._TagCreate(self._node_tag_idx, data)
 
+    def WayCreate(self, data):
+        _BulkWriter.WayCreate(self, data)
+        self._TagCreate(self._way_tag_idx, data)
+
+    def close(self):
+        _BulkWriter.close(self)
+        for w in (self._node_tag_idx, self._way_tag_idx, self._tag_data):
+            w.flush()
+
+###########################################################################
+## Read service
+##
+## A request is a kind ("n", "w" or "r") and a number of ids, then the ids.
+## The response is its size, then for each id "\0" when the object is
+## missing, or "\1" and the object: a node.crd record for nodes, a
+## _WayToStr() record for ways, the size of the body then the body of a
+## relation.data record for relations. Nodes and ways are followed by the
+## size (varint) and the body of their tag store record, with inline strings.
+
+_RequestStruct  = struct.Struct(">cI")
+_ResponseStruct = struct.Struct(">Q")
+
+class _OsmBinRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            head = self.rfile.read(_RequestStruct.size)
+            if len(head) < _RequestStruct.size:
+                return
+            (kind, nb) = _RequestStruct.unpack(head)
+            ids = struct.unpack(">%dq" % nb, self.rfile.read(8*nb))
+            with self.server.lock:
+                c = self.server.Get(kind, ids)
+            self.wfile.write(_ResponseStruct.pack(len(c)) + c)
+
+class OsmBinServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Serve objects of the OsmBin in folder to OsmBinClient on a Unix socket,
+    each client connection by a thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, folder, socket_path):
+        self.bin  = OsmBin(folder)
+        self.lock = threading.Lock()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, _OsmBinRequestHandler)
+
+    def Get(self, kind, ids):
+        c = []
+        if kind == "n":
+            crd = self.bin._MapNodeCrd(max(ids)) if ids else None
+            for NodeId in ids:
+                if crd is None or NodeId < 0 or 8*NodeId >= len(crd):
+                    c.append("\0")
+                else:
+                    c.append("\1" + crd[8*NodeId:8*(NodeId+1)])
+                    c.append(self._Tags(self.bin._fNode_tag_idx, NodeId))
+        elif kind == "w":
+            for WayId in ids:
+                data = self.bin._WayRecord(WayId)
+                if data is None:
+                    c.append("\0")
+                else:
+                    c.append("\1" + data)
+                    c.append(self._Tags(self.bin._fWay_tag_idx, WayId))
+        elif kind == "r":
+            for RelationId in ids:
+                data = self.bin._RelationRecord(RelationId)
+                if data is None:
+                    c.append("\0")
+                else:
+                    c.append("\1" + _Int4Struct.pack(len(data)) + data)
+        return "".join(c)
+
+    def _Tags(self, fIdx, Id):
+        if not self.bin._tags:
+            return _EncodeVarint(0)
+        c = _TagsToStr(self.bin._TagGet(fIdx, Id, {}))
+        return _EncodeVarint(len(c)) + c
+
+class OsmBinClient(_OsmBinBase):
+    """
+    Reader of the objects served by OsmBinServer, with the same interface as
+    OsmBin, and *GetMany() functions to get many objects in one request.
+    """
+
+    def __init__(self, socket_path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._rfile = self._sock.makefile("rb")
+
+    def __del__(self):
+        try:
+            self._rfile.close()
+            self._sock.close()
+        except AttributeError:
+            pass
+
+    def _Request(self, kind, ids):
+        self._sock.sendall(_RequestStruct.pack(kind, len(ids)) + struct.pack(">%dq" % len(ids), *ids))
+        (size,) = _ResponseStruct.unpack(self._rfile.read(_ResponseStruct.size))
+        data = self._rfile.read(size)
+        if len(data) < size:
+            raise socket.error("connection to OsmBinServer closed")
+        return data
+
+    def _Tags(self, data, pos, res):
+        # add tags and attributes at pos to res, return the position after
+        (size, pos) = _DecodeVarint(data, pos)
+        if size:
+            (tags, attrs) = _StrToTags(data, pos)
+            res.update(attrs)
+            res["tag"] = tags
+        return pos + size
+
+    def NodeGetMany(self, NodeIds):
+        data = self._Request("n", NodeIds)
+        res = []
+        pos = 0
+        for NodeId in NodeIds:
+            if data[pos] == "\0":
+                res.append(None)
+                pos += 1
+            else:
+                (lat, lon) = _NodeStruct.unpack_from(data, pos + 1)
+                res.append({"id": NodeId, "lat": _IntToCoord(lat), "lon": _IntToCoord(lon), "tag": {}})
+                pos = self._Tags(data, pos + 1 + _NodeStruct.size, res[-1])
+        return res
+
+    def WayGetMany(self, WayIds):
+        data = self._Request("w", WayIds)
+        res = []
+        spans = []
+        pos = 0
+        for WayId in WayIds:
+            if data[pos] == "\0":
+                res.append(None)
+                pos += 1
+            else:
+                (size, pos) = _DecodeVarint(data, pos + 1)
+                res.append({"id": WayId, "tag": {}})
+                spans.append((pos, pos + size))
+                pos = self._Tags(data, pos + size, res[-1])
+        for (way, nds) in zip([way for way in res if way], _DecodeWayNodesMany(data, spans)):
+            way["nd"] = nds
+        return res
+
+    def RelationGetMany(self, RelationIds):
+        data = self._Request("r", RelationIds)
+        res = []
+        pos = 0
+        for RelationId in RelationIds:
+            if data[pos] == "\0":
+                res.append(None)
+                pos += 1
+            else:
+                (size,) = _Int4Struct.unpack_from(data, pos + 1)
+                res.append(_StrToRelation(RelationId, data, pos + 5))
+                pos += 5 + size
+        return res
+
+    def NodeGet(self, NodeId):
+        return self.NodeGetMany([NodeId])[0]
+
+    def WayGet(self, WayId):
+        return self.WayGetMany([WayId])[0]
+
+    def RelationGet(self, RelationId):
+        return self.RelationGetMany([RelationId])[0]
 
 ###########################################################################
 
 if __name__=="__main__":
     if sys.argv[1]=="--init":
-        InitFolder(sys.argv[2])
+        InitFolder(sys.argv[2], tags="--tags" in sys.argv[3:])
 
+    # writers are deleted before exit, to write free lists and release lock
     if sys.argv[1]=="--import":
         o = OsmBin(sys.argv[2], "w")
         o.Import(sys.argv[3])
+        del o
 
     if sys.argv[1]=="--update":
         o = OsmBin(sys.argv[2], "w")
         o.Update(sys.argv[3])
+        del o
+
+    if sys.argv[1]=="--convert-ways":
+        ConvertWays(sys.argv[2])
+
+    if sys.argv[1]=="--compact":
+        o = OsmBin(sys.argv[2], "w")
+        stats = o.CompactWays()
+        print("%(ways)d ways, way.data was %(size)d bytes: %(used)d of ways, %(free)d in %(free_records)d free records, %(lost)d lost" % stats)
+        print("way.data is now %d bytes" % o._fWay_data_size)
+        del o
+
+    if sys.argv[1]=="--migrate-relations":
+        MigrateRelations(sys.argv[2])
         
     if sys.argv[1]=="--read":
         i = OsmBin(sys.argv[2])
@@ -442,18 +1863,8 @@ if __name__=="__main__":
             import pprint
             pprint.pprint(i.RelationFullRecur(int(sys.argv[4])))
             
-    if sys.argv[1]=="--pyro":
-        import Pyro.core
-        import Pyro.naming
-        class OsmBin2(Pyro.core.ObjBase, OsmBin):
-            def __init__(self, folder):
-                Pyro.core.ObjBase.__init__(self)
-                OsmBin.__init__(self, folder)
-        daemon=Pyro.core.Daemon()
-        #ns=Pyro.naming.NameServerLocator().getNS()
-        #daemon.useNameServer(ns)
-        uri=daemon.connect(OsmBin2("/data/work/osmbin/data/"), "OsmBin")
-        daemon.requestLoop()
+    if sys.argv[1]=="--serve":
+        OsmBinServer(sys.argv[2], sys.argv[3]).serve_forever()
 
 ###########################################################################
 import unittest
@@ -473,6 +1884,34 @@ class TestCountObjects:
     def RelationCreate(self, data):
         self.num_rels += 1
 
+class TestRecordWays:
+    def __init__(self, ways):
+        self.ways = ways
+
+    def WayCreate(self, data):
+        self.ways[data["id"]] = data
+
+class TestRecordObjects:
+    def __init__(self, nodes, ways):
+        self.nodes = nodes
+        self.ways = ways
+
+    def NodeCreate(self, data):
+        self.nodes[data["id"]] = data
+
+    def WayCreate(self, data):
+        self.ways[data["id"]] = data
+
+    def RelationCreate(self, data):
+        pass
+
+class TestRecordRelations:
+    def __init__(self, rels):
+        self.rels = rels
+
+    def RelationCreate(self, data):
+        self.rels[data["id"]] = data
+
 class Test(unittest.TestCase):
     def setUp(self):
         import shutil
@@ -597,6 +2036,44 @@ class Test(unittest.TestCase):
         with self.assertRaises(RelationLoopError) as cm:
             self.a.RelationFullRecur(7801)
         self.assertEquals(str(cm.exception), "RelationLoopError(member loop [7801, 7802, 7801])")
+        res = self.a.RelationFullRecur(7801, RaiseOnLoop=False)
+        self.assertEquals([(x["type"], x["data"]["id"]) for x in res], [("relation", 7801), ("relation", 7802)])
+
+    def test_relation_full_memo(self):
+        self.a.Update("tests/saint_barthelemy.osc.gz")
+        member = lambda t, ref, role="": {"type": t, "ref": ref, "role": role}
+        self.a.RelationCreate({"id": 9001, "tag": {}, "member": [member("relation", 7800), member("way", 24473155),
+                                                                 member("relation", 7800, "subarea"), member("relation", 9002)]})
+        self.a.RelationCreate({"id": 9002, "tag": {}, "member": [member("relation", 9001), member("node", 78)]})
+        self.a.RelationCreate({"id": 9003, "tag": {}, "member": [member("relation", 7800), member("relation", 9004)]})
+        calls = []
+        WayGetMany = self.a.WayGetMany
+        self.a.WayGetMany = lambda WayIds: calls.append(WayIds) or WayGetMany(WayIds)
+        memo = {}
+        for RaiseOnLoop in (True, False):
+            for RemoveSubarea in (True, False):
+                for WayNodes in (True, False):
+                    for RelationId in (7800, 9001, 9003):
+                        args = dict(WayNodes=WayNodes, RaiseOnLoop=RaiseOnLoop, RemoveSubarea=RemoveSubarea)
+                        try:
+                            res = self.a.RelationFullRecur(RelationId, **args)
+                        except (RelationLoopError, MissingDataError) as e:
+                            with self.assertRaises(type(e)) as cm:
+                                self.a.RelationFullRecur(RelationId, Memo=memo, **args)
+                            self.assertEquals(str(cm.exception), str(e))
+                        else:
+                            self.assertEquals(self.a.RelationFullRecur(RelationId, Memo=memo, **args), res)
+        # member relations without skipped loop under them are kept
+        self.assertEquals(sorted(memo), [(7800, False), (7800, True)])
+        # ways are read in one batch by call
+        self.assertEquals(len(calls), 2 * 2 * 2 * 3 * 2)
+        res = self.a.RelationFullRecur(9001, WayNodes=False, RaiseOnLoop=False, RemoveSubarea=True)
+        self.assertEquals([(x["type"], x["data"]["id"]) for x in res if x["type"] != "node" or x["data"]["id"] == 78],
+                          [("relation", 9001), ("relation", 7800), ("node", 78), ("way", 780), ("way", 24473155),
+                           ("relation", 9002), ("node", 78)])
+        with self.assertRaises(MissingDataError) as cm:
+            self.a.RelationFullRecur(9003)
+        self.assertEquals(str(cm.exception), "MissingDataError(missing relation 9004)")
 
     def test_update(self):
         self.check_node(self.a.NodeGet, 1759873129)
@@ -624,3 +2101,517 @@ class Test(unittest.TestCase):
         self.check_node(self.a.NodeGet, 79)
         self.check_way(self.a.WayGet, 780)
         self.check_relation(self.a.RelationGet, 7800)
+
+    def test_node_get_many(self):
+        ids = [266053077, 1, 2619283351, 266053076, 2619283353, 10**12, 266053077]
+        self.assertEquals(self.a.NodeGetMany(ids), [self.a.NodeGet(i) for i in ids])
+        self.assertEquals(self.a.NodeGetMany([]), [])
+        self.assertEquals(self.a.NodeGetMany([10**12]), [None])
+
+        global numpy
+        numpy_ = numpy
+        numpy = None
+        try:
+            self.assertEquals(self.a.NodeGetMany(ids), [self.a.NodeGet(i) for i in ids])
+        finally:
+            numpy = numpy_
+
+    def test_node_update(self):
+        self.check_node(self.a.NodeGet, 266053077)
+        self.a.NodeCreate({"id": 266053077, "lat": 1.5, "lon": -2.25})
+        self.a.NodeCreate({"id": 2619283360, "lat": 3.5, "lon": 4.25})
+        self.assertEquals(self.a.NodeGetMany([266053077, 2619283360]), [
+            {"id": 266053077, "lat": 1.5, "lon": -2.25, "tag": {}},
+            {"id": 2619283360, "lat": 3.5, "lon": 4.25, "tag": {}}])
+
+    def test_relation_encoding(self):
+        data = {u"id": 2**33+5, u"version": 3, u"user": u"été", u"timestamp": u"2013-01-01T00:00:00Z",
+                u"tag": {u"type": u"route", u"name": u"île"},
+                u"member": [{u"type": u"node", u"ref": 2**35+1, u"role": u""},
+                            {u"type": u"way", u"ref": 12, u"role": u"outer"},
+                            {u"type": u"relation", u"ref": 7, u"role": u"subé"}]}
+        c = _RelationToStr(data)
+        self.assertEquals(_StrToRelation(data[u"id"], c, 0), data)
+        self.assertEquals(_StrToRelation(data[u"id"], "-" * 3 + c, 3), data)
+
+    def test_relation_update(self):
+        size = self.a._fRelation_data_size
+        rel = self.a.RelationGet(529891)
+        self.a.RelationDelete(rel)
+        self.check_relation(self.a.RelationGet, 529891, False)
+        self.a.RelationCreate(rel)
+        self.assertEquals(self.a.RelationGet(529891), rel)
+        # free space of the deleted relation is reused
+        self.assertEquals(self.a._fRelation_data_size, size)
+
+        rel[u"id"] = 2**33
+        self.a.RelationCreate(rel)
+        self.assertEquals(self.a.RelationGet(2**33), rel)
+        self.a.RelationDelete(rel)
+        del self.a
+        self.a = OsmBin("tmp-osmbin/", "w")
+        self.check_relation(self.a.RelationGet, 2**33, False)
+        o1 = TestCountObjects()
+        self.a.CopyRelationTo(o1)
+        self.assertEquals(o1.num_rels, 16)
+        self.assertEquals(sum(len(f) for f in self.a._relation_free.values()), 1)
+
+    def test_migrate_relations(self):
+        rels = {}
+        self.a.CopyRelationTo(TestRecordRelations(rels))
+        del self.a
+        for f in ("relation.idx", "relation.data", "relation.free"):
+            os.remove(os.path.join("tmp-osmbin", f))
+        for (RelationId, data) in rels.items():
+            RelationId = "%09d"%RelationId
+            RelFolder  = "tmp-osmbin/relation/" + RelationId[0:3] + "/" + RelationId[3:6] + "/"
+            if not os.path.exists(RelFolder):
+                os.makedirs(RelFolder)
+            open(RelFolder + RelationId[6:9], "w").write(repr(data))
+
+        MigrateRelations("tmp-osmbin/")
+        self.a = OsmBin("tmp-osmbin/", "r")
+        migrated = {}
+        self.a.CopyRelationTo(TestRecordRelations(migrated))
+        self.assertEquals(migrated, rels)
+        for (RelationId, data) in rels.items():
+            self.assertEquals(self.a.RelationGet(RelationId), data)
+
+    def test_way_encoding(self):
+        global numpy
+        for nds in ([], [1], [2**40-1, 0, 2**40-1], [12, 10, 11, 2**33+1, 5] * 100, range(10**9, 10**9 + 300)):
+            c = _EncodeWayNodes(nds)
+            self.assertEquals(_DecodeWayNodes(c, 0, len(c)), nds)
+            self.assertEquals(_DecodeWayNodesMany("-" + c + c, [(1, 1 + len(c)), (1, 1), (1 + len(c), 1 + 2*len(c))]), [nds, [], nds])
+            numpy_ = numpy
+            numpy = None
+            try:
+                self.assertEquals(_EncodeWayNodes(nds), c)
+                self.assertEquals(_DecodeWayNodes(c, 0, len(c)), nds)
+            finally:
+                numpy = numpy_
+        self.assertEquals(_WayToStr([1, 3, 2]), "\x03\x02\x04\x01")
+        self.assertEquals(_DecodeVarint("-" + _EncodeVarint(2**40+3), 1), (2**40+3, 7))
+
+    def test_way_update(self):
+        size = self.a._fWay_data_size
+        way = self.a.WayGet(24552609)
+        self.a.WayDelete(way)
+        self.check_way(self.a.WayGet, 24552609, False)
+        self.a.WayCreate(way)
+        self.assertEquals(self.a.WayGet(24552609), way)
+        # free space of the deleted way is reused
+        self.assertEquals(self.a._fWay_data_size, size)
+
+        self.a.WayCreate({"id": 1, "nd": range(10**10, 10**10 + 3000)})
+        del self.a
+        self.a = OsmBin("tmp-osmbin/", "w")
+        self.assertEquals(self.a.WayGet(1)["nd"], range(10**10, 10**10 + 3000))
+        self.a.WayDelete({"id": 1})
+        self.assertEquals(sum(len(f) for f in self.a._free.values()), 1)
+
+    def test_convert_ways(self):
+        # small ids, as the whole of way.idx is read
+        ways = {}
+        for (WayId, OrigId) in ((1, 24552609), (5, 24473155), (2**20 + 3, 255316725)):
+            ways[WayId] = self.a.WayGet(OrigId)
+            ways[WayId]["id"] = WayId
+        del self.a
+        fWay_idx  = open("tmp-osmbin/way.idx", "wb")
+        fWay_data = open("tmp-osmbin/way.data", "wb")
+        fWay_data.write(_WayDataV1)
+        for WayId in sorted(ways):
+            fWay_idx.seek(5*WayId)
+            fWay_idx.write(_IntToStr5(fWay_data.tell()))
+            fWay_data.write(_IntToStr2(len(ways[WayId]["nd"])) + "".join(_IntToStr5(i) for i in ways[WayId]["nd"]))
+        fWay_idx.close()
+        fWay_data.close()
+        with self.assertRaises(IOError):
+            OsmBin("tmp-osmbin/", "r")
+
+        ConvertWays("tmp-osmbin/")
+        self.a = OsmBin("tmp-osmbin/", "w")
+        converted = {}
+        self.a.CopyWayTo(TestRecordWays(converted))
+        self.assertEquals(converted, ways)
+        self.assertEquals(self.a.WayGet(5), ways[5])
+
+        global numpy
+        numpy_ = numpy
+        numpy = None
+        try:
+            converted = {}
+            self.a.CopyWayTo(TestRecordWays(converted))
+            self.assertEquals(converted, ways)
+        finally:
+            numpy = numpy_
+
+    def test_compact_ways(self):
+        # small ids, as the whole of way.idx is read
+        import shutil
+        ways = {}
+        for (WayId, OrigId) in ((1, 24552609), (5, 24473155), (7, 24552626), (2**20 + 3, 255316725)):
+            ways[WayId] = self.a.WayGet(OrigId)
+            ways[WayId]["id"] = WayId
+        shutil.rmtree("tmp-osmbin-2/", True)
+        InitFolder("tmp-osmbin-2/")
+        try:
+            b = OsmBin("tmp-osmbin-2/", "w")
+            for WayId in sorted(ways, reverse=True):
+                b.WayCreate(ways[WayId])
+            b.WayDelete(ways.pop(7))
+            ways[5]["nd"] = ways[5]["nd"][:3]
+            b.WayCreate(ways[5])
+            size = b._fWay_data_size
+            stats = b.CompactWays()
+            self.assertEquals(stats["ways"], 3)
+            self.assertEquals(stats["size"], size)
+            self.assertEquals(stats["free_records"], 2)
+            self.assertEquals(stats["lost"], 0)
+            self.assertEquals(b._fWay_data_size, size - stats["free"])
+            self.assertEquals(os.stat("tmp-osmbin-2/way.data").st_size, size - stats["free"])
+            self.assertEquals(b._free, {})
+            for WayId in ways:
+                self.assertEquals(b.WayGet(WayId), ways[WayId])
+            # ways are in id order
+            addresses = []
+            for WayId in sorted(ways):
+                b._fWay_idx.seek(5*WayId)
+                addresses.append(_Str5ToInt(b._fWay_idx.read(5)))
+            self.assertEquals(addresses, sorted(addresses))
+            ways[2] = dict(ways[1], id=2)
+            b.WayCreate(ways[2])
+            del b
+
+            # interrupted before the new files are renamed
+            global _FinishCompactWays
+            finish = _FinishCompactWays
+            _FinishCompactWays = lambda folder: None
+            try:
+                b = OsmBin("tmp-osmbin-2/", "w")
+                b.CompactWays()
+                del b
+            finally:
+                _FinishCompactWays = finish
+            self.assertTrue(os.path.exists("tmp-osmbin-2/way.compact"))
+            b = OsmBin("tmp-osmbin-2/", "w")
+            self.assertFalse(os.path.exists("tmp-osmbin-2/way.compact"))
+            self.assertEquals(b._free, {})
+            for WayId in ways:
+                self.assertEquals(b.WayGet(WayId), ways[WayId])
+            del b
+        finally:
+            shutil.rmtree("tmp-osmbin-2/", True)
+
+    def test_import_bulk(self):
+        import OsmSax, shutil, bz2, re
+        shutil.rmtree("tmp-osmbin-2/", True)
+        InitFolder("tmp-osmbin-2/")
+        try:
+            b = OsmBin("tmp-osmbin-2/", "w")
+            OsmSax.OsmExpatReader("tests/saint_barthelemy.osm.bz2").CopyTo(b)
+            del b
+            b = OsmBin("tmp-osmbin-2/", "r")
+            for f in (self.a._fNode_crd, self.a._fWay_idx, self.a._fWay_data, self.a._fRelation_idx, self.a._fRelation_data):
+                f.flush()
+            for f in ("node.crd", "way.idx", "way.data", "relation.idx", "relation.data"):
+                self.assertEquals(os.stat("tmp-osmbin/" + f).st_size, os.stat("tmp-osmbin-2/" + f).st_size, f)
+            # only used parts of sparse node.crd and way.idx are compared
+            osm = bz2.BZ2File("tests/saint_barthelemy.osm.bz2").read()
+            ids = [int(i) for i in re.findall('<node id="([0-9]+)"', osm)]
+            self.assertEquals(self.a.NodeGetMany(ids), b.NodeGetMany(ids))
+            ids = [int(i) for i in re.findall('<way id="([0-9]+)"', osm)]
+            self.assertEquals([self.a.WayGet(i) for i in ids], [b.WayGet(i) for i in ids])
+            for f in ("way.data", "relation.data"):
+                self.assertEquals(open("tmp-osmbin/" + f).read(), open("tmp-osmbin-2/" + f).read(), f)
+            del b
+        finally:
+            shutil.rmtree("tmp-osmbin-2/", True)
+
+    def test_block_writer(self):
+        import StringIO
+        f = StringIO.StringIO()
+        w = _BlockWriter(f, 2, buffer_size=6)
+        for i in (5, 6, 9, 3, 4, 7, 20, 10, 1, 2):
+            w.put(i, "%02d" % i)
+        w.flush()
+        self.assertEquals(f.getvalue(), "\0\0" + "".join("%02d" % i if i in (1, 2, 3, 4, 5, 6, 7, 9, 10, 20) else "\0\0" for i in range(1, 21)))
+
+    def test_import_pbf(self):
+        import shutil
+        shutil.rmtree("tmp-osmbin-2/", True)
+        InitFolder("tmp-osmbin-2/")
+        try:
+            b = OsmBin("tmp-osmbin-2/", "w")
+            b.Import("tests/saint_barthelemy.osm.pbf")
+            for WayId in (24473155, 24552609, 255316725):
+                way = self.a.WayGet(WayId)
+                self.assertEquals(b.WayGet(WayId), way)
+                for (n1, n2) in zip(b.NodeGetMany(way["nd"]), self.a.NodeGetMany(way["nd"])):
+                    self.assertAlmostEquals(n1["lat"], n2["lat"], 6)
+                    self.assertAlmostEquals(n1["lon"], n2["lon"], 6)
+            for RelationId in (47796, 529891, 2707693):
+                self.assertEquals(b.RelationGet(RelationId)["member"], self.a.RelationGet(RelationId)["member"])
+            o1 = TestCountObjects()
+            b.CopyRelationTo(o1)
+            self.assertEquals(o1.num_rels, 16)
+            del b
+        finally:
+            shutil.rmtree("tmp-osmbin-2/", True)
+
+    def test_client(self):
+        import tempfile, shutil
+        self.a.Update("tests/saint_barthelemy.osc.gz")
+        del self.a
+        self.a = OsmBin("tmp-osmbin/", "r")
+        tmp = tempfile.mkdtemp()
+        server = OsmBinServer("tmp-osmbin/", os.path.join(tmp, "osmbin.sock"))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            c1 = OsmBinClient(os.path.join(tmp, "osmbin.sock"))
+            c2 = OsmBinClient(os.path.join(tmp, "osmbin.sock"))
+            ids = [266053077, 1, 2619283351, 266053076, 2619283353, 10**12, 78]
+            self.assertEquals(c1.NodeGetMany(ids), self.a.NodeGetMany(ids))
+            self.assertEquals(c2.NodeGet(266053077), self.a.NodeGet(266053077))
+            ids = [24473155, 255316725, 1, 780, 24473155, 24552609]
+            self.assertEquals(c2.WayGetMany(ids), [self.a.WayGet(i) for i in ids])
+            self.assertEquals(c1.WayGet(780), self.a.WayGet(780))
+            ids = [47796, 2707693, 1, 7800, 529891]
+            self.assertEquals(c1.RelationGetMany(ids), [self.a.RelationGet(i) for i in ids])
+            self.assertEquals(c1.RelationGet(1), None)
+            self.assertEquals(c2.RelationFullRecur(7800), self.a.RelationFullRecur(7800))
+            with self.assertRaises(RelationLoopError):
+                c2.RelationFullRecur(7801)
+            self.assertEquals(c1.NodeGetMany([]), [])
+            self.assertEquals(c1.UserGet(1), None)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tmp)
+
+    def test_update_journal(self):
+        # interrupted after the journal is written, update is applied on next open
+        self.a._ApplyJournal = lambda entries: None
+        self.a.Update("tests/saint_barthelemy.osc.gz")
+        self.check_relation(self.a.RelationGet, 7800, False)
+        self.check_way(self.a.WayGet, 24552609)
+        del self.a
+        self.assertTrue(os.path.exists("tmp-osmbin/journal"))
+        # only the written bytes are journaled, not the pages around them
+        self.assertLess(os.path.getsize("tmp-osmbin/journal"), 2000)
+        self.a = OsmBin("tmp-osmbin/", "w")
+        self.assertFalse(os.path.exists("tmp-osmbin/journal"))
+        self.check_relation(self.a.RelationGet, 7800)
+        self.check_way(self.a.WayGet, 24552609, False)
+        self.check_node(self.a.NodeGet, 78)
+        self.assertEquals(self.a.RelationFullRecur(7800)[3]["data"]["id"], 780)
+
+        # incomplete journal is ignored
+        del self.a
+        open("tmp-osmbin/journal", "wb").write(_JournalMagic + _JournalEntryStruct.pack(1, 5*780, 5) + "\0" * 5)
+        self.a = OsmBin("tmp-osmbin/", "w")
+        self.check_way(self.a.WayGet, 780)
+
+    def test_update_error(self):
+        import copy
+        free = copy.deepcopy((self.a._free, self.a._relation_free, self.a._fWay_data_size, self.a._fRelation_data_size))
+        def error(data):
+            raise ValueError()
+        self.a.RelationCreate = error
+        with self.assertRaises(ValueError):
+            self.a.Update("tests/saint_barthelemy.osc.gz")
+        del self.a.RelationCreate
+        self.assertEquals((self.a._free, self.a._relation_free, self.a._fWay_data_size, self.a._fRelation_data_size), free)
+        self.check_way(self.a.WayGet, 24552609)
+        self.check_way(self.a.WayGet, 780, False)
+        self.check_relation(self.a.RelationGet, 529891)
+        self.a.Update("tests/saint_barthelemy.osc.gz")
+        self.check_way(self.a.WayGet, 24552609, False)
+        self.check_way(self.a.WayGet, 780)
+
+    def test_free(self):
+        free = {12: [2, 1000], 2**33: [2**40]}
+        self.assertEquals(_StrToFree(_FreeToStr(free)), free)
+        self.assertEquals(_StrToFree(_FreeToStr({})), {})
+        self.assertEquals(_StrToFree("2;12\n1000;12\n1099511627776;8589934592\n"), free)
+        self.assertEquals(_StrToFree(""), {})
+
+    def test_paged_file(self):
+        import tempfile
+        f = tempfile.TemporaryFile()
+        f.write("0123456789")
+        p = _PagedFile(f)
+        p.page_size = 4
+        p.seek(2)
+        p.write("ab")
+        p.seek(13)
+        p.write("cd")
+        p.seek(0)
+        self.assertEquals(p.read(), "01ab456789\0\0\0cd")
+        p.seek(3)
+        self.assertEquals(p.read(5), "b4567")
+        f.seek(0)
+        self.assertEquals(f.read(), "0123456789")
+        self.assertEquals(p.Runs(), [(2, "ab"), (13, "cd")])
+
+        # adjacent and overlapping writes are merged, also across pages
+        p.seek(4)
+        p.write("xy")
+        p.seek(5)
+        p.write("Y")
+        self.assertEquals(p.Runs(), [(2, "abxY"), (13, "cd")])
+        p.seek(10)
+        p.write("efg")
+        p.seek(0)
+        self.assertEquals(p.read(), "01abxY6789efgcd")
+        self.assertEquals(p.Runs(), [(2, "abxY"), (10, "efgcd")])
+        p.seek(1)
+        p.write("ABCDEFGHIJKLM")
+        self.assertEquals(p.Runs(), [(1, "ABCDEFGHIJKLMd")])
+
+    def test_paged_file_scattered(self):
+        # memory and journal are in proportion to the bytes written
+        import tempfile
+        f = tempfile.TemporaryFile()
+        f.write("\0" * 2**20)
+        p = _PagedFile(f)
+        for i in xrange(0, 2**20, 2**10):
+            p.seek(i + 5)
+            p.write("12345678")
+        runs = p.Runs()
+        self.assertEquals(len(runs), 2**10)
+        self.assertEquals(sum(len(data) for (offset, data) in runs), 8 * 2**10)
+        p.seek(2**10 + 3)
+        self.assertEquals(p.read(12), "\0\0" + "12345678" + "\0\0")
+
+    def test_tag_encoding(self):
+        data = {u"id": 12, u"lat": 1.5, u"lon": 2.5, u"tag": {u"highway": u"residential", u"name": u"Rue \xe9"},
+                u"version": 4, u"timestamp": u"2014-01-04T21:57:04Z", u"changeset": u"19813735", u"uid": u"10610",
+                u"user": u"RedFox", u"ref": u"007", u"delta": -3, u"date": u"1960-01-01T00:00:00Z"}
+        attrs = dict((k, v) for (k, v) in data.items() if k not in (u"id", u"lat", u"lon", u"tag"))
+        strings = [u"highway", u"residential", u"RedFox"]
+        string_id = lambda s, key: strings.index(s) if s in strings else None
+        for (f, l) in ((None, 0), (string_id, 0), (string_id, 3)):
+            c = _TagsToStr(data, f)
+            self.assertEquals(_StrToTags(c, 0, strings), (data[u"tag"], attrs))
+            c = _TagsToStr({u"id": 1, u"tag": data[u"tag"]}, f)
+            self.assertEquals(_StrToTags(c, 0, strings), (data[u"tag"], {}))
+        self.assertTrue(len(_TagsToStr(data, string_id)) < len(_TagsToStr(data)))
+        self.assertEquals(_TagsToStr({u"id": 1, u"lat": 1.5, u"lon": 2.5, u"tag": {}}), "")
+
+        # only ascii decimals are stored as numbers
+        for v in (u"0", u"19813735", u"999999999999999999", u"1000000000000000000", u"00", u"-1", u"1 ",
+                  u"\xb2", u"\u0663\u0664", u"\uff11", u"1\n"):
+            c = _TagsToStr({u"id": 1, u"tag": {}, u"changeset": v})
+            self.assertEquals(_StrToTags(c, 0), ({}, {u"changeset": v}))
+
+    def check_tags(self, b, nodes, ways):
+        for data in nodes.values():
+            n = b.NodeGet(data["id"])
+            self.assertEquals(dict((k, v) for (k, v) in n.items() if k not in ("lat", "lon")),
+                              dict((k, v) for (k, v) in data.items() if k not in ("lat", "lon")))
+        for data in ways.values():
+            self.assertEquals(b.WayGet(data["id"]), data)
+
+    def test_tags(self):
+        import OsmSax, shutil
+        nodes = {}
+        ways = {}
+        OsmSax.OsmExpatReader("tests/saint_barthelemy.osm.bz2").CopyTo(TestRecordObjects(nodes, ways))
+        self.assertEquals(nodes[266967419]["user"], u"RedFox")
+        shutil.rmtree("tmp-osmbin-2/", True)
+        shutil.rmtree("tmp-osmbin-3/", True)
+        InitFolder("tmp-osmbin-2/", tags=True)
+        InitFolder("tmp-osmbin-3/", tags=True)
+        try:
+            # bulk import, and object by object
+            b = OsmBin("tmp-osmbin-2/", "w")
+            b.Import("tests/saint_barthelemy.osm.bz2")
+            del b
+            b = OsmBin("tmp-osmbin-3/", "w")
+            OsmSax.OsmExpatReader("tests/saint_barthelemy.osm.bz2").CopyTo(b)
+            del b
+            for f in ("tag.data", "tag.dict"):
+                self.assertEquals(open("tmp-osmbin-2/" + f).read(), open("tmp-osmbin-3/" + f).read(), f)
+            self.assertTrue(os.stat("tmp-osmbin-2/tag.dict").st_size > 0)
+
+            b = OsmBin("tmp-osmbin-2/", "r")
+            self.check_tags(b, nodes, ways)
+            ids = list(nodes)[:100] + [1, 10**12]
+            self.assertEquals(b.NodeGetMany(ids), [b.NodeGet(i) for i in ids])
+            del b
+
+            b = OsmBin("tmp-osmbin-2/", "w")
+            b.Update("tests/saint_barthelemy.osc.gz")
+            del b
+            b = OsmBin("tmp-osmbin-2/", "r")
+            self.assertEquals(b.WayGet(24552609), None)
+            self.assertEquals(b.NodeGet(1759873129)["tag"], {})
+            self.assertFalse("user" in b.NodeGet(1759873129))
+            self.assertEquals(b.NodeGet(78)["user"], u"47NOE")
+            self.assertEquals(b.NodeGet(78)["changeset"], u"100000000")
+            self.assertEquals(b.WayGet(780), {"id": 780, "nd": [78, 79], "version": 1,
+                                              "tag": {u"highway": u"residential", u"name": u"Rue de la Colline"},
+                                              "timestamp": u"2011-12-19T22:31:39Z", "changeset": u"100000000",
+                                              "uid": u"464034", "user": u"apexer"})
+            way = b.WayGet(780)
+            del b
+
+            # tags of updated and deleted ways are reused
+            b = OsmBin("tmp-osmbin-2/", "w")
+            size = b._fTag_data_size
+            b.WayDelete(way)
+            way["tag"][u"name"] = u"Rue de la Montagne"
+            b.WayCreate(way)
+            self.assertEquals(b.WayGet(780), way)
+            self.assertEquals(b._fTag_data_size, size)
+            del b
+        finally:
+            shutil.rmtree("tmp-osmbin-2/", True)
+            shutil.rmtree("tmp-osmbin-3/", True)
+
+    def test_tags_pbf(self):
+        import OsmPbf, shutil
+        nodes = {}
+        OsmPbf.OsmPbfReader("tests/saint_barthelemy.osm.pbf").CopyTo(TestRecordObjects(nodes, {}))
+        shutil.rmtree("tmp-osmbin-2/", True)
+        InitFolder("tmp-osmbin-2/", tags=True)
+        try:
+            b = OsmBin("tmp-osmbin-2/", "w")
+            b.Import("tests/saint_barthelemy.osm.pbf")
+            self.assertEquals(len([1 for data in nodes.values() if data["tag"]]), 83)
+            self.check_tags(b, nodes, {})
+            self.check_node(b.NodeGet, 266053077)
+            del b
+        finally:
+            shutil.rmtree("tmp-osmbin-2/", True)
+
+    def test_tags_client(self):
+        import tempfile, shutil
+        shutil.rmtree("tmp-osmbin-2/", True)
+        InitFolder("tmp-osmbin-2/", tags=True)
+        tmp = tempfile.mkdtemp()
+        try:
+            b = OsmBin("tmp-osmbin-2/", "w")
+            b.Import("tests/saint_barthelemy.osm.bz2")
+            del b
+            b = OsmBin("tmp-osmbin-2/", "r")
+            server = OsmBinServer("tmp-osmbin-2/", os.path.join(tmp, "osmbin.sock"))
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            try:
+                c = OsmBinClient(os.path.join(tmp, "osmbin.sock"))
+                ids = [266967419, 266053077, 1, 2619283351]
+                self.assertEquals(c.NodeGetMany(ids), [b.NodeGet(i) for i in ids])
+                ids = [24473155, 255316725, 1, 24552609]
+                self.assertEquals(c.WayGetMany(ids), [b.WayGet(i) for i in ids])
+                self.assertEquals(c.WayGet(24552609)["user"], u"encleadus")
+            finally:
+                server.shutdown()
+                server.server_close()
+        finally:
+            shutil.rmtree(tmp)
+            shutil.rmtree("tmp-osmbin-2/", True)
@@ -19,21 +19,32 @@
 ##                                                                       ##
 ###########################################################################
 
+import collections
 import psycopg2
 import psycopg2.extensions
+import psycopg2.extras
 
 ###########################################################################
 ## Reader / Writer
 
 class OsmOsis:
     
-    def __init__(self, dbstring, schema, dump_sub_elements=True):
+    def __init__(self, dbstring, schema, dump_sub_elements=True, cache_size=100000):
         psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
         psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
         self._PgConn = psycopg2.connect(dbstring)
         self._PgCurs = self._PgConn.cursor()
         self._PgCurs.execute("SET search_path TO %s,public;" % schema)
+        # tags are read as dict
+        psycopg2.extras.register_hstore(self._PgConn, unicode=True)
         self.dump_sub_elements = dump_sub_elements
+        for (name, args, sql) in self._Statements:
+            self._PgCurs.execute("PREPARE %s (%s) AS %s;" % (name, args, sql))
+        # last read objects, by (type, id), the least recently used first
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
         
     def __del__(self):
         try:
@@ -51,74 +62,145 @@ class OsmOsis:
         (timestamp,) = self._PgCurs.fetchone()
         return timestamp
 
-    def NodeGet(self, NodeId):
-        
-        self._PgCurs.execute("SELECT nodes.id, st_y(nodes.geom), st_x(nodes.geom), nodes.version, users.name FROM nodes LEFT JOIN users ON nodes.user_id = users.id WHERE nodes.id = %d;" % NodeId)
-        r1 = self._PgCurs.fetchone()
-        if not r1: return None
+    _NodeSelect = "SELECT nodes.id, st_y(nodes.geom), st_x(nodes.geom), nodes.version, users.name, nodes.tags FROM nodes LEFT JOIN users ON nodes.user_id = users.id"
+    _WaySelect = "SELECT ways.id, ways.version, users.name, ways.tags FROM ways LEFT JOIN users ON ways.user_id = users.id"
+    _RelationSelect = "SELECT relations.id, relations.version, users.name, relations.tags FROM relations LEFT JOIN users ON relations.user_id = users.id"
+
+    def _NodeData(self, r1):
         data = {}
         data[u"id"]      = r1[0]
         data[u"lat"]     = float(r1[1])
         data[u"lon"]     = float(r1[2])
         data[u"version"] = r1[3]
         data[u"user"]    = r1[4] or ""
-        
-        data[u"tag"] = {}
-        self._PgCurs.execute("SELECT (each(tags)).key, (each(tags)).value FROM nodes WHERE id = %d;" % NodeId)
-        for r1 in self._PgCurs.fetchall():
-            data[u"tag"][r1[0]] = r1[1]
-            
+        data[u"tag"]     = r1[5] or {}
         return data
-    
-    def WayGet(self, WayId):
-        
-        self._PgCurs.execute("SELECT ways.id, ways.version, users.name FROM ways LEFT JOIN users ON ways.user_id = users.id WHERE ways.id = %d;" % WayId)
-        r1 = self._PgCurs.fetchone()
-        if not r1: return None
+
+    def _WayData(self, r1):
         data = {}
         data[u"id"]      = r1[0]
         data[u"version"] = r1[1]
         data[u"user"]    = r1[2] or ""
-        
-        data[u"tag"] = {}
-        self._PgCurs.execute("SELECT (each(tags)).key, (each(tags)).value FROM ways WHERE id = %d;" % WayId)
-        for r1 in self._PgCurs.fetchall():
-            data[u"tag"][r1[0]] = r1[1]
-        
-        data[u"nd"] = []
-        if self.dump_sub_elements:
-            self._PgCurs.execute("SELECT node_id FROM way_nodes WHERE way_id = %d ORDER BY sequence_id;" % WayId)
-            for r1 in self._PgCurs.fetchall():
-                data[u"nd"].append(r1[0])
-            
+        data[u"tag"]     = r1[3] or {}
+        data[u"nd"]      = []
         return data
 
-    def RelationGet(self, RelationId):
-        
-        self._PgCurs.execute("SELECT relations.id, relations.version, users.name FROM relations LEFT JOIN users ON relations.user_id = users.id WHERE relations.id = %d;" % RelationId)
-        r1 = self._PgCurs.fetchone()
-        if not r1: return None
+    def _RelationData(self, r1):
         data = {}
         data[u"id"]      = r1[0]
         data[u"version"] = r1[1]
         data[u"user"]    = r1[2] or ""
-        
-        data[u"tag"] = {}
-        self._PgCurs.execute("SELECT (each(tags)).key, (each(tags)).value FROM relations WHERE id = %d;" % RelationId)
-        for r1 in self._PgCurs.fetchall():
-            data[u"tag"][r1[0]] = r1[1]
-        
-        data[u"member"] = []
-        if self.dump_sub_elements:
-            self._PgCurs.execute("SELECT member_id, member_type, member_role FROM relation_members WHERE relation_id = %d ORDER BY sequence_id;" % RelationId)
-            for r1 in self._PgCurs.fetchall():
-                data[u"member"].append({u"ref":r1[0], u"type":{"N":"node","W":"way","R":"relation"}[r1[1]], u"role":r1[2]})
-            
+        data[u"tag"]     = r1[3] or {}
+        data[u"member"]  = []
         return data
 
+    _Statements = (
+        ("osmose_nodes", "bigint[]", _NodeSelect + " WHERE nodes.id = ANY($1)"),
+        ("osmose_ways", "bigint[]", _WaySelect + " WHERE ways.id = ANY($1)"),
+        ("osmose_way_nodes", "bigint[]", "SELECT way_id, node_id FROM way_nodes WHERE way_id = ANY($1) ORDER BY way_id, sequence_id"),
+        ("osmose_relations", "bigint[]", _RelationSelect + " WHERE relations.id = ANY($1)"),
+        ("osmose_relation_members", "bigint[]", "SELECT relation_id, member_id, member_type, member_role FROM relation_members WHERE relation_id = ANY($1) ORDER BY relation_id, sequence_id"),
+        ("osmose_user", "bigint", "SELECT name FROM users WHERE id = $1"),
+    )
+
+    def CacheClear(self):
+        """
+        Forget the cached objects, to be called when the database may have
+        changed, or at the end of an analyser.
+        """
+        self._cache.clear()
+
+    def CacheStats(self):
+        return u"cache %d hits, %d misses, %d objects" % (self.cache_hits, self.cache_misses, len(self._cache))
+
+    def _CacheGetMany(self, Type, Ids, read):
+        """
+        Objects of Type for Ids, in the same order, None for missing ones,
+        taken from the cache or else read by read(ids) as an {id: data}.
+        Returned objects are shared with the cache and must not be modified.
+        """
+        res = {}
+        miss = []
+        for Id in Ids:
+            key = (Type, Id)
+            if key in self._cache:
+                res[Id] = self._cache[key] = self._cache.pop(key)
+            elif Id not in res:
+                res[Id] = None
+                miss.append(Id)
+        self.cache_hits += len(Ids) - len(miss)
+        self.cache_misses += len(miss)
+
+        if miss:
+            res.update(read(miss))
+            for Id in miss:
+                self._cache[(Type, Id)] = res[Id]
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+        return [res[Id] for Id in Ids]
+
+    def _NodeRead(self, NodeIds):
+        self._PgCurs.execute("EXECUTE osmose_nodes (%s);", (NodeIds,))
+        return dict((r1[0], self._NodeData(r1)) for r1 in self._PgCurs.fetchall())
+
+    def _WayRead(self, WayIds):
+        self._PgCurs.execute("EXECUTE osmose_ways (%s);", (WayIds,))
+        ways = dict((r1[0], self._WayData(r1)) for r1 in self._PgCurs.fetchall())
+
+        if self.dump_sub_elements and ways:
+            self._PgCurs.execute("EXECUTE osmose_way_nodes (%s);", (list(ways),))
+            for r1 in self._PgCurs.fetchall():
+                ways[r1[0]][u"nd"].append(r1[1])
+
+        return ways
+
+    def _RelationRead(self, RelationIds):
+        self._PgCurs.execute("EXECUTE osmose_relations (%s);", (RelationIds,))
+        relations = dict((r1[0], self._RelationData(r1)) for r1 in self._PgCurs.fetchall())
+
+        if self.dump_sub_elements and relations:
+            self._PgCurs.execute("EXECUTE osmose_relation_members (%s);", (list(relations),))
+            for r1 in self._PgCurs.fetchall():
+                relations[r1[0]][u"member"].append({u"ref":r1[1], u"type":{"N":"node","W":"way","R":"relation"}[r1[2]], u"role":r1[3]})
+
+        return relations
+
+    def NodeGet(self, NodeId):
+        return self._CacheGetMany("node", [NodeId], self._NodeRead)[0]
+
+    def NodeGetMany(self, NodeIds):
+        """
+        Nodes of NodeIds, in the same order, None for missing ones, the
+        uncached ones read by a single query.
+        """
+        return self._CacheGetMany("node", NodeIds, self._NodeRead)
+
+    def WayGet(self, WayId):
+        return self._CacheGetMany("way", [WayId], self._WayRead)[0]
+
+    def WayGetMany(self, WayIds):
+        """
+        Ways of WayIds, in the same order, None for missing ones, the
+        uncached ones read by a single query, and one more for their nodes.
+        """
+        return self._CacheGetMany("way", WayIds, self._WayRead)
+
+    def RelationGet(self, RelationId):
+        return self._CacheGetMany("relation", [RelationId], self._RelationRead)[0]
+
+    def RelationGetMany(self, RelationIds):
+        """
+        Relations of RelationIds, in the same order, None for missing ones,
+        the uncached ones read by a single query, and one more for their
+        members.
+        """
+        return self._CacheGetMany("relation", RelationIds, self._RelationRead)
+
     def UserGet(self, UserId):
+        return self._CacheGetMany("user", [UserId], self._UserRead)[0]
 
-        self._PgCurs.execute("SELECT name FROM users WHERE id = %d;" % UserId)
+    def _UserRead(self, UserIds):
+        self._PgCurs.execute("EXECUTE osmose_user (%s);", (UserIds[0],))
         r1 = self._PgCurs.fetchone()
-        if not r1: return None
-        return r1[0]
+        return {UserIds[0]: r1 and r1[0]}
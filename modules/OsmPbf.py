@@ -19,11 +19,18 @@
 ##                                                                       ##
 ###########################################################################
 
+import array
+import collections
+import datetime
+import multiprocessing
+import struct
 import time
+import zlib
 import dateutil.parser
+import dateutil.tz
 import traceback
 import config
-from imposm.parser.simple import OSMParser
+from imposm.parser.pbf.parser import PBFFile, PrimitiveBlockParser
 
 try:
     # For Python 3.0 and later
@@ -40,6 +47,164 @@ class dummylog:
     def log(self, text):
         return
 
+###########################################################################
+## Header reading
+##
+## imposm does not give access to all HeaderBlock fields, so the first blob
+## of the file is read here with a minimal protobuf decoder.
+
+def _ReadVarint(data, pos):
+    result = 0
+    shift  = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return (result, pos)
+        shift += 7
+
+def _ProtobufFields(data):
+    """
+    Iterate over (field number, raw value) of a protobuf message.
+    """
+    pos = 0
+    end = len(data)
+    while pos < end:
+        (key, pos) = _ReadVarint(data, pos)
+        wire_type = key & 0x7
+        if wire_type == 0:
+            (value, pos) = _ReadVarint(data, pos)
+        elif wire_type == 1:
+            value = data[pos:pos+8]
+            pos += 8
+        elif wire_type == 2:
+            (length, pos) = _ReadVarint(data, pos)
+            value = data[pos:pos+length]
+            pos += length
+        elif wire_type == 5:
+            value = data[pos:pos+4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % wire_type)
+        yield (key >> 3, value)
+
+# HeaderBlock fields, from osmformat.proto
+_HEADER_OSMOSIS_REPLICATION_TIMESTAMP = 32
+
+def _ReadHeaderBlock(filename):
+    """
+    Return HeaderBlock of a .pbf as a dict of field number to raw value.
+    """
+    f = open(filename, "rb")
+    try:
+        size = struct.unpack("!i", f.read(4))[0]
+        blob_header = dict(_ProtobufFields(f.read(size)))
+        blob = dict(_ProtobufFields(f.read(blob_header[3])))
+    finally:
+        f.close()
+    if 1 in blob:
+        data = blob[1]
+    else:
+        data = zlib.decompress(blob[3])
+    return dict(_ProtobufFields(data))
+
+###########################################################################
+## Block decoding, run in worker processes
+
+class _TimestampFormatter(dict):
+    # Objects from a same block often share the same timestamp, format each
+    # value only once.
+    def __missing__(self, t):
+        s = self[t] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+        return s
+
+def _NodeData(node, ts):
+    data = {}
+    data["id"] = node[0]
+    data["tag"] = node[1] if isinstance(node[1], dict) else dict(node[1])
+    data["lon"] = node[2][0]
+    data["lat"] = node[2][1]
+    if len(node) > 3:
+        data["version"] = node[3]
+        data["timestamp"] = ts[node[4]]
+        data["uid"] = node[5]
+    return data
+
+def _WayData(way, ts):
+    data = {}
+    data["id"] = way[0]
+    data["tag"] = way[1]
+    data["nd"] = way[2]
+    if len(way) > 3:
+        data["version"] = way[3]
+        data["timestamp"] = ts[way[4]]
+        data["uid"] = way[5]
+    return data
+
+def _RelationData(relation, ts):
+    data = {}
+    data["id"] = relation[0]
+    data["tag"] = relation[1]
+    if len(relation) > 3:
+        data["version"] = relation[3]
+        data["timestamp"] = ts[relation[4]]
+        data["uid"] = relation[5]
+    data["member"] = []
+    for (ref, type, role) in relation[2]:
+        attrs = { "ref": int(ref),
+                  "role": role,
+                  "type": type,
+                }
+
+        data["member"].append(attrs)
+    return data
+
+# nodes argument of _DecodeBlock() to get coordinates of all nodes, and
+# also nodes with tags
+_NODE_COORDS = "coords"
+_NODE_COORDS_TAGS = "coords+tags"
+
+def _DecodeBlock(args):
+    """
+    Return nodes, ways and relations of a block, and the max timestamp of
+    the decoded objects. When nodes is _NODE_COORDS, nodes are returned as
+    (ids, lats, lons) arrays of all nodes, with or without tags, and a list
+    of nodes with tags for _NODE_COORDS_TAGS.
+    """
+    (filename, blob_pos, blob_size, nodes, ways, relations) = args
+    block = PrimitiveBlockParser(filename, blob_pos, blob_size)
+    ts = _TimestampFormatter()
+    res = ([], [], [])
+    timestamp_max = None
+    if nodes in (_NODE_COORDS, _NODE_COORDS_TAGS):
+        coords = (array.array("l"), array.array("d"), array.array("d"))
+        tagged = []
+        for node in block.nodes():
+            if len(node) > 3 and node[4] > timestamp_max:
+                timestamp_max = node[4]
+            coords[0].append(node[0])
+            coords[1].append(node[2][1])
+            coords[2].append(node[2][0])
+            if node[1] and nodes == _NODE_COORDS_TAGS:
+                tagged.append(_NodeData(node, ts))
+        res = ((coords, tagged), [], [])
+    elif nodes:
+        for node in block.nodes():
+            if len(node) > 3 and node[4] > timestamp_max:
+                timestamp_max = node[4]
+            # only nodes with tags are reported
+            if node[1]:
+                res[0].append(_NodeData(node, ts))
+    if ways:
+        res[1].extend(_WayData(way, ts) for way in block.ways())
+    if relations:
+        res[2].extend(_RelationData(relation, ts) for relation in block.relations())
+    if ts:
+        # keys of ts are all timestamps of reported objects
+        timestamp_max = max(timestamp_max, max(ts))
+    return res + (timestamp_max,)
+
 ###########################################################################
 
 class OsmPbfReader:
@@ -47,23 +212,36 @@ class OsmPbfReader:
     def log(self, txt):
         self._logger.log(txt)
 
-    def __init__(self, pbf_file, logger = dummylog()):
+    def __init__(self, pbf_file, logger = dummylog(), concurrency = None):
         self._pbf_file = pbf_file
         self._logger   = logger
         self._got_error = False
+        self._concurrency = concurrency or config.pbf_concurrency or multiprocessing.cpu_count()
+        self._timestamp = None
+        self._timestamp_max = None
+        self._parsed = False
 
     def timestamp(self):
-        try:
-            # Try to get timestamp from metadata
-            res = getstatusoutput("%s %s --out-timestamp" % (config.bin_osmconvert, self._pbf_file))
-            if not res[0]:
-                d = dateutil.parser.parse(res[1])
-                if not d:
-                    raise ValueError()
-                return d
-        except:
+        """
+        Replication timestamp from file header, or when missing, max
+        timestamp of objects read by a previous Copy*To().
+        """
+        if self._timestamp is None:
+            try:
+                t = _ReadHeaderBlock(self._pbf_file).get(_HEADER_OSMOSIS_REPLICATION_TIMESTAMP)
+                if t:
+                    self._timestamp = datetime.datetime.fromtimestamp(t, dateutil.tz.tzutc())
+            except:
+                pass
+        if self._timestamp is not None:
+            return self._timestamp
+
+        if self._timestamp_max is not None:
+            return datetime.datetime.fromtimestamp(self._timestamp_max, dateutil.tz.tzutc())
+
+        if self._parsed:
             try:
-                # Compute max timestamp from data
+                # Objects read have no metadata, compute max timestamp from data
                 res = getstatusoutput("%s %s --out-statistics | grep 'timestamp max'" % (config.bin_osmconvert, self._pbf_file))
                 if not res[0]:
                     s = res[1].split(' ')[2]
@@ -72,103 +250,105 @@ class OsmPbfReader:
                 return
 
     def CopyTo(self, output):
-        self._output = output
-        self.parser = OSMParser(concurrency=2,
-                                nodes_callback=self.NodeParse,
-                                ways_callback=self.WayParse,
-                                relations_callback=self.RelationParse)
-        self.parser.parse(self._pbf_file)
-        del self.parser
-        if self._got_error:
-            raise Exception()
+        self._Copy(output, True, True, True)
 
     def CopyWayTo(self, output):
-        self._output = output
-        self.parser = OSMParser(concurrency=2,
-                                nodes_callback=None,
-                                ways_callback=self.WayParse,
-                                relations_callback=None)
-        self.parser.parse(self._pbf_file)
-        del self.parser
-        if self._got_error:
-            raise Exception()
+        self._Copy(output, False, True, False)
 
     def CopyRelationTo(self, output):
+        self._Copy(output, False, False, True)
+
+    def _Blocks(self, nodes, ways, relations):
+        """
+        Iterate over decoded blocks, in file order.
+        Blocks are decoded by a pool of processes, with a bounded number of
+        pending blocks, to keep memory usage low when output is slower
+        than decoding.
+        """
+        jobs = ((pos["filename"], pos["blob_pos"], pos["blob_size"], nodes, ways, relations)
+                for pos in PBFFile(self._pbf_file).blob_offsets())
+
+        if self._concurrency == 1:
+            for job in jobs:
+                yield _DecodeBlock(job)
+            return
+
+        pool = multiprocessing.Pool(self._concurrency)
+        try:
+            pending = collections.deque()
+            for job in jobs:
+                pending.append(pool.apply_async(_DecodeBlock, (job,)))
+                if len(pending) >= 2 * self._concurrency:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _Copy(self, output, nodes, ways, relations):
+        # outputs only storing locations get all nodes, as coordinate arrays,
+        # and nodes with tags when they store them apart
+        coords = nodes and hasattr(output, "NodeCoordCreateMany")
+        if coords:
+            nodes = _NODE_COORDS_TAGS if hasattr(output, "NodeTagCreateMany") else _NODE_COORDS
         self._output = output
-        self.parser = OSMParser(concurrency=2,
-                                nodes_callback=None,
-                                ways_callback=None,
-                                relations_callback=self.RelationParse)
-        self.parser.parse(self._pbf_file)
-        del self.parser
+        for (node_list, way_list, relation_list, timestamp_max) in self._Blocks(nodes, ways, relations):
+            if timestamp_max > self._timestamp_max:
+                self._timestamp_max = timestamp_max
+            if coords:
+                if len(node_list[0][0]):
+                    self._DeliverCoords(node_list[0])
+                if node_list[1]:
+                    self._Deliver(node_list[1], "NodeTagCreate")
+            elif node_list:
+                self._Deliver(node_list, "NodeCreate")
+            if way_list:
+                self._Deliver(way_list, "WayCreate")
+            if relation_list:
+                self._Deliver(relation_list, "RelationCreate")
+            if self._got_error:
+                break
         if self._got_error:
             raise Exception()
+        self._parsed = True
 
-    def NodeParse(self, nodes):
-        if self._got_error:
-            return
-        for node in nodes:
-            data = {}
-            data["id"] = node[0]
-            data["tag"] = node[1]
-            data["lon"] = node[2][0]
-            data["lat"] = node[2][1]
-            if len(node) > 3:
-                data["version"] = node[3]
-                data["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime(node[4]))
-                data["uid"] = node[5]
-            try:
-                self._output.NodeCreate(data)
-            except:
-                print(node, data)
-                print(traceback.format_exc())
-                self._got_error = True
+    def _DeliverCoords(self, coords):
+        """
+        Give (ids, lats, lons) arrays of nodes to output.NodeCoordCreateMany().
+        """
+        try:
+            self._output.NodeCoordCreateMany(*coords)
+        except:
+            print(traceback.format_exc())
+            self._got_error = True
 
-    def WayParse(self, ways):
-        if self._got_error:
-            return
-        for way in ways:
-            data = {}
-            data["id"] = way[0]
-            data["tag"] = way[1]
-            data["nd"] = way[2]
-            if len(way) > 3:
-                data["version"] = way[3]
-                data["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime(way[4]))
-                data["uid"] = way[5]
+    def _Deliver(self, data_list, method):
+        """
+        Give a list of objects to output, with a single call to
+        output.<method>Many(list) if available, else one by one.
+        """
+        many = getattr(self._output, method + "Many", None)
+        if many:
             try:
-                self._output.WayCreate(data)
+                many(data_list)
             except:
-                print(way, data)
                 print(traceback.format_exc())
                 self._got_error = True
-
-    def RelationParse(self, relations):
-        if self._got_error:
             return
-        for relation in relations:
-            data = {}
-            data["id"] = relation[0]
-            data["tag"] = relation[1]
-            if len(relation) > 3:
-                data["version"] = relation[3]
-                data["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime(relation[4]))
-                data["uid"] = relation[5]
-            data["member"] = []
-            for (ref, type, role) in relation[2]:
-                attrs = { "ref": int(ref),
-                          "role": role,
-                          "type": type,
-                        }
-
-                data["member"].append(attrs)
 
+        create = getattr(self._output, method)
+        for data in data_list:
             try:
-                self._output.RelationCreate(data)
+                create(data)
             except:
                 print(data)
                 print(traceback.format_exc())
                 self._got_error = True
+                return
 
 
 ###########################################################################
@@ -189,6 +369,42 @@ class TestCountObjects:
     def RelationCreate(self, data):
         self.num_rels += 1
 
+class TestRecordObjects:
+    def __init__(self):
+        self.objects = []
+
+    def NodeCreate(self, data):
+        self.objects.append(("node", data))
+
+    def WayCreate(self, data):
+        self.objects.append(("way", data))
+
+    def RelationCreate(self, data):
+        self.objects.append(("relation", data))
+
+class TestRecordBatches:
+    def __init__(self):
+        self.batches = []
+
+    def NodeCreateMany(self, data_list):
+        self.batches.append(("node", data_list))
+
+    def WayCreateMany(self, data_list):
+        self.batches.append(("way", data_list))
+
+    def RelationCreateMany(self, data_list):
+        self.batches.append(("relation", data_list))
+
+class TestRecordCoords(TestRecordObjects):
+    def NodeCoordCreateMany(self, ids, lats, lons):
+        for (i, lat, lon) in zip(ids, lats, lons):
+            self.objects.append(("coord", (i, lat, lon)))
+
+class TestRecordCoordsTags(TestRecordCoords):
+    def NodeTagCreateMany(self, data_list):
+        for data in data_list:
+            self.objects.append(("node", data))
+
 class Test(unittest.TestCase):
     def test_copy_all(self):
         i1 = OsmPbfReader("tests/saint_barthelemy.osm.pbf")
@@ -214,3 +430,72 @@ class Test(unittest.TestCase):
         self.assertEquals(o1.num_nodes, 0)
         self.assertEquals(o1.num_ways, 0)
         self.assertEquals(o1.num_rels, 16)
+
+    def test_concurrency(self):
+        o1 = TestRecordObjects()
+        OsmPbfReader("tests/saint_barthelemy.osm.pbf", concurrency=1).CopyTo(o1)
+        o2 = TestRecordObjects()
+        OsmPbfReader("tests/saint_barthelemy.osm.pbf", concurrency=3).CopyTo(o2)
+        self.assertEquals(len(o1.objects), 83 + 625 + 16)
+        self.assertEquals(o1.objects, o2.objects)
+        ways = [data["id"] for (t, data) in o2.objects if t == "way"]
+        self.assertEquals(ways, sorted(ways))
+
+    def test_batches(self):
+        o1 = TestRecordObjects()
+        OsmPbfReader("tests/saint_barthelemy.osm.pbf").CopyTo(o1)
+        o2 = TestRecordBatches()
+        OsmPbfReader("tests/saint_barthelemy.osm.pbf").CopyTo(o2)
+        self.assertEquals(o1.objects, [(t, data) for (t, data_list) in o2.batches for data in data_list])
+
+    def test_coords(self):
+        o1 = TestRecordObjects()
+        OsmPbfReader("tests/saint_barthelemy.osm.pbf").CopyTo(o1)
+        o2 = TestRecordCoords()
+        OsmPbfReader("tests/saint_barthelemy.osm.pbf", concurrency=2).CopyTo(o2)
+        coords = [data for (t, data) in o2.objects if t == "coord"]
+        self.assertEquals(len(coords), 8076)
+        self.assertEquals([i for (i, lat, lon) in coords], sorted(i for (i, lat, lon) in coords))
+        # all nodes with tags are given as coordinates
+        coords = dict((i, (lat, lon)) for (i, lat, lon) in coords)
+        for (t, data) in o1.objects:
+            if t == "node":
+                self.assertEquals(coords[data["id"]], (data["lat"], data["lon"]))
+        self.assertEquals([(t, data) for (t, data) in o1.objects if t != "node"],
+                          [(t, data) for (t, data) in o2.objects if t != "coord"])
+
+    def test_coords_tags(self):
+        o1 = TestRecordObjects()
+        OsmPbfReader("tests/saint_barthelemy.osm.pbf").CopyTo(o1)
+        o2 = TestRecordCoordsTags()
+        OsmPbfReader("tests/saint_barthelemy.osm.pbf", concurrency=2).CopyTo(o2)
+        self.assertEquals(len([data for (t, data) in o2.objects if t == "coord"]), 8076)
+        self.assertEquals(o1.objects, [(t, data) for (t, data) in o2.objects if t != "coord"])
+
+    def test_error(self):
+        class Output(TestCountObjects):
+            def WayCreate(self, data):
+                raise ValueError()
+        o1 = Output()
+        with self.assertRaises(Exception):
+            OsmPbfReader("tests/saint_barthelemy.osm.pbf", concurrency=2).CopyTo(o1)
+        self.assertEquals(o1.num_nodes, 83)
+
+    def test_timestamp_header(self):
+        import os, tempfile
+        (fd, filename) = tempfile.mkstemp(suffix=".osm.pbf")
+        os.close(fd)
+        try:
+            res = getstatusoutput("%s tests/saint_barthelemy.osm.pbf --timestamp=2014-01-16T01:02:03Z -o=%s" % (config.bin_osmconvert, filename))
+            self.assertEquals(res[0], 0)
+            i1 = OsmPbfReader(filename)
+            self.assertEquals(i1.timestamp(), dateutil.parser.parse("2014-01-16T01:02:03Z"))
+        finally:
+            os.remove(filename)
+
+    def test_timestamp_data(self):
+        i1 = OsmPbfReader("tests/saint_barthelemy.osm.pbf")
+        # no timestamp in header, data are not read yet
+        self.assertEquals(i1.timestamp(), None)
+        i1.CopyTo(TestCountObjects())
+        self.assertEquals(i1.timestamp(), dateutil.parser.parse("2014-01-15T19:05:08Z"))
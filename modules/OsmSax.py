@@ -19,20 +19,13 @@
 ##                                                                       ##
 ###########################################################################
 
-import bz2, gzip, cStringIO
+import bz2, gzip, cStringIO, multiprocessing, re
 from xml.sax import make_parser, handler
+from xml.parsers import expat
 from xml.sax.saxutils import XMLGenerator, quoteattr
 import dateutil.parser
 import config
-
-try:
-    # For Python 3.0 and later
-    import subprocess
-    getstatusoutput = subprocess.getstatusoutput
-except:
-    # Fall back to Python 2
-    import commands
-    getstatusoutput = commands.getstatusoutput
+import Decompress
 
 ###########################################################################
 
@@ -62,6 +55,37 @@ class dummyout:
 class OsmSaxNotXMLFile(Exception):
     pass
 
+ReOsmTimestamp = re.compile("<osm\\s[^>]*\\btimestamp=[\"']([^\"']+)[\"']")
+
+def _DecompressThreads():
+    if config.decompress_threads is None:
+        # with a single CPU, decompressing threads only compete with the
+        # parsing for it
+        cpus = multiprocessing.cpu_count()
+        return cpus if cpus > 1 else 0
+    return config.decompress_threads
+
+def _OpenFile(filename):
+    if filename.endswith(".bz2") or filename.endswith(".gz"):
+        threads = _DecompressThreads()
+        if threads != 0:
+            return Decompress.DecompressFile(filename, threads)
+        elif filename.endswith(".bz2"):
+            return bz2.BZ2File(filename)
+        else:
+            return gzip.open(filename)
+    else:
+        return open(filename)
+
+def _OpenFileHeader(filename):
+    # no decompressing threads to only read the first bytes
+    if filename.endswith(".bz2"):
+        return bz2.BZ2File(filename)
+    elif filename.endswith(".gz"):
+        return gzip.open(filename)
+    else:
+        return open(filename)
+
 class OsmSaxReader(handler.ContentHandler):
 
     def log(self, txt):
@@ -70,31 +94,33 @@ class OsmSaxReader(handler.ContentHandler):
     def __init__(self, filename, logger = dummylog()):
         self._filename = filename
         self._logger   = logger
+        self._timestamp_max = None
 
         # check if file begins with an xml tag
-        f = self._GetFile()
-        line = f.readline()
+        if isinstance(filename, basestring):
+            with _OpenFileHeader(filename) as f:
+                line = f.readline()
+        else:
+            line = filename.readline()
         if not line.startswith("<?xml"):
             raise OsmSaxNotXMLFile("File %s is not XML" % filename)
 
     def timestamp(self):
-        try:
-            # Compute max timestamp from data
-            res = getstatusoutput("%s %s --out-statistics | grep 'timestamp max'" % (config.bin_osmconvert, self._filename))
-            if not res[0]:
-                s = res[1].split(' ')[2]
-                return dateutil.parser.parse(s)
-        except:
-            return
+        """
+        Timestamp from <osm> root element, or when missing, max timestamp of
+        objects read by a previous CopyTo().
+        """
+        if isinstance(self._filename, basestring):
+            with _OpenFileHeader(self._filename) as f:
+                m = ReOsmTimestamp.search(f.read(4096))
+            if m:
+                return dateutil.parser.parse(m.group(1))
+        if self._timestamp_max:
+            return dateutil.parser.parse(self._timestamp_max)
 
     def _GetFile(self):
         if isinstance(self._filename, basestring):
-            if self._filename.endswith(".bz2"):
-                return bz2.BZ2File(self._filename)
-            elif self._filename.endswith(".gz"):
-                return gzip.open(self._filename)
-            else:
-                return open(self._filename)
+            return _OpenFile(self._filename)
         else:
             return self._filename
         
@@ -158,6 +184,8 @@ class OsmSaxReader(handler.ContentHandler):
     def endElement(self, name):
         if name == u"node":
             self._data[u"tag"] = self._tags
+            if self._data.get(u"timestamp") > self._timestamp_max:
+                self._timestamp_max = self._data[u"timestamp"]
             try:
                 self._output.NodeCreate(self._data)
             except:
@@ -166,6 +194,8 @@ class OsmSaxReader(handler.ContentHandler):
         elif name == u"way":
             self._data[u"tag"] = self._tags
             self._data[u"nd"]  = self._nodes
+            if self._data.get(u"timestamp") > self._timestamp_max:
+                self._timestamp_max = self._data[u"timestamp"]
             try:
                 self._output.WayCreate(self._data)
             except:
@@ -174,6 +204,8 @@ class OsmSaxReader(handler.ContentHandler):
         elif name == u"relation":
             self._data[u"tag"]    = self._tags
             self._data[u"member"] = self._members
+            if self._data.get(u"timestamp") > self._timestamp_max:
+                self._timestamp_max = self._data[u"timestamp"]
             try:
                 self._output.RelationCreate(self._data)
             except:
@@ -194,12 +226,8 @@ class OscSaxReader(handler.ContentHandler):
     def _GetFile(self):
         if type(self._filename) == file:
             return self._filename
-        elif self._filename.endswith(".bz2"):
-            return bz2.BZ2File(self._filename)
-        elif self._filename.endswith(".gz"):
-            return gzip.open(self._filename)
         else:
-            return open(self._filename)
+            return _OpenFile(self._filename)
         
     def CopyTo(self, output):
         self._output = output
@@ -271,6 +299,120 @@ class OscSaxReader(handler.ContentHandler):
                 self._output.RelationDelete(self._data)  
             return
 
+###########################################################################
+## Expat readers
+##
+## Same output as OsmSaxReader/OscSaxReader, but the document is fed to
+## pyexpat by large blocks, and elements are handled without going through
+## the xml.sax layer. Attributes dict given by expat is used as is for the
+## object data, and tag keys and member roles are interned.
+
+def _expatParse(f, handler, buffer_size = 2**20):
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = handler.startElement
+    parser.EndElementHandler   = handler.endElement
+    read = f.read
+    while True:
+        data = read(buffer_size)
+        if not data:
+            break
+        parser.Parse(data, False)
+    parser.Parse("", True)
+
+class OsmExpatReader(OsmSaxReader):
+
+    def CopyTo(self, output):
+        self._debug_in_way      = False
+        self._debug_in_relation = False
+        self.log("starting nodes")
+        self._output  = output
+        self._strings = {}
+        _expatParse(self._GetFile(), self)
+        del self._strings
+
+    def startElement(self, name, attrs):
+        if name == u"nd":
+            self._nodes.append(int(attrs[u"ref"]))
+        elif name == u"tag":
+            k = attrs[u"k"]
+            self._tags[self._strings.setdefault(k, k)] = attrs[u"v"]
+        elif name == u"node":
+            attrs[u"id"]  = int(attrs[u"id"])
+            attrs[u"lat"] = float(attrs[u"lat"])
+            attrs[u"lon"] = float(attrs[u"lon"])
+            if u"version" in attrs:
+                attrs[u"version"] = int(attrs[u"version"])
+            self._data = attrs
+            self._tags = {}
+        elif name == u"member":
+            attrs[u"ref"] = int(attrs[u"ref"])
+            role = attrs[u"role"]
+            attrs[u"role"] = self._strings.setdefault(role, role)
+            self._members.append(attrs)
+        elif name == u"way":
+            if not self._debug_in_way:
+                self._debug_in_way = True
+                self.log("starting ways")
+            attrs[u"id"] = int(attrs[u"id"])
+            if u"version" in attrs:
+                attrs[u"version"] = int(attrs[u"version"])
+            self._data  = attrs
+            self._tags  = {}
+            self._nodes = []
+        elif name == u"relation":
+            if not self._debug_in_relation:
+                self._debug_in_relation = True
+                self.log("starting relations")
+            attrs[u"id"] = int(attrs[u"id"])
+            if u"version" in attrs:
+                attrs[u"version"] = int(attrs[u"version"])
+            self._data    = attrs
+            self._members = []
+            self._tags    = {}
+        elif name == u"changeset":
+            self._tags = {}
+
+class OscExpatReader(OscSaxReader):
+
+    def CopyTo(self, output):
+        self._output  = output
+        self._strings = {}
+        _expatParse(self._GetFile(), self)
+        del self._strings
+
+    def startElement(self, name, attrs):
+        if name == u"nd":
+            self._nodes.append(int(attrs[u"ref"]))
+        elif name == u"tag":
+            k = attrs[u"k"]
+            self._tags[self._strings.setdefault(k, k)] = attrs[u"v"]
+        elif name == u"node":
+            attrs[u"id"]      = int(attrs[u"id"])
+            attrs[u"lat"]     = float(attrs[u"lat"])
+            attrs[u"lon"]     = float(attrs[u"lon"])
+            attrs[u"version"] = int(attrs[u"version"])
+            self._data = attrs
+            self._tags = {}
+        elif name == u"member":
+            attrs[u"ref"] = int(attrs[u"ref"])
+            role = attrs[u"role"]
+            attrs[u"role"] = self._strings.setdefault(role, role)
+            self._members.append(attrs)
+        elif name == u"way":
+            attrs[u"id"]      = int(attrs[u"id"])
+            attrs[u"version"] = int(attrs[u"version"])
+            self._data  = attrs
+            self._tags  = {}
+            self._nodes = []
+        elif name == u"relation":
+            attrs[u"id"]      = int(attrs[u"id"])
+            attrs[u"version"] = int(attrs[u"version"])
+            self._data    = attrs
+            self._members = []
+            self._tags    = {}
+        elif name in (u"create", u"modify", u"delete"):
+            self._action = name
+
 ###########################################################################
 
 def _formatData(data):
@@ -392,6 +534,26 @@ def RelationToXml(data, full = False):
 ###########################################################################
 import unittest
 
+class TestRecordObjects:
+    def __init__(self):
+        self.objects = []
+
+    def NodeCreate(self, data):
+        self.objects.append(("node", data))
+
+    def WayCreate(self, data):
+        self.objects.append(("way", data))
+
+    def RelationCreate(self, data):
+        self.objects.append(("relation", data))
+
+    NodeUpdate = NodeCreate
+    NodeDelete = NodeCreate
+    WayUpdate = WayCreate
+    WayDelete = WayCreate
+    RelationUpdate = RelationCreate
+    RelationDelete = RelationCreate
+
 class TestCountObjects:
     def __init__(self):
         self.num_nodes = 0
@@ -455,3 +617,107 @@ class Test(unittest.TestCase):
         self.assertEquals(o1.num_ways, 625)
         self.assertEquals(o1.num_rels, 16)
         io.close()
+
+    def test_expat_bz2(self):
+        i1 = OsmExpatReader("tests/saint_barthelemy.osm.bz2")
+        o1 = TestCountObjects()
+        i1.CopyTo(o1)
+        self.assertEquals(o1.num_nodes, 8076)
+        self.assertEquals(o1.num_ways, 625)
+        self.assertEquals(o1.num_rels, 16)
+
+    def test_expat_file(self):
+        f = gzip.open("tests/saint_barthelemy.osm.gz")
+        i1 = OsmExpatReader(f)
+        o1 = TestCountObjects()
+        i1.CopyTo(o1)
+        self.assertEquals(o1.num_nodes, 8076)
+        self.assertEquals(o1.num_ways, 625)
+        self.assertEquals(o1.num_rels, 16)
+
+    def test_timestamp(self):
+        i1 = OsmExpatReader("tests/saint_barthelemy.osm.gz")
+        # no timestamp on <osm>, data are not read yet
+        self.assertEquals(i1.timestamp(), None)
+        i1.CopyTo(TestCountObjects())
+        self.assertEquals(i1.timestamp(), dateutil.parser.parse("2014-01-15T19:05:08Z"))
+
+    def test_timestamp_header(self):
+        import os, tempfile
+        (fd, filename) = tempfile.mkstemp(suffix=".osm")
+        os.write(fd, """<?xml version='1.0' encoding='UTF-8'?>
+<osm version="0.6" generator="osmconvert 0.7L" timestamp="2014-01-16T01:02:03Z">
+	<node id="266053077" lat="17.9031745" lon="-62.8363074" version="2" timestamp="2013-01-03T16:21:31Z"/>
+</osm>
+""")
+        os.close(fd)
+        try:
+            i1 = OsmExpatReader(filename)
+            self.assertEquals(i1.timestamp(), dateutil.parser.parse("2014-01-16T01:02:03Z"))
+        finally:
+            os.remove(filename)
+
+    def test_timestamp_header_compressed(self):
+        import os, shutil, tempfile, threading
+        dir = tempfile.mkdtemp()
+        old = config.decompress_threads
+        try:
+            config.decompress_threads = 2
+            data = open("tests/saint_barthelemy.osm.bz2").read()
+            data = bz2.decompress(data).replace("<osm ", '<osm timestamp="2014-01-16T01:02:03Z" ', 1)
+            with bz2.BZ2File(os.path.join(dir, "test.osm.bz2"), "w") as f:
+                f.write(data)
+            with gzip.open(os.path.join(dir, "test.osm.gz"), "w") as f:
+                f.write(data)
+            threads = threading.active_count()
+            for name in ("test.osm.bz2", "test.osm.gz"):
+                i1 = OsmExpatReader(os.path.join(dir, name))
+                self.assertEquals(i1.timestamp(), dateutil.parser.parse("2014-01-16T01:02:03Z"))
+                # header read without decompressing the whole file in threads
+                self.assertEquals(threading.active_count(), threads)
+        finally:
+            config.decompress_threads = old
+            shutil.rmtree(dir)
+
+    def test_expat_same_as_sax(self):
+        o1 = TestRecordObjects()
+        OsmSaxReader("tests/saint_barthelemy.osm.gz").CopyTo(o1)
+        o2 = TestRecordObjects()
+        OsmExpatReader("tests/saint_barthelemy.osm.gz").CopyTo(o2)
+        self.assertEquals(len(o1.objects), 8717)
+        self.assertEquals(o1.objects, o2.objects)
+
+    def test_osc_expat_same_as_sax(self):
+        o1 = TestRecordObjects()
+        OscSaxReader("tests/saint_barthelemy.osc.gz").CopyTo(o1)
+        o2 = TestRecordObjects()
+        OscExpatReader("tests/saint_barthelemy.osc.gz").CopyTo(o2)
+        self.assertEquals(len(o1.objects), 14)
+        self.assertEquals(o1.objects, o2.objects)
+
+    def test_decompress_same_as_inline(self):
+        old = config.decompress_threads
+        try:
+            config.decompress_threads = 0
+            o1 = TestRecordObjects()
+            OsmExpatReader("tests/saint_barthelemy.osm.bz2").CopyTo(o1)
+            config.decompress_threads = 2
+            o2 = TestRecordObjects()
+            OsmExpatReader("tests/saint_barthelemy.osm.bz2").CopyTo(o2)
+        finally:
+            config.decompress_threads = old
+        self.assertEquals(len(o1.objects), 8717)
+        self.assertEquals(o1.objects, o2.objects)
+
+    def test_decompress_threads(self):
+        old = (config.decompress_threads, multiprocessing.cpu_count)
+        try:
+            config.decompress_threads = None
+            multiprocessing.cpu_count = lambda: 1
+            self.assertEquals(_DecompressThreads(), 0)
+            multiprocessing.cpu_count = lambda: 4
+            self.assertEquals(_DecompressThreads(), 4)
+            config.decompress_threads = 2
+            self.assertEquals(_DecompressThreads(), 2)
+        finally:
+            (config.decompress_threads, multiprocessing.cpu_count) = old
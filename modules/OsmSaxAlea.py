@@ -20,266 +20,269 @@
 ###########################################################################
 
 import OsmSax
-import re, os
+import Decompress
+import array, bisect, itertools, mmap, os, re, struct, sys, tempfile, zlib
 
 ###########################################################################
-## find functions
+## Index of objects offsets
 
 ReGetId = re.compile(" id=[\"']([0-9]+)[\"'][ />]")
+ReElement = re.compile("^[ \t]*<(node|way|relation|/osm)[ />]", re.M)
 
-def get_node_start(fd):
-    fd.seek(0)
-    st = 0
-    while True:
-        line = fd.readline()
-        if line.strip().startswith("<node"):
-            return st
-        st += len(line)
-
-def get_way_start(fd):
-    b_min = 0
-    b_max = get_file_last_line(fd)
-    while True:
-        b_cur = (b_min+b_max)/2
-        fd.seek(b_cur)
-        fd.readline()
-        while True:
-            line = fd.readline().strip()
-            if (line == "</node>") or (line.startswith("<node") and line.endswith("/>")):
-                b_min = b_cur
-                break
-            if line == "</way>":
-                b_max = b_cur
-                break
-            if line == "</relation>":
-                b_max = b_cur
-                break
-            if line == "</osm>":
-                b_max = b_cur
-                break
-        if b_max - b_min <= 1:
-            break
-    fd.seek(b_max)
-    b_max += len(fd.readline())
-    return b_max
-
-def get_relation_start(fd):
-    b_min = 0
-    b_max = get_file_last_line(fd)
-    while True:
-        b_cur = (b_min+b_max)/2
-        fd.seek(b_cur)
-        fd.readline()
-        while True:
-            line = fd.readline().strip()
-            if (line == "</node>") or (line.startswith("<node") and line.endswith("/>")):
-                b_min = b_cur
-                break
-            if line == "</way>":
-                b_min = b_cur
-                break
-            if line == "</relation>":
-                b_max = b_cur
-                break
-            if line == "</osm>":
-                b_max = b_cur
-                break
-        if b_max - b_min <= 1:
-            break
-    fd.seek(b_max)
-    b_max += len(fd.readline())
-    return b_max
-
-def get_node_id_start(fd, nodeid):
-    b_min = 0
-    b_max = get_file_last_line(fd)
-    seq_read = False
-    prev_seq_read = False
-    while True:
-        if seq_read == True:
-            b_cur = b_min
-            prev_seq_read = True
-        else:
-            b_cur = (b_min+b_max)/2
-        fd.seek(b_cur)
-
-        while True:
-            line = fd.readline().strip()
-            line_len = len(line)
-            if line.startswith("<node "):
-                nid = int(ReGetId.findall(line)[0])
-                if nid < nodeid:
-                    if b_cur >= b_max:
-                        b_max *= 2
-                    b_min = b_cur + line_len
-                    break
-                if nid > nodeid:
-                    if b_max <= b_cur:
-			# switch to sequential read if b_cur is in the middle
-			# of the wanted element
-                        seq_read = True
-                    b_max = b_cur
-                    break
-                fd.seek(b_cur)
-                while True:
-                    line = fd.readline()
-                    if line.strip().startswith("<node "):
-                        return b_cur
-                    b_cur += len(line)
-            if (line.startswith("<way ") or line.startswith("<relation ") or
-                     line.startswith("</osm>") or line_len == 0):
-                if b_max <= b_cur:
-                    # switch to sequential read if b_cur is in the middle
-                    # of the wanted element
-                    seq_read = True
-                b_max = b_cur
-                break
-            b_cur += line_len
-        if b_max - b_min <= 1 or (prev_seq_read and b_cur == b_max):
-            return None
+_INDEX_MAGIC = "OSMALEA1"
+# magic, source file size and mtime, offsets of nodes, ways, relations and
+# </osm>, numbers of nodes, ways, relations and seek points
+_Header = struct.Struct("<8s10q")
+_Int = struct.Struct("<q")
+# array typecode of int64 on 64 bits platforms, Python 2 has no "q"
+_INT64 = "l"
 
-def get_way_id_start(fd, wayid):
-    b_min = 0
-    b_max = get_file_last_line(fd)
-    seq_read = False
-    prev_seq_read = False
-    while True:
-        if seq_read == True:
-            b_cur = b_min
-            prev_seq_read = True
-        else:
-            b_cur = (b_min+b_max)/2
-        fd.seek(b_cur)
-        while True:
-            line = fd.readline().strip()
-            line_len = len(line)
-            if line.startswith("<node "):
-                if b_cur >= b_max:
-                    b_max *= 2
-                b_min = b_cur + line_len
-                break
-            if line.startswith("<way "):
-                wid = int(ReGetId.findall(line)[0])
-                if wid < wayid:
-                    if b_cur >= b_max:
-                        b_max *= 2
-                    b_min = b_cur + line_len
-                    break
-                if wid > wayid:
-                    if b_max <= b_cur:
-			# switch to sequential read if b_cur is in the middle
-			# of the wanted element
-                        seq_read = True
-                    b_max = b_cur
-                    break
-                fd.seek(b_cur)
-                while True:
-                    line = fd.readline()
-                    if line.strip().startswith("<way "):
-                        return b_cur
-                    b_cur += len(line)
-            if line.startswith("<relation ") or line.startswith("</osm>") or line_len == 0:
-                if b_max <= b_cur:
-                    # switch to sequential read if b_cur is in the middle
-                    # of the wanted element
-                    seq_read = True
-                b_max = b_cur
-                break
-            b_cur += line_len
-        if b_max - b_min <= 1 or (prev_seq_read and b_cur == b_max):
-            return None
+class _Array(object):
+    """
+    Packed array of int64 in a buffer.
+    """
 
-def get_relation_id_start(fd, relationid):
-    b_min = 0
-    b_max = get_file_last_line(fd)
-    seq_read = False
-    prev_seq_read = False
-    while True:
-        if seq_read == True:
-            b_cur = b_min
-            prev_seq_read = True
+    def __init__(self, buf, pos, length):
+        self._buf = buf
+        self._pos = pos
+        self._len = length
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+        return _Int.unpack_from(self._buf, self._pos + 8*i)[0]
+
+class _SeekPoints(object):
+    """
+    Seek points (compressed offset, bits, window) of a gzip file, with
+    compressed windows, in a buffer.
+    """
+
+    def __init__(self, buf, pos, length):
+        self._buf = buf
+        self._in = _Array(buf, pos, length)
+        self._bits = _Array(buf, pos + 8*length, length)
+        self._window_pos = _Array(buf, pos + 16*length, length)
+        self._window_len = _Array(buf, pos + 24*length, length)
+
+    def __len__(self):
+        return len(self._in)
+
+    def __getitem__(self, i):
+        window_pos = self._window_pos[i]
+        window = zlib.decompress(self._buf[window_pos:window_pos + self._window_len[i]])
+        return (self._in[i], self._bits[i], window)
+
+class OsmIndex:
+    """
+    Offsets of nodes, ways and relations in an OSM file, sorted by id, and
+    for gzip files, points where decompression can restart. Built on first
+    use by a sequential read of the file, and saved next to it as packed
+    arrays, memory-mapped when reopened.
+    """
+
+    def __init__(self, filename, logger = OsmSax.dummylog()):
+        self._filename = filename
+        self._logger   = logger
+        st = os.stat(filename)
+        self._source = (st.st_size, int(st.st_mtime))
+        self._index_filename = filename + ".idx"
+        try:
+            with open(self._index_filename, "rb") as f:
+                if self._Load(f):
+                    return
+        except (IOError, OSError):
+            pass
+
+        try:
+            tmp = "%s.%d.tmp" % (self._index_filename, os.getpid())
+            with open(tmp, "wb") as f:
+                self._Build(f)
+            os.rename(tmp, self._index_filename)
+            with open(self._index_filename, "rb") as f:
+                self._Load(f)
+        except (IOError, OSError):
+            # can't write next to the OSM file, keep index in a temporary file
+            self._logger.log("can't write index %s, using a temporary file" % self._index_filename)
+            with tempfile.TemporaryFile() as f:
+                self._Build(f)
+                f.flush()
+                self._Load(f)
+
+    def _Load(self, f):
+        if os.fstat(f.fileno()).st_size < _Header.size:
+            return False
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _Header.unpack_from(buf, 0)
+        if header[0] != _INDEX_MAGIC or header[1:3] != self._source:
+            buf.close()
+            return False
+
+        (self.node_start, self.way_start, self.relation_start, self.end) = header[3:7]
+        pos = _Header.size
+        self._ids = {}
+        self._offsets = {}
+        for (kind, length) in zip(("node", "way", "relation"), header[7:10]):
+            self._ids[kind] = _Array(buf, pos, length)
+            self._offsets[kind] = _Array(buf, pos + 8*length, length)
+            pos += 16*length
+        length = header[10]
+        self.seek_offsets = _Array(buf, pos, length)
+        self.seek_points = _SeekPoints(buf, pos + 8*length, length)
+        self._buf = buf
+        return True
+
+    def _Build(self, out):
+        self._logger.log("building index of %s" % self._filename)
+        ids = {}
+        offsets = {}
+        for kind in ("node", "way", "relation"):
+            ids[kind] = array.array(_INT64)
+            offsets[kind] = array.array(_INT64)
+        first = {}
+
+        f = open(self._filename, "rb")
+        indexer = None
+        if self._filename.endswith(".gz") and Decompress.GzipSeekable():
+            indexer = Decompress.GzipIndexer(f)
+            chunks = indexer
+        elif self._filename.endswith(".gz") or self._filename.endswith(".bz2"):
+            d = OsmSax._OpenFile(self._filename)
+            chunks = iter(lambda: d.read(2**20), "")
         else:
-            b_cur = (b_min+b_max)/2
-        fd.seek(b_cur)
-        while True:
-            line = fd.readline().strip()
-            line_len = len(line)
-            if line.startswith("<node ") or line.startswith("<way "):
-                if b_cur >= b_max:
-                    b_max *= 2
-                b_min = b_cur + line_len
-                break
-            if line.startswith("<relation "):
-                rid = int(ReGetId.findall(line)[0])
-                if rid < relationid:
-                    if b_cur >= b_max:
-                        b_max *= 2
-                    b_min = b_cur + line_len
-                    break
-                if rid > relationid:
-                    if b_max <= b_cur:
-			# switch to sequential read if b_cur is in the middle
-			# of the wanted element
-                        seq_read = True
-                    b_max = b_cur
-                    break
-                fd.seek(b_cur)
-                while True:
-                    line = fd.readline()
-                    if line.strip().startswith("<relation "):
-                        return b_cur
-                    b_cur += len(line)
-            if line.startswith("</osm>") or line_len == 0:
-                if b_max <= b_cur:
-                    # switch to sequential read if b_cur is in the middle
-                    # of the wanted element
-                    seq_read = True
-                b_max = b_cur
-                break;
-            b_cur += line_len
-        if b_max - b_min <= 1 or (prev_seq_read and b_cur == b_max):
-            return None
+            chunks = iter(lambda: f.read(2**20), "")
 
-def get_file_last_line(fd):
-    return max(0, os.fstat(fd.fileno()).st_size)
+        offset = 0
+        data = ""
+        for chunk in itertools.chain(chunks, ["\n"]):
+            data += chunk
+            # only complete lines
+            cut = data.rfind("\n") + 1
+            for m in ReElement.finditer(data, 0, cut):
+                kind = m.group(1)
+                pos = offset + m.start()
+                if kind not in first:
+                    first[kind] = pos
+                if kind == "/osm":
+                    continue
+                i = ReGetId.search(data, m.end() - 1, data.find("\n", m.end()) + 1)
+                if i:
+                    ids[kind].append(int(i.group(1)))
+                    offsets[kind].append(pos)
+            offset += cut
+            data = data[cut:]
+        f.close()
+        size = offset - 1
+
+        for kind in ("node", "way", "relation"):
+            if any(ids[kind][i] > ids[kind][i+1] for i in xrange(len(ids[kind]) - 1)):
+                order = sorted(xrange(len(ids[kind])), key=ids[kind].__getitem__)
+                ids[kind] = array.array(_INT64, (ids[kind][i] for i in order))
+                offsets[kind] = array.array(_INT64, (offsets[kind][i] for i in order))
+
+        points = indexer.points if indexer else []
+        windows = [zlib.compress(p[3]) for p in points]
+
+        end = first.get("/osm", size)
+        relation_start = first.get("relation", end)
+        way_start = first.get("way", relation_start)
+        node_start = first.get("node", way_start)
+        out.write(_Header.pack(_INDEX_MAGIC, self._source[0], self._source[1],
+                               node_start, way_start, relation_start, end,
+                               len(ids["node"]), len(ids["way"]), len(ids["relation"]), len(points)))
+        pos = _Header.size + 16 * sum(len(a) for a in ids.values()) + 40 * len(points)
+        window_pos = []
+        for w in windows:
+            window_pos.append(pos)
+            pos += len(w)
+        arrays = []
+        for kind in ("node", "way", "relation"):
+            arrays += [ids[kind], offsets[kind]]
+        arrays += [array.array(_INT64, (p[0] for p in points)),
+                   array.array(_INT64, (p[1] for p in points)),
+                   array.array(_INT64, (p[2] for p in points)),
+                   array.array(_INT64, window_pos),
+                   array.array(_INT64, (len(w) for w in windows))]
+        for a in arrays:
+            if sys.byteorder != "little":
+                a.byteswap()
+            a.tofile(out)
+        for w in windows:
+            out.write(w)
+
+    def get(self, kind, id):
+        """
+        Offset of object id of kind node, way or relation, or None.
+        """
+        ids = self._ids[kind]
+        i = bisect.bisect_left(ids, id)
+        if i < len(ids) and ids[i] == id:
+            return self._offsets[kind][i]
 
 ###########################################################################
 
 class OsmSaxReader(OsmSax.OsmSaxReader):
 
-    def _Copy(self, output, get_start, get_end):
+    def __init__(self, filename, logger = OsmSax.dummylog()):
+        OsmSax.OsmSaxReader.__init__(self, filename, logger)
+        self._index = None
+        self._file  = None
+
+    def _GetIndex(self):
+        if not self._index:
+            self._index = OsmIndex(self._filename, self._logger)
+        return self._index
+
+    def _GetSeekFile(self):
+        # kept open, for successive lookups in the same part of the file
+        if not self._file:
+            index = self._GetIndex()
+            if self._filename.endswith(".gz") and len(index.seek_offsets) > 0:
+                self._file = Decompress.GzipSeekFile(self._filename, index.seek_offsets, index.seek_points)
+            else:
+                self._file = self._GetFile()
+        return self._file
+
+    def _Copy(self, output, start, end):
         self._debug_in_way      = True
         self._debug_in_relation = True
         self._output = output
         parser = OsmSax.make_parser()
         parser.setContentHandler(self)
-        f = self._GetFile()
-        start = get_start(f)
-        end   = get_end(f)
-        count = end - start
-        bs    = 1024
+        f = self._GetSeekFile()
         f.seek(start)
+        count = end - start
+        bs    = 2**20
         parser.feed("<?xml version='1.0' encoding='UTF-8'?>")
         parser.feed("<osm>")
-        for i in range(count/bs):
-            parser.feed(f.read(bs))
-        parser.feed(f.read(count-bs*int(count/bs)))
+        while count > 0:
+            data = f.read(min(bs, count))
+            if not data:
+                break
+            parser.feed(data)
+            count -= len(data)
         parser.feed("</osm>")
-                                        
+
     def CopyNodeTo(self, output):
-        return self._Copy(output, get_node_start, get_way_start)
-        
+        index = self._GetIndex()
+        return self._Copy(output, index.node_start, index.way_start)
+
     def CopyWayTo(self, output):
-        return self._Copy(output, get_way_start, get_relation_start)
-    
+        index = self._GetIndex()
+        return self._Copy(output, index.way_start, index.relation_start)
+
     def CopyRelationTo(self, output):
-        return self._Copy(output, get_relation_start, get_file_last_line)
+        index = self._GetIndex()
+        return self._Copy(output, index.relation_start, index.end)
+
+    def _Get(self, start):
 
-    def _Get(self, start):        
-        
         if start == None:
             return None
-        
+
         class _output:
             data = None
             def NodeCreate(self, data):
@@ -293,33 +296,70 @@ class OsmSaxReader(OsmSax.OsmSaxReader):
         self._output = _output()
         parser = OsmSax.make_parser()
         parser.setContentHandler(self)
-        parser.feed("<?xml version='1.0' encoding='UTF-8'?>")        
+        parser.feed("<?xml version='1.0' encoding='UTF-8'?>")
 
-        f = self._GetFile()
+        f = self._GetSeekFile()
         f.seek(start)
         while not self._output.data:
             parser.feed(f.readline())
         return self._output.data
-        
+
     def NodeGet(self, NodeId):
-        start = get_node_id_start(self._GetFile(), NodeId)
-        return self._Get(start)
+        return self._Get(self._GetIndex().get("node", NodeId))
 
     def WayGet(self, WayId):
-        start = get_way_id_start(self._GetFile(), WayId)
-        return self._Get(start)
+        return self._Get(self._GetIndex().get("way", WayId))
 
     def RelationGet(self, RelationId):
-        start = get_relation_id_start(self._GetFile(), RelationId)
-        return self._Get(start)
+        return self._Get(self._GetIndex().get("relation", RelationId))
 
     def UserGet(self, UserId):
         return None
 
 ###########################################################################
 import unittest
+import gzip
+import shutil
+
+class TestLog:
+    def __init__(self):
+        self.messages = []
+
+    def log(self, text):
+        self.messages.append(text)
+
+class TestCountObjects:
+    def __init__(self):
+        self.num_nodes = 0
+        self.num_ways = 0
+        self.num_rels = 0
+
+    def NodeCreate(self, data):
+        self.num_nodes += 1
+
+    def WayCreate(self, data):
+        self.num_ways += 1
+
+    def RelationCreate(self, data):
+        self.num_rels += 1
 
 class Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # indexes are written next to the files
+        cls.dir = tempfile.mkdtemp()
+        cls.gz = os.path.join(cls.dir, "saint_barthelemy.osm.gz")
+        shutil.copy("tests/saint_barthelemy.osm.gz", cls.gz)
+        cls.bz2 = os.path.join(cls.dir, "saint_barthelemy.osm.bz2")
+        shutil.copy("tests/saint_barthelemy.osm.bz2", cls.bz2)
+        cls.osm = os.path.join(cls.dir, "saint_barthelemy.osm")
+        with open(cls.osm, "wb") as f:
+            f.write(gzip.open(cls.gz).read())
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
     def check(self, func, id, exists=True):
         res = func(id)
         if exists:
@@ -334,7 +374,7 @@ class Test(unittest.TestCase):
             assert not res
 
     def test_node(self):
-        i1 = OsmSaxReader("tests/saint_barthelemy.osm.gz")
+        i1 = OsmSaxReader(self.gz)
         self.check(i1.NodeGet, 266053077)
         self.check(i1.NodeGet, 2619283351)
         self.check(i1.NodeGet, 2619283352)
@@ -343,7 +383,7 @@ class Test(unittest.TestCase):
         self.check(i1.NodeGet, 2619283353, False)
 
     def test_way(self):
-        i1 = OsmSaxReader("tests/saint_barthelemy.osm.gz")
+        i1 = OsmSaxReader(self.gz)
         self.check(i1.WayGet, 24473155)
         self.check(i1.WayGet, 53599877, False)
         self.check(i1.WayGet, 255316725)
@@ -352,9 +392,53 @@ class Test(unittest.TestCase):
         self.check(i1.WayGet, 255316726, False)
 
     def test_relation(self):
-        i1 = OsmSaxReader("tests/saint_barthelemy.osm.gz")
+        i1 = OsmSaxReader(self.gz)
         self.check(i1.RelationGet, 47796)
         self.check(i1.RelationGet, 2707693)
         self.check(i1.RelationGet, 1, False)
         self.check(i1.RelationGet, 47795, False)
         self.check(i1.RelationGet, 2707694, False)
+
+    def test_formats(self):
+        for filename in (self.osm, self.bz2):
+            i1 = OsmSaxReader(filename)
+            self.check(i1.NodeGet, 266053077)
+            self.check(i1.WayGet, 255316725)
+            self.check(i1.RelationGet, 2707693)
+            self.check(i1.RelationGet, 47795, False)
+
+    def test_same_as_gz(self):
+        i1 = OsmSaxReader(self.gz)
+        i2 = OsmSaxReader(self.osm)
+        for id in (266053077, 1554852345, 2619283351):
+            self.assertEquals(i1.NodeGet(id), i2.NodeGet(id))
+        for id in (24473155, 142061833, 255316725):
+            self.assertEquals(i1.WayGet(id), i2.WayGet(id))
+
+    def test_copy(self):
+        for filename in (self.gz, self.osm):
+            i1 = OsmSaxReader(filename)
+            o1 = TestCountObjects()
+            i1.CopyNodeTo(o1)
+            i1.CopyWayTo(o1)
+            i1.CopyRelationTo(o1)
+            self.assertEquals(o1.num_nodes, 8076)
+            self.assertEquals(o1.num_ways, 625)
+            self.assertEquals(o1.num_rels, 16)
+
+    def test_index_reopen(self):
+        OsmIndex(self.gz)
+        log = TestLog()
+        index = OsmIndex(self.gz, log)
+        self.assertEquals(log.messages, [])
+        self.assertTrue(len(index.seek_offsets) > 0)
+        self.assertEquals(index.get("node", 266053077), index.node_start)
+
+    def test_index_outdated(self):
+        OsmIndex(self.osm)
+        st = os.stat(self.osm)
+        os.utime(self.osm, (st.st_atime, st.st_mtime + 10))
+        log = TestLog()
+        index = OsmIndex(self.osm, log)
+        self.assertEquals(log.messages, ["building index of %s" % self.osm])
+        self.assertEquals(index.get("node", 266053077), index.node_start)
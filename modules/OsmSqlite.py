@@ -0,0 +1,270 @@
+#-*- coding: utf-8 -*-
+
+###########################################################################
+##                                                                       ##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+##                                                                       ##
+###########################################################################
+
+import OsmSax
+import marshal, os, sqlite3, tempfile
+
+###########################################################################
+## Store of objects by id
+
+_STORE_VERSION = 1
+_Tables = ("node", "way", "relation")
+
+class _StoreWriter:
+    """
+    Output of a reader CopyTo(), inserting objects in a store by batches.
+    """
+
+    def __init__(self, conn, batch = 10000):
+        self._conn  = conn
+        self._batch = batch
+        self._rows  = dict((kind, []) for kind in _Tables)
+        self._users = {}
+
+    def _Add(self, kind, data):
+        if u"uid" in data and u"user" in data:
+            self._users[int(data[u"uid"])] = data[u"user"]
+        rows = self._rows[kind]
+        rows.append((data[u"id"], buffer(marshal.dumps(data))))
+        if len(rows) >= self._batch:
+            self._Flush(kind)
+
+    def _Flush(self, kind):
+        self._conn.executemany("INSERT OR REPLACE INTO %s VALUES (?, ?)" % kind, self._rows[kind])
+        self._rows[kind] = []
+
+    def NodeCreate(self, data):
+        self._Add("node", data)
+
+    # .pbf reader only reports nodes with tags to NodeCreate(), others are
+    # only stored with their coordinates
+    def NodeCoordCreateMany(self, ids, lats, lons):
+        for (id, lat, lon) in zip(ids, lats, lons):
+            self._Add("node", {u"id": id, u"lat": lat, u"lon": lon, u"tag": {}})
+
+    def NodeTagCreateMany(self, data_list):
+        for data in data_list:
+            self._Add("node", data)
+
+    def WayCreate(self, data):
+        self._Add("way", data)
+
+    def RelationCreate(self, data):
+        self._Add("relation", data)
+
+    def close(self):
+        for kind in _Tables:
+            self._Flush(kind)
+        self._conn.executemany("INSERT OR REPLACE INTO user VALUES (?, ?)", self._users.iteritems())
+        self._conn.commit()
+
+class OsmSqlite:
+    """
+    Reader of objects by id from an OSM extract, .osm(.gz|.bz2) or .pbf.
+    Objects are copied on first use, by a single sequential read of the
+    extract, in a SQLite database saved next to it and reused while the
+    extract is unchanged.
+    """
+
+    def __init__(self, filename, logger = OsmSax.dummylog()):
+        self._filename = filename
+        self._logger   = logger
+        self._temp     = None
+        st = os.stat(filename)
+        self._source = (st.st_size, int(st.st_mtime))
+        self._store_filename = filename + ".sqlite"
+        if os.path.exists(self._store_filename):
+            self._conn = sqlite3.connect(self._store_filename)
+            if self._Load():
+                return
+            self._conn.close()
+
+        try:
+            tmp = "%s.%d.tmp" % (self._store_filename, os.getpid())
+            self._Build(tmp)
+            os.rename(tmp, self._store_filename)
+        except (IOError, OSError, sqlite3.OperationalError):
+            # can't write next to the OSM file, keep store in a temporary file
+            self._logger.log("can't write store %s, using a temporary file" % self._store_filename)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            (fd, self._temp) = tempfile.mkstemp(suffix=".sqlite")
+            os.close(fd)
+            self._Build(self._temp)
+        self._conn = sqlite3.connect(self._store_filename if not self._temp else self._temp)
+        self._Load()
+
+    def __del__(self):
+        try:
+            self.close()
+        except AttributeError:
+            pass
+
+    def close(self):
+        self._conn.close()
+        if self._temp:
+            os.remove(self._temp)
+            self._temp = None
+
+    def _Load(self):
+        try:
+            meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+        except sqlite3.DatabaseError:
+            return False
+        return (meta.get("version") == _STORE_VERSION and
+                (meta.get("size"), meta.get("mtime")) == self._source)
+
+    def _Build(self, store_filename):
+        self._logger.log("building store of %s" % self._filename)
+        if os.path.exists(store_filename):
+            os.remove(store_filename)
+        conn = sqlite3.connect(store_filename)
+        try:
+            # the whole store is rebuilt if anything goes wrong
+            conn.execute("PRAGMA journal_mode = OFF")
+            conn.execute("PRAGMA synchronous = OFF")
+            for kind in _Tables:
+                conn.execute("CREATE TABLE %s (id INTEGER PRIMARY KEY, data BLOB)" % kind)
+            conn.execute("CREATE TABLE user (id INTEGER PRIMARY KEY, name TEXT)")
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value)")
+
+            if self._filename.endswith(".pbf"):
+                import OsmPbf
+                reader = OsmPbf.OsmPbfReader(self._filename, self._logger)
+            else:
+                reader = OsmSax.OsmExpatReader(self._filename, self._logger)
+            writer = _StoreWriter(conn)
+            reader.CopyTo(writer)
+            writer.close()
+
+            conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                             [("version", _STORE_VERSION), ("size", self._source[0]), ("mtime", self._source[1])])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _Get(self, kind, id):
+        r = self._conn.execute("SELECT data FROM %s WHERE id = ?" % kind, (id,)).fetchone()
+        if r:
+            return marshal.loads(str(r[0]))
+
+    def NodeGet(self, NodeId):
+        return self._Get("node", NodeId)
+
+    def WayGet(self, WayId):
+        return self._Get("way", WayId)
+
+    def RelationGet(self, RelationId):
+        return self._Get("relation", RelationId)
+
+    def UserGet(self, UserId):
+        r = self._conn.execute("SELECT name FROM user WHERE id = ?", (int(UserId),)).fetchone()
+        if r:
+            return r[0]
+
+###########################################################################
+import unittest
+import shutil
+
+class TestLog:
+    def __init__(self):
+        self.messages = []
+
+    def log(self, text):
+        self.messages.append(text)
+
+class Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # stores are written next to the files
+        cls.dir = tempfile.mkdtemp()
+        cls.gz = os.path.join(cls.dir, "saint_barthelemy.osm.gz")
+        shutil.copy("tests/saint_barthelemy.osm.gz", cls.gz)
+        cls.pbf = os.path.join(cls.dir, "saint_barthelemy.osm.pbf")
+        shutil.copy("tests/saint_barthelemy.osm.pbf", cls.pbf)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def check(self, func, id, exists=True, meta=True):
+        res = func(id)
+        if exists:
+            assert res
+            self.assertEquals(res["id"], id)
+            if meta:
+                assert res["timestamp"]
+                assert res["uid"]
+            self.assertEquals(type(res["tag"]), type(dict()))
+        else:
+            assert not res
+
+    def test_get(self):
+        for filename in (self.gz, self.pbf):
+            i1 = OsmSqlite(filename)
+            # test .pbf file has no metadata
+            meta = filename != self.pbf
+            self.check(i1.NodeGet, 266053077, meta=meta)
+            self.check(i1.NodeGet, 2619283352, meta=meta)
+            self.check(i1.NodeGet, 266053076, False)
+            self.check(i1.WayGet, 24473155, meta=meta)
+            self.check(i1.WayGet, 53599877, False)
+            self.check(i1.RelationGet, 47796, meta=meta)
+            self.check(i1.RelationGet, 2707693, meta=meta)
+            self.check(i1.RelationGet, 47795, False)
+
+    def test_same_as_alea(self):
+        import OsmSaxAlea
+        i1 = OsmSqlite(self.gz)
+        i2 = OsmSaxAlea.OsmSaxReader(self.gz)
+        for id in (266053077, 1554852345, 2619283351):
+            self.assertEquals(i1.NodeGet(id), i2.NodeGet(id))
+        for id in (24473155, 142061833, 255316725):
+            self.assertEquals(i1.WayGet(id), i2.WayGet(id))
+        for id in (47796, 2707693):
+            self.assertEquals(i1.RelationGet(id), i2.RelationGet(id))
+
+    def test_same_as_pbf(self):
+        i1 = OsmSqlite(self.gz)
+        i2 = OsmSqlite(self.pbf)
+        self.assertAlmostEquals(i2.NodeGet(266053077)["lat"], i1.NodeGet(266053077)["lat"])
+        for id in (24473155, 142061833, 255316725):
+            self.assertEquals(i1.WayGet(id)["nd"], i2.WayGet(id)["nd"])
+
+    def test_user(self):
+        i1 = OsmSqlite(self.gz)
+        node = i1.NodeGet(266053077)
+        self.assertEquals(i1.UserGet(node["uid"]), node["user"])
+        self.assertEquals(i1.UserGet(1), None)
+
+    def test_store_reopen(self):
+        OsmSqlite(self.gz)
+        log = TestLog()
+        i1 = OsmSqlite(self.gz, log)
+        self.assertEquals(log.messages, [])
+        self.check(i1.NodeGet, 266053077)
+
+    def test_store_outdated(self):
+        OsmSqlite(self.gz)
+        st = os.stat(self.gz)
+        os.utime(self.gz, (st.st_atime, st.st_mtime + 10))
+        log = TestLog()
+        i1 = OsmSqlite(self.gz, log)
+        self.assertEquals(log.messages[0], "building store of %s" % self.gz)
+        self.check(i1.NodeGet, 266053077)
@@ -19,7 +19,7 @@
 ##                                                                       ##
 ###########################################################################
 
-import bz2, datetime
+import bz2, datetime, shutil, tempfile
 
 import OsmSax
 from OsmoseErrorFile_ErrorFilter import PolygonErrorFilter
@@ -43,6 +43,7 @@ class ErrorFile:
             output = bz2.BZ2File(self.config.dst, "w")
         else:
             output = open(self.config.dst, "w")
+        self.output = output
         self.outxml = OsmSax.OsmSaxWriter(output, "UTF-8")
         self.outxml.startDocument()
         self.outxml.startElement("analysers", {})
@@ -51,16 +52,39 @@ class ErrorFile:
         self.outxml.endElement("analysers")
         self.outxml.endDocument()
         del self.outxml
+        del self.output
 
     def analyser(self, timestamp, change=False):
+        """
+        Start an analyser. When timestamp is None, it is given to
+        analyser_end(), and content is spooled to a temporary file until
+        then. Without any timestamp there, the analyser has none.
+        """
         self.mode = "analyserChange" if change else "analyser"
         attrs = {}
-        attrs["timestamp"] = timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
         if hasattr(self.config, "version"):
             attrs["version"] = self.config.version
-        self.outxml.startElement(self.mode, attrs)
+        if timestamp:
+            attrs["timestamp"] = timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+            self.outxml.startElement(self.mode, attrs)
+            self.spool = None
+        else:
+            self.spool_attrs = attrs
+            self.spool = tempfile.TemporaryFile()
+            self.spool_outxml = self.outxml
+            self.outxml = OsmSax.OsmSaxWriter(self.spool, "UTF-8")
 
-    def analyser_end(self):
+    def analyser_end(self, timestamp=None):
+        if self.spool:
+            if timestamp:
+                self.spool_attrs["timestamp"] = timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+            self.outxml = self.spool_outxml
+            del self.spool_outxml
+            self.outxml.startElement(self.mode, self.spool_attrs)
+            self.spool.seek(0)
+            shutil.copyfileobj(self.spool, self.output)
+            self.spool.close()
+            self.spool = None
         self.outxml.endElement(self.mode)
 
     def classs(self, id, item, level, tag, langs):
@@ -86,7 +110,7 @@ class ErrorFile:
             for g in geom[type]:
                 self.geom_type_renderer[type](g)
         if text:
-            for lang in text:
+            for lang in sorted(text.keys()):
                 self.outxml.Element("text", {"lang":lang, "value":text[lang]})
         if fix:
             fix = self.fixdiff(fix)
@@ -202,3 +226,37 @@ class Test(unittest.TestCase):
         self.check([{"~": {"t": "v"}}, {"+": {"t": "v"}}], [[{"~": {"t": "v"}}], [{"+": {"t": "v"}}]] )
         self.check([[{"t": "v"}], [{"t": "v"}]], [[{"~": {"t": "v"}}], [{"~": {"t": "v"}}]] )
         self.check([[None, {"t": "v"}]], [[None, {"~": {"t": "v"}}]] )
+
+    def test_analyser_timestamp_at_end(self):
+        import os
+        (fd, self.a.config.dst) = tempfile.mkstemp(suffix=".xml")
+        os.close(fd)
+        try:
+            self.a.begin()
+            self.a.analyser(None)
+            self.a.classs(1, 1000, 2, None, {"en": "title"})
+            self.a.analyser_end(datetime.datetime(2014, 1, 16, 1, 2, 3))
+            self.a.end()
+            with open(self.a.config.dst) as f:
+                self.assertEquals(f.read().split("\n")[2:5], [
+                    '<analyser timestamp="2014-01-16T01:02:03Z">',
+                    '<class item="1000" id="1" level="2">',
+                    '<classtext lang="en" title="title" />'])
+        finally:
+            os.remove(self.a.config.dst)
+
+    def test_analyser_timestamp_unknown(self):
+        import os
+        (fd, self.a.config.dst) = tempfile.mkstemp(suffix=".xml")
+        os.close(fd)
+        try:
+            self.a.begin()
+            self.a.analyser(None)
+            self.a.analyser_end(None)
+            self.a.end()
+            with open(self.a.config.dst) as f:
+                self.assertEquals(f.read().split("\n")[2:4], [
+                    '<analyser>',
+                    '</analyser>'])
+        finally:
+            os.remove(self.a.config.dst)
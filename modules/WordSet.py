@@ -0,0 +1,222 @@
+#-*- coding: utf-8 -*-
+
+###########################################################################
+##                                                                       ##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+##                                                                       ##
+###########################################################################
+
+import hashlib, mmap, os, re, struct, zlib
+
+###########################################################################
+## Set of words compiled in a file
+##
+## File is a hash table with open addressing, mapped in memory and shared
+## by all processes using it:
+##   header  magic, number of slots (a power of 2), number of words
+##   slots   (offset, length) of the utf-8 word of each slot, 0 if empty
+##   words   utf-8 words
+
+_MAGIC = "OSMWORD1"
+_Header = struct.Struct("<8sII")
+_Slot = struct.Struct("<II")
+
+def _key(word):
+    if isinstance(word, unicode):
+        return word.encode("utf-8")
+    return word
+
+def Build(filename, words):
+    """
+    Write the file of words, atomically, and return it opened.
+    """
+    keys = sorted(set(_key(w) for w in words))
+    size = 1
+    while size < 2 * len(keys):
+        size *= 2
+    mask = size - 1
+
+    slots = [(0, 0)] * size
+    offset = _Header.size + _Slot.size * size
+    for key in keys:
+        i = zlib.crc32(key) & mask
+        while slots[i][0]:
+            i = (i + 1) & mask
+        slots[i] = (offset, len(key))
+        offset += len(key)
+
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(_Header.pack(_MAGIC, size, len(keys)))
+            f.write("".join(_Slot.pack(*s) for s in slots))
+            f.write("".join(keys))
+        os.rename(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return WordSet(filename)
+
+def BuildInFolder(folder, name, words):
+    """
+    Write the file of words in folder, named from name and the words, or
+    reuse the same one written before. Files of name with other words are
+    removed.
+    """
+    keys = sorted(set(_key(w) for w in words))
+    filename = os.path.join(folder, "%s-%s.words" % (name, hashlib.sha1("\n".join(keys)).hexdigest()))
+    if os.path.exists(filename):
+        try:
+            return WordSet(filename)
+        except (IOError, ValueError):
+            # not complete, write again
+            pass
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    s = Build(filename, keys)
+    # already mapped by other processes, files stay readable by them
+    same_name = re.compile(re.escape(name) + r"-[0-9a-f]{40}\.words$")
+    for f in os.listdir(folder):
+        if same_name.match(f) and os.path.join(folder, f) != filename:
+            try:
+                os.remove(os.path.join(folder, f))
+            except OSError:
+                pass
+    return s
+
+class WordSet:
+    """
+    Read only set of words of a file written by Build(). Instances are
+    pickled as their file name.
+    """
+
+    def __init__(self, filename):
+        self._open(filename)
+
+    def _open(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _Header.size:
+            raise ValueError("not a words file: %s" % filename)
+        (magic, size, self._len) = _Header.unpack_from(self._map)
+        if magic != _MAGIC or len(self._map) < _Header.size + _Slot.size * size:
+            raise ValueError("not a words file: %s" % filename)
+        self._mask = size - 1
+
+    def __getstate__(self):
+        return self.filename
+
+    def __setstate__(self, filename):
+        self._open(filename)
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, word):
+        return bool(self.intersection((word,)))
+
+    def intersection(self, words):
+        """
+        Set of words also in this set, looked up in one call.
+        """
+        m = self._map
+        mask = self._mask
+        unpack = _Slot.unpack_from
+        crc32 = zlib.crc32
+        found = set()
+        for word in words:
+            key = word.encode("utf-8") if isinstance(word, unicode) else word
+            i = crc32(key) & mask
+            while True:
+                (offset, length) = unpack(m, _Header.size + 8 * i)
+                if not offset:
+                    break
+                if m[offset:offset + length] == key:
+                    found.add(word)
+                    break
+                i = (i + 1) & mask
+        return found
+
+    def __iter__(self):
+        m = self._map
+        for i in xrange(self._mask + 1):
+            (offset, length) = _Slot.unpack_from(m, _Header.size + _Slot.size * i)
+            if offset:
+                yield m[offset:offset + length].decode("utf-8")
+
+###########################################################################
+import unittest
+import cPickle, shutil, tempfile
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_contains(self):
+        words = [u"", u"rue", u"avenue", "1er", u"Ça", u"à", u"rue"]
+        s = Build(os.path.join(self.dir, "test.words"), words)
+        self.assertEquals(len(s), 6)
+        for w in words:
+            assert w in s, w
+        assert u"1er" in s
+        for w in (u"ru", u"rues", u"Ç", u"ça", u" ", u"avenue\n"):
+            assert w not in s, w
+        self.assertEquals(sorted(s), sorted(set(unicode(w) for w in words)))
+        self.assertEquals(s.intersection([u"rue", u"ru", u"", "1er", u"rue"]), set([u"rue", u"", "1er"]))
+
+    def test_empty(self):
+        s = Build(os.path.join(self.dir, "test.words"), [])
+        self.assertEquals(len(s), 0)
+        assert u"" not in s
+        self.assertEquals(list(s), [])
+
+    def test_many(self):
+        words = [unicode(i) for i in range(0, 20000, 2)]
+        s = Build(os.path.join(self.dir, "test.words"), words)
+        for i in range(20000):
+            self.assertEquals(unicode(i) in s, i % 2 == 0)
+
+    def test_folder(self):
+        folder = os.path.join(self.dir, "cache")
+        s1 = BuildInFolder(folder, "test", [u"a", u"b"])
+        s2 = BuildInFolder(folder, "test", [u"b", u"a", u"a"])
+        self.assertEquals(s1.filename, s2.filename)
+        BuildInFolder(folder, "test-2", [u"a"])
+        s3 = BuildInFolder(folder, "test", [u"a", u"c"])
+        self.assertNotEquals(s1.filename, s3.filename)
+        # previous words of test removed, not the ones of test-2
+        self.assertEquals(len(os.listdir(folder)), 2)
+        assert not os.path.exists(s1.filename)
+        assert u"b" in s1
+
+        # a truncated file is written again
+        with open(s3.filename, "wb") as f:
+            f.write(_MAGIC)
+        s4 = BuildInFolder(folder, "test", [u"a", u"c"])
+        assert u"c" in s4
+
+    def test_pickle(self):
+        s = Build(os.path.join(self.dir, "test.words"), [u"rue"])
+        data = cPickle.dumps(s, cPickle.HIGHEST_PROTOCOL)
+        assert len(data) < 200
+        s = cPickle.loads(data)
+        assert u"rue" in s
+        assert u"ru" not in s
+
+        os.remove(s.filename)
+        self.assertRaises(IOError, cPickle.loads, data)
@@ -41,10 +41,39 @@ bin_osmosis = dir_osmose + "/osmosis/osmosis-0.44/bin/osmosis"
 # where osmconvert is located
 bin_osmconvert = "./osmconvert/osmconvert"
 
+# number of processes decoding .pbf blocks, None to use all CPUs
+pbf_concurrency = None
+
+# number of threads decompressing .bz2/.gz files ahead of the readers, None to
+# use all CPUs when there are more than one, 0 to decompress in the reader itself
+decompress_threads = None
+
+# number of processes running sax plugins, 1 to run them in the analyser
+# process, None to use all CPUs
+sax_concurrency = 1
+
+# Unix socket of a shared "OsmBin.py --serve", used by sax analysers before
+# opening osmbin files themselves
+osmbin_socket = "/data/work/osmbin/osmbin.sock"
+
+# osmbin files opened by sax analysers
+osmbin_folder = "/data/work/osmbin/data"
+
+# readers tried in turn by sax analysers to get objects by id, the first
+# available one is used:
+#   osmosis        database of the country, when configured
+#   osmbin_socket  server on osmbin_socket
+#   osmbin         files in osmbin_folder
+#   sqlite         store built from the extract on first use, kept next to it
+#   alea           lookups in the extract itself, .osm files only
+# can be overridden by a "sax_readers" attribute of the country config
+sax_readers = ["osmosis", "osmbin_socket", "osmbin", "sqlite", "alea"]
+
 ### no need to modify following variables ###
 
 dir_tmp = os.path.join(dir_work, "tmp")
 dir_cache = os.path.join(dir_work, "cache")
+dir_plugins_cache = os.path.join(dir_cache, "plugins")
 dir_results = os.path.join(dir_work, "results")
 dir_extracts = os.path.join(dir_work, "extracts")
 dir_diffs = os.path.join(dir_work, "diffs")
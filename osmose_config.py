@@ -93,6 +93,8 @@ class template_config:
     db_host     = None        # Use socket by default
     db_schema   = None
 
+    sax_readers = None        # Use modules.config.sax_readers by default
+
     def __init__(self, country, polygon_id=None, analyser_options=None, download_repo=GEOFABRIK):
         config[country] = self
         self.country          = country
@@ -614,6 +614,7 @@ def run(conf, logger, options):
                 analyser_conf.db_schema = conf.db_schema
             else:
                 analyser_conf.db_schema = country
+            analyser_conf.sax_readers = conf.sax_readers
 
             analyser_conf.dir_scripts = conf.dir_scripts
             analyser_conf.options = conf.analyser_options
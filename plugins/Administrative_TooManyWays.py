@@ -24,6 +24,8 @@ from plugins.Plugin import Plugin
 
 class Administrative_TooManyWays(Plugin):
 
+    only_for_tags = ["boundary"]
+
     def init(self, logger):
         Plugin.init(self, logger)
         self.errors[504] = { "item": 6020, "level": 3, "tag": ["boundary", "fix:chair"], "desc": T_(u"Duplicated way in relation") }
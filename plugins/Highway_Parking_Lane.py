@@ -23,6 +23,8 @@ from plugins.Plugin import Plugin
 
 class Highway_Parking_Lane(Plugin):
 
+    only_for_tags = ["highway"]
+
     def init(self, logger):
         Plugin.init(self, logger)
         self.parking_lane = "parking:lane:"
@@ -19,12 +19,20 @@
 ##                                                                       ##
 ###########################################################################
 
-from plugins.Plugin import Plugin
+from plugins.Plugin import Plugin, ValueCache
+from modules import WordSet
 import re
 
 
 class P_Name_Dictionary(Plugin):
 
+    init_cache = ["DictKnownWords", "DictCorrections", "DictUnknownWords", "DictCommonWords", "DictEncoding", "apostrophe"]
+
+    def __init__(self, father):
+        Plugin.__init__(self, father)
+        # same names are on many elements
+        self._names_errors = ValueCache()
+
     def init(self, logger):
         Plugin.init(self, logger)
         self.errors[703] = { "item": 5010, "level": 2, "tag": ["name", "fix:chair"], "desc": T_(u"Word not found in dictionary") }
@@ -56,9 +64,17 @@ class P_Name_Dictionary(Plugin):
         #            self.DictCorrections.pop(k)
         #            break
 
-        self.DictKnownWords = set(self.DictKnownWords)
+        self.DictKnownWords = self.compile_words("KnownWords", self.DictKnownWords)
         self.DictUnknownWords = set(self.DictUnknownWords)
 
+    def compile_words(self, name, words):
+        # Mapped in memory from a file shared by all processes and runs, and
+        # saved by the init cache as its file name
+        try:
+            return WordSet.BuildInFolder(self.father.ToolsGetCacheFolder(), self.__class__.__name__ + "-" + name, words)
+        except (IOError, OSError):
+            return set(words)
+
     def load_external_dictionaries(self, lang):
         # Dictionaries
         for d in self.father.ToolsListDir("dictionaries/%s" % lang):
@@ -70,10 +86,11 @@ class P_Name_Dictionary(Plugin):
         for d in self.father.ToolsListDir("dictionaries/%s" % lang):
             if d[-1] == "~": continue
             if d[:4] != "Corr": continue
-            self.DictCorrections = dict( self.DictCorrections.items() + self.father.ToolsReadDict("dictionaries/%s/%s" % (lang, d), ":").items() )
+            self.DictCorrections.update(self.father.ToolsReadDict("dictionaries/%s/%s" % (lang, d), ":"))
 
         # Common words
-        self.DictCommonWords += [x for x in self.father.ToolsReadList("dictionaries/%s/ResultCommonWords" % lang) if x in self.DictKnownWords]
+        known = set(self.DictKnownWords)
+        self.DictCommonWords += [x for x in self.father.ToolsReadList("dictionaries/%s/ResultCommonWords" % lang) if x in known]
 
     def laod_numbering(self):
         # 1a 1b 1c
@@ -119,9 +136,11 @@ class P_Name_Dictionary(Plugin):
         if self.apostrophe:
             name = self.apostrophe.sub(' ', name)
 
-        for WordComplet in name.split(" "):
-            if WordComplet in self.DictCommonWords: continue
-            elif WordComplet in self.DictKnownWords: continue
+        words = name.split(" ")
+        # DictCommonWords are also in DictKnownWords
+        known = self.DictKnownWords.intersection(words)
+        for WordComplet in words:
+            if WordComplet in known: continue
             elif WordComplet in self.DictCorrections:
                 if self.DictCorrections[WordComplet]:
                     err.append({"class": 703, "subclass": abs(hash(WordComplet)), "fix": {"name": initialName.replace(WordComplet, self.DictCorrections[WordComplet])}})
@@ -154,7 +173,7 @@ class P_Name_Dictionary(Plugin):
         err = []
         for name in [u"name", u"name_1", u"name_2", u"alt_name", u"loc_name", u"old_name", u"official_name", u"short_name", u"addr:street:name"]:
             if name in tags:
-                err += self._get_err(tags[name])
+                err += [dict(e) for e in self._names_errors.get(tags[name], self._get_err)]
         return err
 
     def way(self, data, tags, nodes):
@@ -27,6 +27,8 @@ class Name_Dictionary_Lang_fr(P_Name_Dictionary):
 
     only_for = ["fr"]
 
+    init_cache_files = ["dictionaries/fr"]
+
     def init(self, logger):
         P_Name_Dictionary.init(self, logger)
 
@@ -75,20 +77,32 @@ class Name_Dictionary_Lang_fr(P_Name_Dictionary):
 
 ###########################################################################
 from plugins.Plugin import TestPluginCommon
+import os
 
 class Test(TestPluginCommon):
+    def setUp(self):
+        TestPluginCommon.setUp(self)
+        import tempfile
+        self.dir_plugins_cache = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir_plugins_cache)
+
     def test(self):
         import modules.config as config
         from analysers.analyser_sax import Analyser_Sax
         class _config:
             options = {"language": "fr"}
             dir_scripts = config.dir_osmose
+            dir_plugins_cache = self.dir_plugins_cache
         class father(Analyser_Sax):
             config = _config()
             def __init__(self):
                 pass
         a = Name_Dictionary_Lang_fr(father())
         a.init(None)
+        self.assertEquals(len(os.listdir(self.dir_plugins_cache)), 1)
         assert not a.node(None, {"highway": "Pont des Anes"})
         name = [(u"Pont des Anes", u"Pont des Ânes"),
                 (u"Pont des Ânes", None),
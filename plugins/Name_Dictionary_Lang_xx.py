@@ -36,17 +36,29 @@ class Name_Dictionary_Lang_xx(P_Name_Dictionary):
 
 ###########################################################################
 from plugins.Plugin import TestPluginCommon
+import os
 
 class Test(TestPluginCommon):
+    def setUp(self):
+        TestPluginCommon.setUp(self)
+        import tempfile
+        self.dir_plugins_cache = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir_plugins_cache)
+
     def test(self):
         import modules.config as config
         from analysers.analyser_sax import Analyser_Sax
         class _config:
             options = {"language": "xx"}
             dir_scripts = config.dir_osmose
+            dir_plugins_cache = self.dir_plugins_cache
         class father(Analyser_Sax):
             config = _config()
             def __init__(self):
                 pass
         a = Name_Dictionary_Lang_xx(father())
         a.init(None)
+        self.assertEquals(len(os.listdir(self.dir_plugins_cache)), 1)
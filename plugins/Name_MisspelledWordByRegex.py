@@ -24,6 +24,8 @@ from plugins.Plugin import Plugin
 
 class P_Name_MisspelledWordByRegex(Plugin):
 
+    only_for_tags = ["name"]
+
     def init(self, logger):
         Plugin.init(self, logger)
         self.errors[701] = { "item": 5010, "level": 1, "tag": ["name", "fix:chair"], "desc": T_(u"Badly written word") }
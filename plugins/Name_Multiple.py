@@ -26,6 +26,8 @@ import re
 
 class Name_Multiple(Plugin):
 
+    only_for_tags = ["name"]
+
     def init(self, logger):
         Plugin.init(self, logger)
         self.errors[705] = { "item": 5030, "level": 1, "tag": ["name", "fix:survey"], "desc": T_(u"The name tag contains two names") }
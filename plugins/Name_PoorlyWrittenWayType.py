@@ -26,6 +26,8 @@ import re
 
 class P_Name_PoorlyWrittenWayType(Plugin):
 
+    only_for_tags = ["name"]
+
     def generator(self, p):
         (p1, p2) = p.split("|")
         r = u"^(("
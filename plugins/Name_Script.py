@@ -100,93 +100,117 @@ class Name_Script(Plugin):
 
         self.names = [u"name", u"name_1", u"name_2", u"alt_name", u"loc_name", u"old_name", u"official_name", u"short_name"]
 
-    def node(self, data, tags):
+    def check(self, key, value):
         err = []
-        for key, value in tags.items():
-            m = self.non_printable.search(key)
-            if m:
-                err.append({"class": 50702, "subclass": 0, "text": T_("\"%s\" unexpected non printable char (%s, 0x%04x) in key at position %s", key, unicodedata.name(m.group(0), ''), ord(m.group(0)), m.start() + 1)})
-                continue
-
-            m = self.non_printable.search(value)
-            if m:
-                err.append({"class": 50702, "subclass": 1, "text": T_("\"%s\"=\"%s\" unexpected non printable char (%s, 0x%04x) in value at position %s", key, value, unicodedata.name(m.group(0), ''), ord(m.group(0)), m.start() + 1)})
-                continue
-
-            m = self.other_symbol.search(key)
-            if m:
-                err.append({"class": 50703, "subclass": 0, "text": T_("\"%s\" unexpected symbol char (%s, 0x%04x) in key at position %s", key, unicodedata.name(m.group(0), ''), ord(m.group(0)), m.start() + 1)})
-                continue
-
-            m = self.other_symbol.search(value)
-            if m:
-                err.append({"class": 50703, "subclass": 1, "text": T_("\"%s\"=\"%s\" unexpected symbol char (%s, 0x%04x) in value at position %s", key, value, unicodedata.name(m.group(0), ''), ord(m.group(0)), m.start() + 1)})
-                continue
-
-            # https://en.wikipedia.org/wiki/Bi-directional_text#Table_of_possible_BiDi-types
-            for c in u"\u200E\u200F\u061C\u202A\u202D\u202B\u202E\u202C\u2066\u2067\u2068\u2069":
-                m = key.find(c)
-                if m > 0:
-                    err.append({"class": 50702, "subclass": 2, "text": T_("\"%s\" unexpected non printable char (%s, 0x%04x) in key at position %s", key, unicodedata.name(c, ''), ord(c), m + 1)})
-
-                m = value.find(c)
-                if m > 0:
-                    err.append({"class": 50702, "subclass": 2, "text": T_("\"%s\"=\"%s\" unexpected non printable char (%s, 0x%04x) in value at position %s", key, value, unicodedata.name(c, ''), ord(c), m + 1)})
-
-            if self.default:
-                if key in self.names:
-                    s = self.non_letter.sub(u" ", value)
-                    s = self.alone_char.sub(u"", s)
-                    s = self.roman_number.sub(u"", s)
-                    s = self.default.sub(u"", s)
-                    if len(s) > 0 and \
-                        not(len(value) == 2 and len(s) == 1) and \
-                        len(s) <= len(value) / 10 + 1:
-                        if len(s) == 1:
-                            c = s[0]
-                            u = self.uniq_script and confusables.unconfuse(c, self.uniq_script)
-                            if u:
-                                err.append({"class": 50701, "subclass": 0,
-                                    "text": T_("\"%s\"=\"%s\" unexpected char \"%s\" (%s, 0x%04x). Means \"%s\" (%s, 0x%04x)?", key, value, s, unicodedata.name(c, ''), ord(c), u, unicodedata.name(u, ''), ord(u)),
-                                    "fix": {key: value.replace(c, u)}
-                                })
-                            else:
-                                err.append({"class": 50701, "subclass": 0,
-                                    "text": T_("\"%s\"=\"%s\" unexpected char \"%s\" (%s, 0x%04x)", key, value, s, unicodedata.name(c, ''), ord(c))
-                                })
-                        else:
-                            err.append({"class": 50701, "subclass": 0, "text": T_("\"%s\"=\"%s\" unexpected \"%s\"", key, value, s)})
-
-            l = key.split(':')
-            if len(l) > 1 and l[0] in self.names and l[1] in self.lang:
+        m = self.non_printable.search(key)
+        if m:
+            err.append({"class": 50702, "subclass": 0, "text": T_("\"%s\" unexpected non printable char (%s, 0x%04x) in key at position %s", key, unicodedata.name(m.group(0), ''), ord(m.group(0)), m.start() + 1)})
+            return err
+
+        m = self.non_printable.search(value)
+        if m:
+            err.append({"class": 50702, "subclass": 1, "text": T_("\"%s\"=\"%s\" unexpected non printable char (%s, 0x%04x) in value at position %s", key, value, unicodedata.name(m.group(0), ''), ord(m.group(0)), m.start() + 1)})
+            return err
+
+        m = self.other_symbol.search(key)
+        if m:
+            err.append({"class": 50703, "subclass": 0, "text": T_("\"%s\" unexpected symbol char (%s, 0x%04x) in key at position %s", key, unicodedata.name(m.group(0), ''), ord(m.group(0)), m.start() + 1)})
+            return err
+
+        m = self.other_symbol.search(value)
+        if m:
+            err.append({"class": 50703, "subclass": 1, "text": T_("\"%s\"=\"%s\" unexpected symbol char (%s, 0x%04x) in value at position %s", key, value, unicodedata.name(m.group(0), ''), ord(m.group(0)), m.start() + 1)})
+            return err
+
+        # https://en.wikipedia.org/wiki/Bi-directional_text#Table_of_possible_BiDi-types
+        for c in u"\u200E\u200F\u061C\u202A\u202D\u202B\u202E\u202C\u2066\u2067\u2068\u2069":
+            m = key.find(c)
+            if m > 0:
+                err.append({"class": 50702, "subclass": 2, "text": T_("\"%s\" unexpected non printable char (%s, 0x%04x) in key at position %s", key, unicodedata.name(c, ''), ord(c), m + 1)})
+
+            m = value.find(c)
+            if m > 0:
+                err.append({"class": 50702, "subclass": 2, "text": T_("\"%s\"=\"%s\" unexpected non printable char (%s, 0x%04x) in value at position %s", key, value, unicodedata.name(c, ''), ord(c), m + 1)})
+
+        if self.default:
+            if key in self.names:
                 s = self.non_letter.sub(u" ", value)
-                s = self.alone_char.sub(u"\\1", s)
-                s = self.roman_number.sub(u"\\1", s)
-                s = self.lang[l[1]].sub(u"", s)
-                if len(s) > 0:
+                s = self.alone_char.sub(u"", s)
+                s = self.roman_number.sub(u"", s)
+                s = self.default.sub(u"", s)
+                if len(s) > 0 and \
+                    not(len(value) == 2 and len(s) == 1) and \
+                    len(s) <= len(value) / 10 + 1:
                     if len(s) == 1:
                         c = s[0]
-                        u = self.uniq_scripts.get(l[1]) and confusables.unconfuse(c, self.uniq_scripts.get(l[1]))
+                        u = self.uniq_script and confusables.unconfuse(c, self.uniq_script)
                         if u:
-                            err.append({"class": 50701, "subclass": 1,
+                            err.append({"class": 50701, "subclass": 0,
                                 "text": T_("\"%s\"=\"%s\" unexpected char \"%s\" (%s, 0x%04x). Means \"%s\" (%s, 0x%04x)?", key, value, s, unicodedata.name(c, ''), ord(c), u, unicodedata.name(u, ''), ord(u)),
                                 "fix": {key: value.replace(c, u)}
                             })
                         else:
-                            err.append({"class": 50701, "subclass": 1,
+                            err.append({"class": 50701, "subclass": 0,
                                 "text": T_("\"%s\"=\"%s\" unexpected char \"%s\" (%s, 0x%04x)", key, value, s, unicodedata.name(c, ''), ord(c))
                             })
                     else:
-                        err.append({"class": 50701, "subclass": 1, "text": T_("\"%s\"=\"%s\" unexpected \"%s\"", key, value, s)})
+                        err.append({"class": 50701, "subclass": 0, "text": T_("\"%s\"=\"%s\" unexpected \"%s\"", key, value, s)})
+
+        l = key.split(':')
+        if len(l) > 1 and l[0] in self.names and l[1] in self.lang:
+            s = self.non_letter.sub(u" ", value)
+            s = self.alone_char.sub(u"\\1", s)
+            s = self.roman_number.sub(u"\\1", s)
+            s = self.lang[l[1]].sub(u"", s)
+            if len(s) > 0:
+                if len(s) == 1:
+                    c = s[0]
+                    u = self.uniq_scripts.get(l[1]) and confusables.unconfuse(c, self.uniq_scripts.get(l[1]))
+                    if u:
+                        err.append({"class": 50701, "subclass": 1,
+                            "text": T_("\"%s\"=\"%s\" unexpected char \"%s\" (%s, 0x%04x). Means \"%s\" (%s, 0x%04x)?", key, value, s, unicodedata.name(c, ''), ord(c), u, unicodedata.name(u, ''), ord(u)),
+                            "fix": {key: value.replace(c, u)}
+                        })
+                    else:
+                        err.append({"class": 50701, "subclass": 1,
+                            "text": T_("\"%s\"=\"%s\" unexpected char \"%s\" (%s, 0x%04x)", key, value, s, unicodedata.name(c, ''), ord(c))
+                        })
+                else:
+                    err.append({"class": 50701, "subclass": 1, "text": T_("\"%s\"=\"%s\" unexpected \"%s\"", key, value, s)})
 
         return err
 
+    def node(self, data, tags):
+        err = []
+        for key, value in tags.items():
+            err += self.check(key, value)
+        return err
+
     def way(self, data, tags, nds):
         return self.node(data, tags)
 
     def relation(self, data, tags, members):
         return self.node(data, tags)
 
+    def node_batch(self, nodes):
+        # same tags are on many elements, check them once
+        checked = {}
+        res = []
+        for (data, tags) in nodes:
+            err = []
+            for tag in tags.items():
+                if tag not in checked:
+                    checked[tag] = self.check(*tag)
+                err += [dict(e) for e in checked[tag]]
+            res.append(err)
+        return res
+
+    def way_batch(self, ways):
+        return self.node_batch([(data, tags) for (data, tags, nds) in ways])
+
+    def relation_batch(self, relations):
+        return self.node_batch([(data, tags) for (data, tags, members) in relations])
+
 
 ###########################################################################
 from plugins.Plugin import TestPluginCommon
@@ -25,6 +25,8 @@ import re
 
 class Name_Spaces(Plugin):
 
+    only_for_tags = ["name"]
+
     def init(self, logger):
         Plugin.init(self, logger)
         self.errors[903] = { "item": 5010, "level": 2, "tag": ["name", "fix:chair"], "desc": T_(u"Too many spaces") }
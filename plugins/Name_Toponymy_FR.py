@@ -19,12 +19,18 @@
 ##                                                                       ##
 ###########################################################################
 
-from plugins.Plugin import Plugin
+from plugins.Plugin import Plugin, ValueCache
 
 
 class Name_Toponymy_FR(Plugin):
 
     only_for = ["FR", "NC"]
+    only_for_tags = ["name"]
+
+    def __init__(self, father):
+        Plugin.__init__(self, father)
+        # same names are on many elements
+        self._names_errors = ValueCache()
 
     def init(self, logger):
         Plugin.init(self, logger)
@@ -126,9 +132,13 @@ class Name_Toponymy_FR(Plugin):
             return
         if (u"highway" not in tags) and (u"waterway" not in tags) and (u"place" not in tags):
             return
+        e = self._names_errors.get(tags[u"name"], self._get_err)
+        if e:
+            return dict(e)
+
+    def _get_err(self, name):
         words = []
 
-        name = tags[u"name"]
         name_subst = self.apply_special_subst(name)
         split = self._split(name_subst)
         for i in xrange(0, len(split), 2):
@@ -175,3 +185,8 @@ class Test(TestPluginCommon):
         e = a.node(None, {"place": "yep", "name": "tio tio tiotio de  tio &apos;tio-tio &amp;tio! "})
         self.check_err(e)
         self.assertEquals(e["fix"]["name"], "Tio Tio Tiotio de  Tio &apos;Tio-Tio &amp;Tio! ")
+
+        # same name on another element, from cache
+        e2 = a.way(None, {"highway": "trunk", "name": "tio tio tiotio de  tio &apos;tio-tio &amp;tio! "}, None)
+        self.assertEquals(e2, e)
+        assert e2 is not e
@@ -21,8 +21,54 @@
 
 import hashlib
 
+# Characters replaced by Plugin.ToolsStripAccents()
+_StripAccents = dict((ord(c), to) for (chars, to) in (
+    (u"àâ", u"a"), (u"éèëê", u"e"), (u"îï", u"i"), (u"ôö", u"o"), (u"ûüù", u"u"), (u"ÿ", u"y"), (u"ç", u"c"),
+    (u"ÀÂ", u"A"), (u"ÉÈËÊ", u"E"), (u"ÎÏ", u"I"), (u"ÔÖ", u"O"), (u"ÛÜÙ", u"U"), (u"Ÿ", u"Y"), (u"Ç", u"C"),
+    (u"œ", u"oe"), (u"æ", u"ae"), (u"Œ", u"OE"), (u"Æ", u"AE"),
+) for c in chars)
+
+
+class ValueCache(object):
+    """
+    Results of a function of a tag value, kept for values repeated on many
+    elements, as names of streets on all their segments. Cleared when full.
+    """
+
+    def __init__(self, size = 100000):
+        self._size = size
+        self._results = {}
+
+    def get(self, value, function):
+        if value in self._results:
+            return self._results[value]
+        if len(self._results) >= self._size:
+            self._results.clear()
+        result = self._results[value] = function(value)
+        return result
+
+
 class Plugin(object):
 
+    # Plugins can be run on elements in parallel, by several processes, each
+    # one with its own instance. Plugins keeping state across elements, for
+    # end() or depending on elements order, run in the analyser process.
+    shardable = True
+
+    # Tag keys, or key prefixes ending with "*", without which node(), way()
+    # and relation() never return errors. Methods are then only called for
+    # elements with one of them. None to be called for all elements.
+    only_for_tags = None
+
+    # Attributes set by init(), as lists or dictionaries loaded from files
+    # or downloaded, restored from a cache by later runs with the same
+    # options instead of calling init() again. The cache is rebuilt when
+    # plugin sources change, when files or folders of init_cache_files,
+    # relative to the osmose folder, change, or after init_cache_delay days.
+    init_cache = None
+    init_cache_files = []
+    init_cache_delay = None
+
     def __init__(self, father):
         self.father = father
 
@@ -81,6 +127,32 @@ class Plugin(object):
         """
         pass
 
+    def node_batch(self, nodes):
+        """
+        Called by analyser_sax with lists of nodes, to be overridden by
+        plugins faster on many nodes at once.
+
+        @param nodes: list of (node, tags), parameters of node().
+        @return: list of error lists, one for each node.
+        """
+        return [self.node(node, tags) for (node, tags) in nodes]
+
+    def way_batch(self, ways):
+        """
+        Called by analyser_sax with lists of ways, as node_batch().
+
+        @param ways: list of (way, tags, nodes), parameters of way().
+        """
+        return [self.way(way, tags, nodes) for (way, tags, nodes) in ways]
+
+    def relation_batch(self, relations):
+        """
+        Called by analyser_sax with lists of relations, as node_batch().
+
+        @param relations: list of (relation, tags, members), parameters of relation().
+        """
+        return [self.relation(relation, tags, members) for (relation, tags, members) in relations]
+
     def end(self, logger):
         """
         Called after starting analyse.
@@ -89,25 +161,7 @@ class Plugin(object):
         pass
 
     def ToolsStripAccents(self, mot):
-        mot = mot.replace(u"à", u"a").replace(u"â", u"a")
-        mot = mot.replace(u"é", u"e").replace(u"è", u"e").replace(u"ë", u"e").replace(u"ê", u"e")
-        mot = mot.replace(u"î", u"i").replace(u"ï", u"i")
-        mot = mot.replace(u"ô", u"o").replace(u"ö", u"o")
-        mot = mot.replace(u"û", u"u").replace(u"ü", u"u").replace(u"ù", u"u")
-        mot = mot.replace(u"ÿ", u"y")
-        mot = mot.replace(u"ç", u"c")
-        mot = mot.replace(U"À", U"A").replace(u"Â", u"A")
-        mot = mot.replace(U"É", U"E").replace(U"È", U"E").replace(U"Ë", U"E").replace(U"Ê", U"E")
-        mot = mot.replace(U"Î", U"I").replace(U"Ï", U"I")
-        mot = mot.replace(U"Ô", U"O").replace(U"Ö", U"O")
-        mot = mot.replace(U"Û", U"U").replace(U"Ü", U"U").replace(u"Ù", u"U")
-        mot = mot.replace(U"Ÿ", U"Y")
-        mot = mot.replace(U"Ç", U"C")
-        mot = mot.replace(U"œ", U"oe")
-        mot = mot.replace(U"æ", U"ae")
-        mot = mot.replace(U"Œ", U"OE")
-        mot = mot.replace(U"Æ", U"AE")
-        return mot
+        return unicode(mot).translate(_StripAccents)
 
     def stablehash(self, s):
         """
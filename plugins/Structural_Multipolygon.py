@@ -24,6 +24,8 @@ from plugins.Plugin import Plugin
 
 class Structural_Multipolygon(Plugin):
 
+    only_for_tags = ["type"]
+
     def init(self, logger):
         Plugin.init(self, logger)
         self.errors[11701] = { "item": 1170, "level": 2, "tag": ["relation", "multipolygon", "fix:chair"], "desc": T_(u"Inadequate role for multipolygon") }
@@ -23,6 +23,8 @@ from plugins.Plugin import Plugin
 
 class Structural_UnclosedArea(Plugin):
 
+    only_for_tags = ["area"]
+
     def init(self, logger):
         Plugin.init(self, logger)
         self.errors[1100] = { "item": 1100, "level": 3, "tag": ["geom", "fix:imagery"], "desc": T_(u"Unclosed area") }
@@ -23,6 +23,8 @@ from plugins.Plugin import Plugin
 
 class Structural_Waterway(Plugin):
 
+    only_for_tags = ["waterway"]
+
     def init(self, logger):
         Plugin.init(self, logger)
         self.errors[12200] = { "item": 1220, "level": 2, "tag": ["geom", "waterway", "fix:imagery"], "desc": T_(u"Closed waterway") }
@@ -48,23 +48,28 @@ class TagFix_BadKey(Plugin):
         self.exceptions_whole = set((
                                 "railway:memor2+", "railway:tbl1+",
                                 ))
+    def check_key(self, k):
+        part = k.split(':', 1)
+        if ":(" in k or k.startswith("def:") or part[0] in self.exceptions:
+            # acess:([date])
+            # key def: can contains sign =
+            return
+        if k in self.exceptions_whole:
+            return
+
+        if not self.KeyPart1.match(part[0]):
+            return 0
+        elif len(part) == 2 and not self.KeyPart2.match(part[1]):
+            return 1
+
     def node(self, data, tags):
-        err = []
-        keys = tags.keys()
-        for k in keys:
-            part = k.split(':', 1)
-            if ":(" in k or k.startswith("def:") or part[0] in self.exceptions:
-                # acess:([date])
-                # key def: can contains sign =
-                continue
-            if k in self.exceptions_whole:
-                continue
-
-            if not self.KeyPart1.match(part[0]):
-                err.append({"class": 3050, "subclass": 0, "text": T_("Bad tag %(k)s=%(v)s", {"k":k, "v":tags[k]})})
-            elif len(part) == 2 and not self.KeyPart2.match(part[1]):
-                err.append({"class": 3050, "subclass": 1, "text": T_("Bad tag %(k)s=%(v)s", {"k":k, "v":tags[k]})})
+        return self.errors_keys(tags, dict((k, self.check_key(k)) for k in tags))
 
+    def errors_keys(self, tags, subclass):
+        err = []
+        for k in tags:
+            if subclass[k] is not None:
+                err.append({"class": 3050, "subclass": subclass[k], "text": T_("Bad tag %(k)s=%(v)s", {"k":k, "v":tags[k]})})
         return err
 
     def way(self, data, tags, nds):
@@ -73,6 +78,21 @@ class TagFix_BadKey(Plugin):
     def relation(self, data, tags, members):
         return self.node(data, tags)
 
+    def node_batch(self, nodes):
+        # same keys are on many elements, check them once
+        subclass = {}
+        for (data, tags) in nodes:
+            for k in tags:
+                if k not in subclass:
+                    subclass[k] = self.check_key(k)
+        return [self.errors_keys(tags, subclass) for (data, tags) in nodes]
+
+    def way_batch(self, ways):
+        return self.node_batch([(data, tags) for (data, tags, nds) in ways])
+
+    def relation_batch(self, relations):
+        return self.node_batch([(data, tags) for (data, tags, members) in relations])
+
 ###########################################################################
 from plugins.Plugin import TestPluginCommon
 
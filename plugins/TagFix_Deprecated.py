@@ -26,6 +26,9 @@ import re
 
 class TagFix_Deprecated(Plugin):
 
+    init_cache = ["Deprecated", "DeprecatedSet"]
+    init_cache_delay = 1
+
     def cleanWiki(self, src):
         if src is None:
             return src
@@ -28,6 +28,7 @@ from plugins.Plugin import Plugin
 class TagFix_Housenumber(Plugin):
 
     not_for = ("RU", "BG")
+    only_for_tags = ["addr:*"]
 
     def init(self, logger):
         Plugin.init(self, logger)
@@ -26,6 +26,7 @@ import re, unicodedata
 class TagFix_Note_Lang_fr(Plugin):
 
     only_for = ["fr"]
+    only_for_tags = ["note", "comment"]
 
     def normalize(self, s):
         return ''.join((c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')).lower()
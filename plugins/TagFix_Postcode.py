@@ -26,6 +26,9 @@ import re
 
 class TagFix_Postcode(Plugin):
 
+    init_cache = ["Country", "CountryPostcodeArea", "CountryPostcodeStreet"]
+    init_cache_delay = 1
+
     def parse_format(self, reline, format):
         format = format.replace('optionally ', '')
         if format[-1] == ')':
@@ -28,6 +28,9 @@ class TagFix_Tree_Lang_fr(Plugin):
 
     only_for = ["fr"]
 
+    init_cache = ["Tree"]
+    init_cache_delay = 1
+
     def strip_accents(self, s):
         return ''.join((c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn'))
 
@@ -26,6 +26,9 @@ import json
 
 
 class TagFix_Wikipedia(Plugin):
+
+    only_for_tags = ["wikipedia", "wikipedia:*"]
+
     def init(self, logger):
         Plugin.init(self, logger)
         if self.father.config.options.get("project") != 'openstreetmap':
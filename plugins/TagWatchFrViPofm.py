@@ -27,6 +27,9 @@ from collections import defaultdict
 
 class TagWatchFrViPofm(Plugin):
 
+    init_cache = ["_update_ks", "_update_kr", "_update_ks_vs", "_update_kr_vs", "_update_ks_vr", "_update_kr_vr"]
+    init_cache_delay = 1
+
     def quoted(self, string):
         return len(string)>=2 and string[0]==u"`" and string[-1]==u"`"
 
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+###########################################################################
+##                                                                       ##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+##                                                                       ##
+###########################################################################
+
+# Measure time spent by sax plugins on the elements of a file, called on
+# each element, and by batches of elements.
+#
+#   tools/bench-plugins.py tests/saint_barthelemy.osm.gz
+#   tools/bench-plugins.py -p TagFix_BadKey -b 100 -b 1000 /data/work/osmose/extracts/france.osm.pbf
+
+from __future__ import print_function
+
+import argparse
+import importlib
+import itertools
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from analysers.analyser_sax import Analyser_Sax
+from modules import OsmoseLog
+
+
+class CollectElements:
+    def __init__(self):
+        self.elements = {"node": [], "way": [], "relation": []}
+
+    def NodeCreate(self, data):
+        if data[u"tag"]:
+            self.elements["node"].append(data)
+
+    def WayCreate(self, data):
+        self.elements["way"].append(data)
+
+    def RelationCreate(self, data):
+        self.elements["relation"].append(data)
+
+
+def bench(function, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        res = function()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return (res, best)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sax plugins")
+    parser.add_argument("-p", "--plugin", action="append",
+                        help="plugin to benchmark, can be repeated (default: plugins with batch methods)")
+    parser.add_argument("-b", "--batch-size", action="append", type=int,
+                        help="number of elements by batch, can be repeated (default: 1000)")
+    parser.add_argument("-c", "--country", default="FR",
+                        help="country option of the plugins")
+    parser.add_argument("-l", "--language", default="fr",
+                        help="language option of the plugins")
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="number of runs, best one is reported")
+    parser.add_argument("filename")
+    args = parser.parse_args()
+
+    class config:
+        dir_scripts = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+        options = {"project": "openstreetmap", "country": args.country, "language": args.language}
+        src = args.filename
+        dst = None
+        polygon_id = None
+    logger = OsmoseLog.logger(open(os.devnull, "w"))
+    analyser = Analyser_Sax(config(), logger)
+    analyser._load_parser()
+
+    collect = CollectElements()
+    analyser.parser.CopyTo(collect)
+
+    plugins = args.plugin or ["Name_Script", "TagFix_BadKey"]
+    for name in plugins:
+        plugin = getattr(importlib.import_module("plugins." + name), name)(analyser)
+        plugin.init(logger)
+        for kind in plugin.availableMethodes():
+            elements = [analyser._plugins_args(kind, data) for data in collect.elements[kind]]
+            if not elements:
+                continue
+            meth = getattr(plugin, kind)
+            (res, duration) = bench(lambda: [meth(*a) for a in elements], args.repeat)
+            print("%-24s %-8s %8d elements %8.4fs" % (name, kind, len(elements), duration))
+            batch_meth = getattr(plugin, kind + "_batch")
+            for size in (args.batch_size or [1000]):
+                (res_batch, duration) = bench(lambda: list(itertools.chain.from_iterable(batch_meth(elements[i:i+size]) for i in range(0, len(elements), size))), args.repeat)
+                print("%-24s %-8s %8s by %-5d %8.4fs %s" % ("", "batch", "", size, duration, "same" if res == res_batch else "DIFFERENT"))
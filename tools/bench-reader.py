@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+###########################################################################
+##                                                                       ##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+##                                                                       ##
+###########################################################################
+
+# Measure throughput (elements/s) of the OSM readers on a file.
+#
+#   tools/bench-reader.py tests/saint_barthelemy.osm.gz
+#   tools/bench-reader.py -r expat -n 5 /data/work/osmose/extracts/france.osm.bz2
+#   tools/bench-reader.py -d 0 -d 4 /data/work/osmose/extracts/france.osm.bz2
+#   tools/bench-reader.py -j 1 -j 2 -j 16 /data/work/osmose/extracts/france.osm.pbf
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules"))
+
+import config
+import OsmSax
+import OsmPbf
+
+
+class CountObjects:
+    def __init__(self):
+        self.num = 0
+
+    def NodeCreate(self, data):
+        self.num += 1
+
+    def WayCreate(self, data):
+        self.num += 1
+
+    def RelationCreate(self, data):
+        self.num += 1
+
+
+readers = {
+    "sax": OsmSax.OsmSaxReader,
+    "expat": OsmSax.OsmExpatReader,
+}
+
+
+def bench(reader, filename, repeat):
+    best = None
+    for i in range(repeat):
+        count = CountObjects()
+        start = time.time()
+        reader(filename).CopyTo(count)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return (count.num, best)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark OSM readers")
+    parser.add_argument("-r", "--reader", action="append", choices=sorted(readers.keys()),
+                        help="reader to benchmark, can be repeated (default: all)")
+    parser.add_argument("-j", "--concurrency", action="append", type=int,
+                        help="number of .pbf decoding processes, can be repeated")
+    parser.add_argument("-d", "--decompress-threads", action="append", type=int,
+                        help="number of .bz2/.gz decompressing threads, 0 to decompress in the reader, can be repeated")
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="number of runs, best one is reported")
+    parser.add_argument("filename")
+    args = parser.parse_args()
+
+    if args.filename.endswith(".pbf"):
+        for j in (args.concurrency or sorted(set([1, 2, multiprocessing.cpu_count()]))):
+            reader = lambda filename: OsmPbf.OsmPbfReader(filename, concurrency=j)
+            (num, duration) = bench(reader, args.filename, args.repeat)
+            print("%-12s %10d elements %8.2fs %12.0f elements/s" % ("pbf -j%d" % j, num, duration, num / duration))
+        sys.exit(0)
+
+    if args.filename.endswith(".bz2") or args.filename.endswith(".gz"):
+        decompress = args.decompress_threads or [0, multiprocessing.cpu_count()]
+    else:
+        decompress = [0]
+
+    for name in (args.reader or sorted(readers.keys(), reverse=True)):
+        for d in decompress:
+            config.decompress_threads = d
+            (num, duration) = bench(readers[name], args.filename, args.repeat)
+            label = name if len(decompress) == 1 else "%s -d%d" % (name, d)
+            print("%-12s %10d elements %8.2fs %12.0f elements/s" % (label, num, duration, num / duration))